@@ -1,17 +1,28 @@
 # --- START OF FINAL agent_core.py ---
 
-import threading, serverconfig, traceback
+import time, threading, serverconfig, traceback, metrics, backend
+from collections import OrderedDict
+from nodes import _sanitize_for_filename
 from statefulness import UserDossier, MemorySystem
+from pipeline import PipelineExecutor, run_node
+from ingestion import IngestionQueue
+from dossierstore import DossierStore
 from nodes import (
-    InputParserNode, AuthenticationNode, MemoryRecallNode, PromptFormatterNode, 
+    InputParserNode, AuthenticationNode, QueryAnalysisNode, MemoryRecallNode, PromptFormatterNode, 
     ContextMonitorNode, LLMCallNode, WorkingMemoryUpdateNode, MemoryGatekeeperNode
 )
 
+# Requests that name neither a session nor a user share this session, as all requests used to.
+DEFAULT_SESSION_ID = "default"
+
 class StateAgent:
     def __init__(self, persona_id, ability_id, engine_id):
         print("Initializing State Agent Core...")
         self.memory_system = MemorySystem()
-        self.dossiers = {}
+        # All background memory work goes through one bounded worker pool, and its backend calls
+        # queue behind the turns users are waiting on.
+        self.ingestion = IngestionQueue(serverconfig.INGESTION_WORKERS, serverconfig.INGESTION_MAX_QUEUE, serverconfig.INGESTION_WHEN_FULL,
+                                        job_context=lambda: backend.priority(backend.INGESTION))
 
         # These now correctly store the defaults passed from server.py at startup
         self.default_persona_id = persona_id
@@ -24,53 +35,169 @@ class StateAgent:
         initial_dossier.persona_id = self.default_persona_id
         initial_dossier.ability_id = self.default_ability_id
         initial_dossier.engine_id = self.default_engine_id
-        self.dossiers[initial_agent_id] = initial_dossier
+        # Dossiers persist on disk, load on first use and leave RAM when idle. The initial user's
+        # dossier is always rebuilt from the startup defaults, so it is pinned and never stored.
+        self.dossiers = DossierStore(serverconfig.DOSSIER_STORE_PATH, self._build_dossier, max_resident=serverconfig.DOSSIER_MAX_RESIDENT,
+                                     idle_seconds=serverconfig.DOSSIER_IDLE_SECONDS, pinned=[initial_agent_id], shared=serverconfig.SHARED_STORE,
+                                     session_idle_seconds=serverconfig.SESSION_IDLE_SECONDS)
+        self.dossiers.put(initial_dossier)
         
-        self.active_session_id = initial_agent_id
+        # session_id -> user_id. Each client session has its own active dossier, so one
+        # person's `//user` switch no longer changes what every other request sees.
+        # With worker processes the dossier store holds the authoritative copy (see _session_user).
+        # session_id -> (user_id, last_used), least recently used first. Every client run opens a
+        # new session, so at most SESSION_MAX are kept and idle ones expire (the default never does).
+        self.sessions = OrderedDict({DEFAULT_SESSION_ID: (initial_agent_id, time.monotonic())})
         self.current_model_id = None
+        # Guards only the sessions/dossiers maps. Turns are serialized per dossier (UserDossier.lock).
         self.lock = threading.Lock()
         
         self.pipeline = [
-            InputParserNode(self), AuthenticationNode(self), MemoryRecallNode(self), 
+            InputParserNode(self), AuthenticationNode(self), QueryAnalysisNode(self), MemoryRecallNode(self), 
             PromptFormatterNode(self), ContextMonitorNode(self), LLMCallNode(self), 
             WorkingMemoryUpdateNode(self), MemoryGatekeeperNode(self)
         ]
+        # Independent nodes (e.g. authentication and query analysis) run concurrently.
+        self.executor = PipelineExecutor(self.pipeline)
+        print(f"[PIPELINE] {self.executor.describe()}")
         print("State Agent Core Initialized (v0.3 - Implicit Intelligence).")
 
-    def switch_active_dossier(self, user_id):
+    def _build_dossier(self, user_id, snapshot):
+        """DossierStore factory: restores a stored dossier, or starts a new one."""
+        if snapshot is not None: return UserDossier.from_dict(snapshot)
+        new_dossier = UserDossier(user_id)
+        # New dossiers for users ALSO get the startup defaults.
+        new_dossier.persona_id = self.default_persona_id
+        new_dossier.ability_id = self.default_ability_id
+        new_dossier.engine_id = self.default_engine_id
+        return new_dossier
+
+    def _get_or_create_dossier(self, user_id):
+        # Caller holds self.lock.
+        return self.dossiers.get(user_id)
+
+    def _session_user(self, session_id):
+        # Caller holds self.lock. Another worker process may have switched this session.
+        self._expire_sessions()
+        if serverconfig.SHARED_STORE and (user_id := self.dossiers.get_session(session_id)): self.sessions.pop(session_id, None)
+        elif session_id in self.sessions: user_id = self.sessions.pop(session_id)[0]
+        else: return None
+        self.sessions[session_id] = (user_id, time.monotonic())
+        return user_id
+
+    def _set_session(self, session_id, user_id):
+        # Caller holds self.lock.
+        self.sessions.pop(session_id, None); self.sessions[session_id] = (user_id, time.monotonic())
+        if serverconfig.SHARED_STORE: self.dossiers.set_session(session_id, user_id)
+        self._expire_sessions()
+
+    def _expire_sessions(self):
+        # Caller holds self.lock. Drops least recently used sessions over the cap, then idle ones.
+        now = time.monotonic()
+        for session_id, (_, last_used) in list(self.sessions.items()):
+            if session_id == DEFAULT_SESSION_ID: continue
+            if len(self.sessions) <= serverconfig.SESSION_MAX and now - last_used < serverconfig.SESSION_IDLE_SECONDS: break # the rest are newer
+            del self.sessions[session_id]
+
+    def shutdown(self):
+        """Drains queued memory ingestion, flushes dossiers, then stops the pipeline pool."""
+        print(f"[INGEST] Draining {self.ingestion.stats()['queued']} queued memory job(s)...")
+        self.ingestion.shutdown(drain=True)
+        self.dossiers.close()
+        self.executor.shutdown()
+
+    def switch_active_dossier(self, user_id, session_id=DEFAULT_SESSION_ID):
+        """Points one session at `user_id`'s dossier (creating it if needed) and returns the dossier."""
         with self.lock:
-            if user_id not in self.dossiers:
-                new_dossier = UserDossier(user_id)
-                # New dossiers for users ALSO get the startup defaults.
-                new_dossier.persona_id = self.default_persona_id
-                new_dossier.ability_id = self.default_ability_id
-                new_dossier.engine_id = self.default_engine_id
-                self.dossiers[user_id] = new_dossier
-            
-            self.active_session_id = user_id
-            active_dossier = self.dossiers[self.active_session_id]
-            print(f"[DOSSIER_MGR] Active session switched to: {user_id} (Mind: P:{active_dossier.persona_id}/A:{active_dossier.ability_id}/E:{active_dossier.engine_id})")
-            
-    def handle_request(self, request_data, model_id_from_client):
+            active_dossier = self._get_or_create_dossier(user_id)
+            self._set_session(session_id, user_id)
+        print(f"[DOSSIER_MGR] Session '{session_id}' switched to: {user_id} (Mind: P:{active_dossier.persona_id}/A:{active_dossier.ability_id}/E:{active_dossier.engine_id})")
+        return active_dossier
+
+    @staticmethod
+    def session_id_for(request_data):
+        """The session a request belongs to: its 'session_id', else one derived from its OpenAI 'user' field."""
+        if session_id := str(request_data.get('session_id') or "").strip(): return session_id
+        if user_id := _sanitize_for_filename(str(request_data.get('user') or "")): return f"user:{user_id}"
+        return DEFAULT_SESSION_ID
+
+    def _resolve_session(self, request_data):
+        session_id = self.session_id_for(request_data)
         with self.lock:
-            user_dossier = self.dossiers.get(self.active_session_id, self.dossiers[serverconfig.INITIAL_USER_ID])
-            self.current_model_id = model_id_from_client
+            user_id = self._session_user(session_id)
+            if user_id is None:
+                # A client that names its user skips the "who am I speaking with" step.
+                user_id = _sanitize_for_filename(str(request_data.get('user') or "")) or serverconfig.INITIAL_USER_ID
+                self._set_session(session_id, user_id)
+            return session_id, self._get_or_create_dossier(user_id)
+
+    def claim_dossier(self, context, dossier):
+        """
+        Makes the current turn the only one running on `dossier` until it finishes. The shared
+        initial-user dossier is never locked: turns on it end before touching its history.
+        """
+        if dossier.user_id == serverconfig.INITIAL_USER_ID or dossier.lock in context['held_locks']: return
+        dossier.lock.acquire(); context['held_locks'].append(dossier.lock); context['claimed_dossiers'].append(dossier)
+        # Another worker may have served this user since it was loaded; catch up now that no other turn can be using it.
+        self.dossiers.refresh(dossier)
 
+    def _release_turn(self, context):
+        # Snapshot what the turn changed while it still owns the dossiers; the store writes it back later.
+        while context['claimed_dossiers']: self.dossiers.save(context['claimed_dossiers'].pop())
+        while context['held_locks']: context['held_locks'].pop().release()
+
+    def handle_request(self, request_data, model_id_from_client, stream=False):
+        """
+        Runs the pipeline and returns the response text. With stream=True and a turn that
+        reaches the LLM, returns a generator of text deltas instead; the nodes after
+        LLMCallNode run on the assembled text once the generator is exhausted.
+        """
+        session_id, user_dossier = self._resolve_session(request_data)
+        self.current_model_id = model_id_from_client
+        context = {
+            'agent': self, 'session_id': session_id, 'user_dossier': user_dossier, 'memory_system': self.memory_system,
+            'request_data': request_data, 'model_id': model_id_from_client, 
+            'continue_pipeline': True, 'stream': stream, 'held_locks': [], 'claimed_dossiers': [], 'turn_started': time.perf_counter(),
+        }
+        streaming = False
         try:
-            context = {
-                'agent': self, 'user_dossier': user_dossier, 'memory_system': self.memory_system,
-                'request_data': request_data, 'model_id': self.current_model_id, 
-                'continue_pipeline': True,
-            }
-            
-            for node_instance in self.pipeline:
-                if not context.get('continue_pipeline', True): break
-                context = node_instance.process(context)
+            self.claim_dossier(context, user_dossier)
+            context, remaining_nodes = self.executor.run(context, stop_after=lambda c: 'response_stream' in c)
+            if 'response_stream' in context:
+                # The dossier stays locked until the stream is finished (or abandoned).
+                turn = self._finish_streamed_turn(context, remaining_nodes)
+                next(turn); streaming = True
+                return turn
             
             return context.get('final_response', "Error: Agent pipeline produced no response.")
         
         except Exception as e:
             traceback.print_exc()
             return f"Fatal Server Error: {e}"
+        finally:
+            if not streaming:
+                self._release_turn(context); metrics.TURN_SECONDS.observe(time.perf_counter() - context['turn_started'], mode="plain")
+
+    def _finish_streamed_turn(self, context, remaining_nodes):
+        try:
+            # Primed by handle_request, so the finally below runs even if the client never reads the stream.
+            yield ""
+            parts = []
+            try:
+                for delta in context.pop('response_stream'):
+                    parts.append(delta); yield delta
+            except Exception as e:
+                traceback.print_exc()
+                if not parts: yield "Error: Could not contact model."; return
+            text = "".join(parts).strip()
+            if not text: return
+            context['llm_response_text'] = text; context['final_response'] = text
+            try:
+                for node_instance in remaining_nodes:
+                    if not context.get('continue_pipeline', True): break
+                    context = run_node(node_instance, context)
+            except Exception: traceback.print_exc()
+        finally:
+            self._release_turn(context); metrics.TURN_SECONDS.observe(time.perf_counter() - context['turn_started'], mode="stream")
 
 # --- END OF FINAL agent_core.py ---
\ No newline at end of file
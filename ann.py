@@ -0,0 +1,234 @@
+# --- START OF FILE ann.py ---
+
+import os
+import json
+import threading
+import numpy as np
+from similarity import SimilaritySearch, normalize, top_k_indices
+
+def _nearest_centroids(data, centroids, chunk_rows=16384):
+    """Index of the closest (max dot product) centroid for every row of `data`."""
+    out = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), chunk_rows):
+        out[start:start + chunk_rows] = np.argmax(np.asarray(data[start:start + chunk_rows]) @ centroids.T, axis=1)
+    return out
+
+def spherical_kmeans(data, k, iterations=12, seed=0):
+    """Plain NumPy k-means on unit vectors (cosine distance). Returns unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest_centroids(data, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filled = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(data[order], starts[filled], axis=0)
+        # Empty clusters are re-seeded from random rows so every list stays useful.
+        sums[~filled] = data[rng.choice(len(data), int((~filled).sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+class _RowList:
+    """Growable int64 array; cheaper than Python lists of ints for large inverted lists."""
+    def __init__(self, rows=None):
+        self.data = np.asarray(rows if rows is not None else np.empty(0), dtype=np.int64); self.size = len(self.data)
+
+    def append(self, row):
+        if self.size == len(self.data):
+            grown = np.empty(max(16, 2 * len(self.data)), dtype=np.int64); grown[:self.size] = self.data; self.data = grown
+        self.data[self.size] = row; self.size += 1
+
+    def view(self): return self.data[:self.size]
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour index (inverted file over k-means centroids) for the
+    unit-normalized rows of a VectorStore.
+
+    Nothing changes until the store holds `train_min_rows` vectors; then the centroids are
+    trained once and every later `add` files its row under the nearest centroid. The
+    centroids are retrained when the store has grown `retrain_factor` times since the
+    last training. Training runs on a background thread without holding any lock; the
+    old centroids (or exact scans) keep serving until the new ones are swapped in.
+    Persisted next to the store as:
+      ivf.centroids.npy   (n_lists, dim) float32 centroids
+      ivf.assign.i32      append-only int32 list id per store row
+      ivf.json            rows the centroids were trained on
+    `search` returns None whenever an exact scan is the better choice, so callers can
+    always fall back to brute force. Writes hold the store's lock file, so worker processes
+    sharing one store also share one index; `refresh()` picks up their assignments.
+    """
+    CENTROIDS_FILE = "ivf.centroids.npy"
+    ASSIGN_FILE = "ivf.assign.i32"
+    META_FILE = "ivf.json"
+
+    def __init__(self, store, nprobe=8, exact_below=2048, train_min_rows=4096, retrain_factor=4):
+        self.store = store
+        self.nprobe, self.exact_below = nprobe, exact_below
+        self.train_min_rows, self.retrain_factor = train_min_rows, retrain_factor
+        self.centroids_path = os.path.join(store.directory, self.CENTROIDS_FILE)
+        self.assign_path = os.path.join(store.directory, self.ASSIGN_FILE)
+        self.meta_path = os.path.join(store.directory, self.META_FILE)
+        self.lock = threading.Lock()
+        self._trainer = None # background training thread, if one is running
+        self.search_engine = SimilaritySearch(lambda: self.store.matrix)
+        self.centroids, self.lists, self.assigned_rows, self.trained_rows = None, [], 0, 0
+        self._centroids_mtime = None
+        with self.store.file_lock: self._load()
+
+    # --- Persistence ---
+    def _load(self):
+        # Caller holds the store's file lock, so the assignment file matches the store on disk.
+        self.store.refresh()
+        if not os.path.exists(self.centroids_path): return
+        try:
+            self._centroids_mtime = os.path.getmtime(self.centroids_path)
+            self.centroids = np.load(self.centroids_path)
+            assign = np.fromfile(self.assign_path, dtype=np.int32) if os.path.exists(self.assign_path) else np.empty(0, dtype=np.int32)
+        except Exception as e:
+            print(f"ANN_WARN: Could not load IVF index, it will be rebuilt: {e}"); self.centroids = None; return
+        assign = assign[:len(self.store)]
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f: self.trained_rows = int(json.load(f)["trained_rows"])
+        except (FileNotFoundError, ValueError, KeyError, TypeError): self.trained_rows = len(assign) # index from before ivf.json
+        self._build_lists(assign)
+        with open(self.assign_path, "r+b" if os.path.exists(self.assign_path) else "wb") as f: f.truncate(assign.nbytes)
+        # Rows added while the index was disabled (or before a crash) are filed now.
+        if self.assigned_rows < len(self.store): self._assign_missing_rows()
+        print(f"ANN: IVF index loaded ({len(self.centroids)} lists over {self.assigned_rows} vectors).")
+
+    def _build_lists(self, assign):
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self.lists = [_RowList(order[bounds[i]:bounds[i + 1]]) for i in range(len(self.centroids))]
+        self.assigned_rows = len(assign)
+
+    def _assign_missing_rows(self):
+        start = self.assigned_rows
+        assign = _nearest_centroids(self.store.matrix[start:], self.centroids)
+        with open(self.assign_path, "ab") as f: f.write(assign.tobytes())
+        for offset, list_id in enumerate(assign): self.lists[list_id].append(start + offset)
+        self.assigned_rows = start + len(assign)
+
+    def _sync(self):
+        """Catches up with another process: a retrain reloads everything, new assignments are appended."""
+        try: mtime = os.path.getmtime(self.centroids_path)
+        except FileNotFoundError: return
+        if mtime != self._centroids_mtime: self.centroids = None; self._load(); return
+        try: on_disk = os.path.getsize(self.assign_path) // 4
+        except FileNotFoundError: return
+        if on_disk <= self.assigned_rows: return
+        start = self.assigned_rows
+        with open(self.assign_path, "rb") as f:
+            f.seek(4 * start); assign = np.fromfile(f, dtype=np.int32, count=on_disk - start)
+        for offset, list_id in enumerate(assign): self.lists[list_id].append(start + offset)
+        self.assigned_rows = start + len(assign)
+
+    def refresh(self):
+        with self.lock, self.store.file_lock: self._sync()
+
+    # --- Building ---
+    def _fit(self, matrix):
+        """Centroids trained on a sample of `matrix`, and the list id of each of its rows. Needs no lock."""
+        rows = len(matrix)
+        n_lists = int(min(4096, max(16, np.sqrt(rows))))
+        rng = np.random.default_rng(rows)
+        sample = matrix[np.sort(rng.choice(rows, min(rows, 64 * n_lists), replace=False))]
+        centroids = spherical_kmeans(sample, n_lists)
+        return centroids, _nearest_centroids(matrix, centroids)
+
+    def _install(self, centroids, assign):
+        """Swaps in freshly trained centroids. Caller holds self.lock and the store's file lock."""
+        trained_rows = len(assign)
+        # Rows stored while training ran are filed under the new centroids too.
+        self.store.refresh()
+        if len(self.store) > trained_rows:
+            assign = np.concatenate([assign, _nearest_centroids(self.store.matrix[trained_rows:], centroids)])
+        tmp_path = f"{self.assign_path}.tmp"
+        assign.tofile(tmp_path); os.replace(tmp_path, self.assign_path)
+        with open(f"{self.centroids_path}.tmp", "wb") as f: np.save(f, centroids)
+        os.replace(f"{self.centroids_path}.tmp", self.centroids_path)
+        with open(f"{self.meta_path}.tmp", "w", encoding="utf-8") as f: json.dump({"trained_rows": trained_rows}, f)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
+        self._centroids_mtime = os.path.getmtime(self.centroids_path)
+        self.centroids, self.trained_rows = centroids, trained_rows
+        self._build_lists(assign)
+        print(f"ANN: Trained IVF index with {len(centroids)} lists over {trained_rows} vectors.")
+
+    def train(self):
+        """(Re)trains centroids on a sample of the store and re-files every row, in the calling thread."""
+        centroids, assign = self._fit(self.store.matrix)
+        with self.lock, self.store.file_lock: self._install(centroids, assign)
+
+    def _start_training(self):
+        # Caller holds self.lock. At most one training runs per process at a time.
+        if self._trainer is not None: return
+        self._trainer = threading.Thread(target=self._train_in_background, args=(self._centroids_mtime,), name="ivf-train", daemon=True)
+        self._trainer.start()
+
+    def _train_in_background(self, started_mtime):
+        try:
+            centroids, assign = self._fit(self.store.matrix)
+            with self.lock, self.store.file_lock:
+                self._sync()
+                # Another process retrained meanwhile; its centroids are already loaded, so ours are dropped.
+                if self._centroids_mtime != started_mtime: return
+                self._install(centroids, assign)
+        except Exception as e: print(f"ANN_WARN: IVF training failed, the current index stays in use: {e}")
+        finally:
+            with self.lock: self._trainer = None
+
+    def add(self, row, vector):
+        """Files a newly stored row. Call after VectorStore.add returned `row`."""
+        with self.lock, self.store.file_lock:
+            self._sync()
+            if self.centroids is None:
+                if len(self.store) >= self.train_min_rows: self._start_training()
+                return
+            if len(self.store) >= self.retrain_factor * self.trained_rows: self._start_training()
+            if row < self.assigned_rows: return # filed by another process
+            if row != self.assigned_rows: self._assign_missing_rows(); return
+            list_id = int(np.argmax(self.centroids @ normalize(vector)))
+            with open(self.assign_path, "ab") as f: f.write(np.int32(list_id).tobytes())
+            self.lists[list_id].append(row); self.assigned_rows += 1
+
+    def add_many(self, first_row):
+        """Files every store row from `first_row` on, after a VectorStore.add_many."""
+        with self.lock, self.store.file_lock:
+            self._sync()
+            if self.centroids is None:
+                if len(self.store) >= self.train_min_rows: self._start_training()
+                return
+            if len(self.store) >= self.retrain_factor * self.trained_rows: self._start_training()
+            if self.assigned_rows < len(self.store): self._assign_missing_rows()
+
+    # --- Searching ---
+    def search(self, query, rows, top_k=3, threshold=None):
+        """
+        Approximate top-k over the given candidate store rows (the speaker/entity filter).
+        Returns a list of (row, score) pairs, or None when the caller should scan exactly.
+        """
+        centroids, lists, assigned = self.centroids, self.lists, self.assigned_rows
+        if centroids is None or len(rows) < self.exact_below: return None
+        if len(lists) != len(centroids): return None # caught mid-retrain
+        allowed = np.zeros(assigned, dtype=bool)
+        rows = np.asarray(rows, dtype=np.int64)
+        allowed[rows[rows < assigned]] = True
+
+        list_order = top_k_indices(centroids @ normalize(query), len(centroids))
+        nprobe = self.nprobe
+        while True:
+            probed = np.concatenate([lists[i].view() for i in list_order[:nprobe]])
+            probed = probed[probed < assigned]
+            candidates = probed[allowed[probed]]
+            # Too few of this user's rows in the probed lists: widen the probe rather than return short.
+            if len(candidates) >= top_k or nprobe >= len(list_order): break
+            nprobe *= 2
+        # Rows stored after the last assignment pass are not in any list yet; score them exactly.
+        candidates = np.concatenate([candidates, rows[rows >= assigned]])
+        return self.search_engine.search_one(query, rows=np.sort(candidates), top_k=top_k, threshold=threshold)
+
+# --- END OF FILE ann.py ---
@@ -0,0 +1,307 @@
+# --- START OF FILE backend.py ---
+
+import time
+import heapq
+import itertools
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import serverconfig
+import metrics
+
+# Priority classes for backend calls, most urgent first.
+INTERACTIVE, RECALL, INGESTION, HOUSEKEEPING = range(4)
+PRIORITY_NAMES = ("interactive", "recall", "ingestion", "housekeeping")
+# Classes from here down are background work and only use spare capacity.
+BACKGROUND = INGESTION
+# Used when the calling thread has not set a priority (see `priority`).
+CALL_TYPE_PRIORITIES = {"chat": INTERACTIVE, "health": HOUSEKEEPING}
+
+_local = threading.local()
+
+@contextmanager
+def priority(level):
+    """Runs every backend call made by this thread inside the block at priority `level`."""
+    previous = getattr(_local, "priority", None); _local.priority = level
+    try: yield
+    finally: _local.priority = previous
+
+def current_priority(call_type=None):
+    level = getattr(_local, "priority", None)
+    return CALL_TYPE_PRIORITIES.get(call_type, RECALL) if level is None else level
+
+class RequestScheduler:
+    """
+    Admission control in front of every backend call. At most `max_in_flight` calls run at
+    once; when one finishes, its slot goes to the most urgent waiter (first come, first
+    served within a class). Background classes never take the last `reserved` slots, so
+    a burst of ingestion cannot leave a chat turn queued behind it. `max_in_flight=0`
+    turns the scheduler off.
+    """
+    def __init__(self, max_in_flight=0, reserved=0):
+        self.max_in_flight = max(0, max_in_flight)
+        self.reserved = min(max(0, reserved), max(0, self.max_in_flight - 1))
+        self.cond = threading.Condition()
+        self.waiting = [] # heap of (priority, ticket)
+        self.tickets = itertools.count()
+        self.in_flight = [0] * len(PRIORITY_NAMES)
+        self.admitted = [0] * len(PRIORITY_NAMES)
+
+    def _limit(self, level): return self.max_in_flight - (self.reserved if level >= BACKGROUND else 0)
+
+    @contextmanager
+    def slot(self, level):
+        """Holds one in-flight slot for the duration of the block."""
+        if not self.max_in_flight: yield; return
+        entry, started = (level, next(self.tickets)), time.perf_counter()
+        with self.cond:
+            heapq.heappush(self.waiting, entry)
+            while self.waiting[0] != entry or sum(self.in_flight) >= self._limit(level): self.cond.wait()
+            heapq.heappop(self.waiting); self.in_flight[level] += 1; self.admitted[level] += 1
+            self.cond.notify_all() # the next waiter may fit too
+        metrics.BACKEND_QUEUE_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[level])
+        try: yield
+        finally:
+            with self.cond: self.in_flight[level] -= 1; self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            waiting = [0] * len(PRIORITY_NAMES)
+            for level, _ in self.waiting: waiting[level] += 1
+            return {"max_in_flight": self.max_in_flight, "background_reserve": self.reserved,
+                    **{name: {"in_flight": self.in_flight[i], "waiting": waiting[i], "admitted": self.admitted[i]} for i, name in enumerate(PRIORITY_NAMES)}}
+
+# Which backend pool (see BackendRouter) serves each call type.
+CALL_TYPE_ROLES = {"chat": "chat", "models": "chat", "utility": "utility", "embedding": "embedding"}
+
+class BackendRouter:
+    """
+    Pools of llama.cpp servers per role (chat, utility, embedding). A call whose URL is just a
+    path ("/v1/chat/completions") goes to the least-loaded healthy server in its role's pool.
+    A call with an `affinity` key (a conversation) stays on the server that served the key
+    last, as long as that server is healthy and at most AFFINITY_SLACK calls busier than the
+    least-loaded one, so its KV cache stays warm. Health comes from the model monitor's
+    polling (`mark`) and from connection failures.
+    """
+    AFFINITY_SLACK = 2
+
+    def __init__(self, pools, max_affinities=4096):
+        self.max_affinities = max_affinities
+        self.lock = threading.Lock()
+        self.configure(pools)
+
+    def configure(self, pools):
+        """Replaces the pools, given as {role: [base_url, ...]}; 'chat' is required."""
+        with self.lock:
+            self.pools = {role: list(dict.fromkeys(url.rstrip("/") for url in urls)) for role, urls in pools.items()}
+            servers = [url for urls in self.pools.values() for url in urls]
+            # A server listed under several roles is one server: its load and health are shared.
+            self.in_flight, self.served = dict.fromkeys(servers, 0), dict.fromkeys(servers, 0)
+            self.healthy, self.models = dict.fromkeys(servers, True), dict.fromkeys(servers)
+            self.affinities = OrderedDict() # (role, key) -> server, least recently used first
+
+    def servers(self):
+        with self.lock: return list(self.in_flight)
+
+    def acquire(self, role, affinity=None):
+        """Picks a server for one call and counts the call against it. Pair with `release`."""
+        with self.lock:
+            pool = self.pools.get(role) or self.pools["chat"]
+            candidates = [url for url in pool if self.healthy[url]] or pool # nothing healthy: let the call try anyway
+            chosen = min(candidates, key=lambda url: (self.in_flight[url], self.served[url]))
+            if affinity is not None:
+                key = (role, affinity)
+                sticky = self.affinities.get(key)
+                if sticky in candidates and self.in_flight[sticky] <= self.in_flight[chosen] + self.AFFINITY_SLACK: chosen = sticky
+                self.affinities[key] = chosen; self.affinities.move_to_end(key)
+                while len(self.affinities) > self.max_affinities: self.affinities.popitem(last=False)
+            self.in_flight[chosen] += 1; self.served[chosen] += 1
+            return chosen
+
+    def release(self, server):
+        with self.lock:
+            if server in self.in_flight: self.in_flight[server] -= 1
+
+    def mark(self, server, healthy, model=None):
+        """Records a health check (or a failed call) for one server."""
+        with self.lock:
+            if server not in self.healthy: return
+            if self.healthy[server] != healthy: print(f"[BACKEND] {server} is {'back online' if healthy else 'unavailable'}.")
+            self.healthy[server] = healthy
+            if model is not None: self.models[server] = model
+
+    def has_healthy(self, role):
+        with self.lock: return any(self.healthy[url] for url in self.pools.get(role) or self.pools["chat"])
+
+    def model_for(self, role):
+        """The model loaded on the first healthy server of a role's pool, if any."""
+        with self.lock:
+            for url in self.pools.get(role) or self.pools["chat"]:
+                if self.healthy[url] and self.models[url]: return self.models[url]
+            return None
+
+    def stats(self):
+        with self.lock:
+            return {"pools": {role: list(urls) for role, urls in self.pools.items()},
+                    "servers": {url: {"healthy": self.healthy[url], "model": self.models[url], "in_flight": self.in_flight[url], "served": self.served[url]}
+                                for url in self.in_flight}}
+
+class BackendClient:
+    """
+    The one HTTP client every llama.cpp call goes through.
+
+    - A single requests.Session keeps pooled keep-alive connections, so turns stop paying
+      for TCP setup on every utility prompt or embedding.
+    - Each endpoint (host + path) gets its own concurrency cap, so a burst on one route
+      cannot take every connection.
+    - Retries are bounded, back off exponentially, and only cover failures where nothing
+      was generated yet (connect errors and 502/503/504), so a generation is never duplicated.
+    - Every call names its call type, which picks the timeout, and runs at the calling
+      thread's priority (see `priority`); the scheduler admits urgent calls first.
+    - A URL given as a bare path is sent to a server from the call type's pool (see BackendRouter).
+    - A chat call with an `affinity` key gets that conversation's slot (see SlotAffinity) on
+      whichever server it was routed to, so a slot id never crosses servers.
+    """
+    def __init__(self, pool_size=32, retries=2, backoff=0.25, timeouts=None, endpoint_limits=None, scheduler=None, router=None, slots=None):
+        self.timeouts = dict(timeouts or {})
+        self.scheduler = scheduler or RequestScheduler()
+        self.router, self.slots = router, slots
+        self.endpoint_limits = dict(endpoint_limits or {})
+        self._semaphores, self._sem_lock = {}, threading.Lock()
+        retry = Retry(total=retries, connect=retries, read=0, other=0, status=retries, status_forcelist=(502, 503, 504),
+                      allowed_methods=None, backoff_factor=backoff, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter); self.session.mount("https://", adapter)
+
+    def _semaphore(self, url):
+        parts = urlsplit(url)
+        limit = self.endpoint_limits.get(parts.path)
+        if not limit: return None
+        key = (parts.netloc, parts.path)
+        with self._sem_lock:
+            if key not in self._semaphores: self._semaphores[key] = threading.BoundedSemaphore(limit)
+            return self._semaphores[key]
+
+    @contextmanager
+    def _routed(self, call_type, url, affinity):
+        """Yields the absolute URL for one call, holding its server's load count meanwhile."""
+        if not url.startswith("/") or self.router is None: yield url; return
+        server = self.router.acquire(CALL_TYPE_ROLES.get(call_type, "chat"), affinity)
+        try: yield server + url
+        except requests.exceptions.ConnectionError: self.router.mark(server, False); raise
+        finally: self.router.release(server)
+
+    def _pin_slot(self, call_type, url, affinity, kwargs):
+        """`kwargs` with the conversation's slot on the server `url` points at added to a chat payload."""
+        if self.slots is None or affinity is None or CALL_TYPE_ROLES.get(call_type) != "chat" or not isinstance(kwargs.get("json"), dict): return kwargs
+        if (slot := self.slots.slot_for(affinity, server=urlsplit(url).netloc)) is None: return kwargs
+        return dict(kwargs, json=dict(kwargs["json"], id_slot=slot))
+
+    def request(self, method, call_type, url, affinity=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts.get(call_type, 60))
+        try: return self._request(method, call_type, url, affinity, kwargs)
+        except requests.exceptions.ConnectionError:
+            # That server is now marked unavailable; a routed call gets one more try on another server of its pool.
+            if not url.startswith("/") or self.router is None or not self.router.has_healthy(CALL_TYPE_ROLES.get(call_type, "chat")): raise
+            return self._request(method, call_type, url, affinity, kwargs)
+
+    def _request(self, method, call_type, url, affinity, kwargs):
+        # The span includes waiting for a scheduler and endpoint slot, which is part of what the caller pays.
+        with metrics.BACKEND_SECONDS.time(call_type=call_type, outcome="error") as span, \
+             self.scheduler.slot(current_priority(call_type)), self._routed(call_type, url, affinity) as url, self._semaphore(url) or nullcontext():
+            resp = self.session.request(method, url, **self._pin_slot(call_type, url, affinity, kwargs))
+            span["outcome"] = "ok" if resp.ok else f"http_{resp.status_code}"
+            return resp
+
+    @contextmanager
+    def stream(self, call_type, url, affinity=None, **kwargs):
+        """POSTs with a streamed body. The scheduler and endpoint slots are held until the caller leaves the block."""
+        kwargs.setdefault("timeout", self.timeouts.get(call_type, 60))
+        with metrics.BACKEND_SECONDS.time(call_type=call_type, outcome="error") as span, \
+             self.scheduler.slot(current_priority(call_type)), self._routed(call_type, url, affinity) as url, self._semaphore(url) or nullcontext():
+            resp = self.session.post(url, stream=True, **self._pin_slot(call_type, url, affinity, kwargs))
+            try:
+                yield resp
+                span["outcome"] = "ok" if resp.ok else f"http_{resp.status_code}"
+            finally: resp.close()
+
+    def post(self, call_type, url, **kwargs): return self.request("POST", call_type, url, **kwargs)
+    def get(self, call_type, url, **kwargs): return self.request("GET", call_type, url, **kwargs)
+
+class SlotAffinity:
+    """
+    Pins each conversation (dossier) to one llama.cpp slot so its KV cache survives between
+    turns; when every slot is taken, the least recently used conversation gives its slot up.
+    Also keeps prompt-cache statistics from the `timings` llama.cpp returns with each reply.
+
+    Slots belong to one server: a conversation routed to another server of its pool gets a
+    slot there, and each server's `slots` are shared out separately.
+
+    With `shared=True` (several worker processes) the LRU table could not agree between
+    processes, so a conversation's slot is a stable hash of its key instead.
+    """
+    def __init__(self, slots=0, shared=False):
+        self.slots, self.shared = max(0, slots), shared
+        self.owners = OrderedDict() # (server, conversation key) -> slot, least recently used first
+        self.lock = threading.Lock()
+        self.replies = self.prompt_tokens = self.cached_tokens = self.reassigned = 0
+        self.prompt_ms = 0.0
+
+    def slot_for(self, key, server=None):
+        """Returns the slot id for `key` on `server`, or None when slot pinning is off."""
+        if not self.slots: return None
+        owner = (server, key)
+        if self.shared: return zlib.crc32(str(owner).encode("utf-8")) % self.slots
+        with self.lock:
+            if owner in self.owners:
+                self.owners.move_to_end(owner); return self.owners[owner]
+            taken = [(other, slot) for other, slot in self.owners.items() if other[0] == server]
+            if len(taken) < self.slots: slot = min(set(range(self.slots)) - {slot for _, slot in taken})
+            else: slot = self.owners.pop(taken[0][0]); self.reassigned += 1
+            self.owners[owner] = slot
+            return slot
+
+    def record(self, reply):
+        """Accounts one chat reply (or final stream chunk) carrying llama.cpp `timings`."""
+        timings = reply.get("timings") if isinstance(reply, dict) else None
+        if not timings or "prompt_n" not in timings: return
+        evaluated = timings["prompt_n"]
+        cached = timings.get("cache_n")
+        if cached is None and (usage := reply.get("usage")) and "prompt_tokens" in usage: cached = max(0, usage["prompt_tokens"] - evaluated)
+        with self.lock:
+            self.replies += 1; self.prompt_tokens += evaluated + (cached or 0); self.cached_tokens += cached or 0
+            self.prompt_ms += timings.get("prompt_ms", 0.0)
+
+    def stats(self):
+        with self.lock:
+            return {"slots": self.slots, "pinned_conversations": len(self.owners), "slot_reassignments": self.reassigned,
+                    "replies": self.replies, "prompt_tokens": self.prompt_tokens, "cached_prompt_tokens": self.cached_tokens,
+                    "cache_hit_rate": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+                    "avg_prefill_ms": round(self.prompt_ms / self.replies, 2) if self.replies else 0.0}
+
+# --- Shared instance used by every subsystem ---
+slots = SlotAffinity(serverconfig.BACKEND_SLOTS, shared=serverconfig.SHARED_STORE)
+client = BackendClient(
+    pool_size=serverconfig.BACKEND_POOL_SIZE,
+    retries=serverconfig.BACKEND_RETRIES,
+    backoff=serverconfig.BACKEND_RETRY_BACKOFF,
+    timeouts=serverconfig.BACKEND_TIMEOUTS,
+    endpoint_limits={"/v1/chat/completions": serverconfig.BACKEND_CHAT_CONCURRENCY, "/v1/embeddings": serverconfig.BACKEND_EMBEDDING_CONCURRENCY},
+    scheduler=RequestScheduler(serverconfig.BACKEND_MAX_IN_FLIGHT, serverconfig.BACKEND_BACKGROUND_RESERVE),
+    router=BackendRouter(serverconfig.BACKEND_POOLS),
+    slots=slots,
+)
+
+router = client.router
+
+def post(call_type, url, **kwargs): return client.post(call_type, url, **kwargs)
+def get(call_type, url, **kwargs): return client.get(call_type, url, **kwargs)
+def stream(call_type, url, **kwargs): return client.stream(call_type, url, **kwargs)
+
+# --- END OF FILE backend.py ---
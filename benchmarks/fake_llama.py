@@ -0,0 +1,126 @@
+# --- START OF FILE benchmarks/fake_llama.py ---
+"""
+A stand-in for the llama.cpp server, so the orchestrator can be measured on its own.
+
+    python benchmarks/fake_llama.py --port 8080 --chat-latency-ms 50 --token-latency-ms 5
+
+Implements GET /v1/models, POST /v1/embeddings and POST /v1/chat/completions (plain and
+SSE streaming, with llama.cpp-style `timings`). Latencies are simulated with sleeps and
+embeddings are a pure function of the text (a seeded Gaussian, unit length), so two runs
+of a benchmark see exactly the same vectors.
+"""
+import re, sys, json, time, hashlib, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+def fake_embedding(text, dim):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vec = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vec / np.linalg.norm(vec)
+
+class FakeLlamaServer:
+    """Threaded HTTP server; start() returns its base URL. Counts calls per endpoint."""
+    def __init__(self, host="127.0.0.1", port=0, dim=384, model_id="fake-model.gguf", chat_latency_ms=0.0,
+                 token_latency_ms=0.0, reply_tokens=32, embed_latency_ms=0.0, embed_item_latency_ms=0.0):
+        self.dim, self.model_id, self.reply_tokens = dim, model_id, reply_tokens
+        self.chat_latency, self.token_latency = chat_latency_ms / 1000.0, token_latency_ms / 1000.0
+        self.embed_latency, self.embed_item_latency = embed_latency_ms / 1000.0, embed_item_latency_ms / 1000.0
+        self.calls = {"models": 0, "embeddings": 0, "embedded_texts": 0, "chat": 0}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self): return f"http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-llama", daemon=True); self.thread.start()
+        return self.base_url
+
+    def stop(self): self.httpd.shutdown(); self.httpd.server_close()
+
+    def _count(self, key, n=1):
+        with self.lock: self.calls[key] += n
+
+    def reply_for(self, body):
+        """Plausible content for each of the orchestrator's prompt types."""
+        last = (body.get("messages") or [{}])[-1].get("content", "")
+        text = last if isinstance(last, str) else " ".join(p.get("text", "") for p in last if isinstance(p, dict))
+        if body.get("response_format"):
+            statement = m.group(1) if (m := re.search(r'Message: "(.*)"', text, re.S)) else text
+            return json.dumps({"enriched_fact": statement.strip()[:200] or "Nothing.", "primary_entity": "self", "mentioned_entities": ["self"]})
+        if text.rstrip().endswith(("Subjects:", "Subject:")): return "self"
+        if text.rstrip().endswith("Factual Memory:"): return "The user shared a fact."
+        if text.rstrip().endswith("Updated summary:"): return "The user and the assistant talked about several things."
+        return " ".join(f"word{i}" for i in range(self.reply_tokens))
+
+    def _handler(self):
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True # headers and body go out as separate writes
+            def log_message(self, *args): pass
+
+            def _send_json(self, obj, status=200):
+                data = json.dumps(obj).encode("utf-8")
+                self.send_response(status); self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data))); self.end_headers(); self.wfile.write(data)
+
+            def _chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n"); self.wfile.flush()
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/v1/models":
+                    server._count("models"); self._send_json({"object": "list", "data": [{"id": server.model_id, "object": "model"}]})
+                else: self._send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path == "/v1/embeddings":
+                    texts = body.get("input", []); texts = [texts] if isinstance(texts, str) else texts
+                    server._count("embeddings"); server._count("embedded_texts", len(texts))
+                    time.sleep(server.embed_latency + server.embed_item_latency * len(texts))
+                    self._send_json({"object": "list", "data": [{"index": i, "embedding": fake_embedding(t, server.dim).tolist()} for i, t in enumerate(texts)]})
+                elif self.path == "/v1/chat/completions":
+                    server._count("chat")
+                    reply = server.reply_for(body); tokens = reply.split(" ")
+                    prompt_n = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+                    timings = {"prompt_n": prompt_n, "cache_n": 0, "prompt_ms": server.chat_latency * 1000, "predicted_n": len(tokens)}
+                    time.sleep(server.chat_latency)
+                    if not body.get("stream"):
+                        time.sleep(server.token_latency * len(tokens))
+                        self._send_json({"id": "fake", "object": "chat.completion", "model": server.model_id, "timings": timings,
+                                         "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}]})
+                        return
+                    self.send_response(200); self.send_header("Content-Type", "text/event-stream"); self.send_header("Transfer-Encoding", "chunked"); self.end_headers()
+                    for i, token in enumerate(tokens):
+                        time.sleep(server.token_latency)
+                        delta = {"content": token if i == 0 else " " + token}
+                        self._chunk(f"data: {json.dumps({'choices': [{'index': 0, 'delta': delta}]})}\n\n".encode())
+                    self._chunk(f"data: {json.dumps({'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'timings': timings})}\n\n".encode())
+                    self._chunk(b"data: [DONE]\n\n"); self._chunk(b"")
+                else: self._send_json({"error": "not found"}, 404)
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake llama.cpp server for offline benchmarks")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--chat-latency-ms', type=float, default=0.0, help="Time to first token (prefill).")
+    parser.add_argument('--token-latency-ms', type=float, default=0.0, help="Time per generated token.")
+    parser.add_argument('--reply-tokens', type=int, default=32)
+    parser.add_argument('--embed-latency-ms', type=float, default=0.0, help="Fixed cost per embeddings request.")
+    parser.add_argument('--embed-item-latency-ms', type=float, default=0.0, help="Extra cost per embedded text.")
+    args = parser.parse_args()
+    server = FakeLlamaServer(args.host, args.port, args.dim, chat_latency_ms=args.chat_latency_ms, token_latency_ms=args.token_latency_ms,
+                             reply_tokens=args.reply_tokens, embed_latency_ms=args.embed_latency_ms, embed_item_latency_ms=args.embed_item_latency_ms)
+    print(f"Fake llama.cpp listening on {server.base_url}", file=sys.stderr)
+    try: server.httpd.serve_forever()
+    except KeyboardInterrupt: pass
+
+if __name__ == '__main__':
+    main()
+
+# --- END OF FILE benchmarks/fake_llama.py ---
@@ -0,0 +1,264 @@
+# --- START OF FILE benchmarks/orchestrator.py ---
+"""
+Offline benchmarks for the orchestrator, run against a fake llama.cpp server.
+
+    python benchmarks/orchestrator.py --output bench.json
+    python benchmarks/orchestrator.py --sizes 1000,100000 --compare bench.json
+
+Scenarios:
+  token_counting  full re-tokenization of a 20-message history vs ContextMonitorNode's
+                  incremental count, plus the one-time tiktoken load
+  startup         MemorySystem() construction over 1k/100k/1M stored memories
+  recall          intelligent_recall latency at each size (with and without the embedding call)
+  remember        MemorySystem.remember throughput, one thread and several
+  pipeline        per-node latency of StateAgent.handle_request turns
+  routes          /v1/chat/completions through Flask, plain and streamed
+
+Memories are synthetic (random unit vectors spread over --users speakers and --entities
+subjects) and live in a temporary directory; nothing under memory/ is touched. The fake
+server's latencies are configurable, so results isolate orchestrator overhead when they
+are zero and show overlap/batching effects when they are not. The JSON report carries the
+git revision; --compare prints the relative change of every number against an older report.
+"""
+import os, io, sys, json, time, uuid, argparse, tempfile, subprocess, contextlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT); sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import serverconfig
+import backend
+from fake_llama import FakeLlamaServer
+
+_ORIGINAL_MEMORY_DIR = serverconfig.MEMORY_DIR
+_MEMORY_PATH_NAMES = [name for name, value in vars(serverconfig).items()
+                      if name.endswith(("_PATH", "_DIR")) and isinstance(value, str) and value.startswith(_ORIGINAL_MEMORY_DIR)]
+_ORIGINAL_MEMORY_PATHS = {name: getattr(serverconfig, name) for name in _MEMORY_PATH_NAMES}
+
+def use_memory_dir(directory):
+    """Points every memory path in serverconfig at `directory` instead of memory/."""
+    for name, value in _ORIGINAL_MEMORY_PATHS.items(): setattr(serverconfig, name, directory + value[len(_ORIGINAL_MEMORY_DIR):])
+
+def use_backend(base_url):
+    serverconfig.LLAMA_CPP_BASE_URL = base_url
+    serverconfig.LLAMA_CPP_CHAT_URL = f"{base_url}/v1/chat/completions"
+    serverconfig.LLAMA_CPP_RAW_EMBEDDING_URL = f"{base_url}/v1/embeddings"
+    backend.router.configure({role: [base_url] for role in ("chat", "utility", "embedding")})
+
+def summarize(samples_s):
+    """Latency summary in milliseconds."""
+    ms = np.asarray(samples_s, dtype=np.float64) * 1000
+    if not len(ms): return {"n": 0}
+    return {"n": int(len(ms)), "mean_ms": round(float(ms.mean()), 3), "p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(ms, 95)), 3), "max_ms": round(float(ms.max()), 3)}
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter(); result = fn(*args, **kwargs); return time.perf_counter() - t0, result
+
+@contextlib.contextmanager
+def quiet(enabled):
+    """Silences the agent's console logging while a scenario runs."""
+    if not enabled: yield; return
+    with contextlib.redirect_stdout(io.StringIO()): yield
+
+# --- Synthetic memories ---
+def build_dataset(directory, rows, dim, users, entities, seed):
+    """Writes `rows` memories straight into the vector store and memory log (no backend calls)."""
+    from vectorstore import VectorStore
+    from memorylog import MemoryLog, MemoryRecord
+    use_memory_dir(directory)
+    rng = np.random.default_rng(seed)
+    store = VectorStore(serverconfig.AGENT_VECTOR_DB_PATH, normalize=True)
+    log = MemoryLog(serverconfig.MEMORY_LOG_DB_PATH)
+    for start in range(0, rows, 10000):
+        n = min(10000, rows - start)
+        vectors = rng.standard_normal((n, dim)).astype(np.float32)
+        speakers, subjects = rng.integers(0, users, n), rng.integers(-1, entities, n)
+        records = []
+        for vec, speaker, subject in zip(vectors, speakers, subjects):
+            uid = str(uuid.uuid4()); store.add(uid, vec)
+            speaker_id = f"user{speaker}"
+            records.append(MemoryRecord(uid, "2025-01-01 00:00:00", speaker_id, speaker_id if subject < 0 else f"entity{subject}", f"Memory {start + len(records)} of {speaker_id}."))
+        log.append_many(records)
+    store.close(); log.close()
+
+# --- Scenarios ---
+def bench_token_counting(repeats):
+    import tokencount, nodes
+    encoder_load_s, _ = timed(tokencount.encoder)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i}: " + "the quick brown fox jumps over the lazy dog " * 25} for i in range(20)]
+    messages = [{"role": "system", "content": "You are a helpful assistant. " * 60}] + history + [{"role": "user", "content": "And what about tomorrow?"}]
+    known = [tokencount.count_message(m) for m in messages[:-1]] + [None]
+    monitor = nodes.ContextMonitorNode()
+    full = [timed(monitor._count_tokens, messages)[0] for _ in range(repeats)]
+    incremental = [timed(monitor._count_tokens, messages, known)[0] for _ in range(repeats)]
+    return {"encoder_load_ms": round(encoder_load_s * 1000, 3), "payload_tokens": monitor._count_tokens(messages),
+            "full_recount": summarize(full), "incremental": summarize(incremental)}
+
+def bench_memory_system(directory, rows, args, rng):
+    """Startup and recall latency over a pre-built store of `rows` memories."""
+    from statefulness import MemorySystem
+    use_memory_dir(directory)
+    startup_s, memory = timed(MemorySystem)
+    try:
+        # Ask about (speaker, subject) pairs that exist, so every query has candidates to score.
+        sampled = [memory.master_log[i] for i in rng.integers(0, len(memory.master_log), args.queries)]
+        pairs = [(r.speaker_id, r.entity_id) for r in sampled]
+        queries = [f"What do you remember about {entity}? ({i})" for i, (_, entity) in enumerate(pairs)]
+        with_embedding = [timed(memory.intelligent_recall, user, query, entities=[entity], threshold=-1.0)[0]
+                          for (user, entity), query in zip(pairs, queries)]
+        vectors = memory._get_embeddings([q + " (cached)" for q in queries])
+        precomputed = [timed(memory.intelligent_recall, user, query, entities=[entity], query_vec=vec, threshold=-1.0)[0]
+                       for (user, entity), query, vec in zip(pairs, queries, vectors)]
+        self_recall = [timed(memory.intelligent_recall, user, query, entities=["self"], query_vec=vec, threshold=-1.0)[0]
+                       for (user, _), query, vec in zip(pairs, queries, vectors)]
+        return {"startup_ms": round(startup_s * 1000, 1)}, {
+            "with_embedding": summarize(with_embedding), "precomputed_vector": summarize(precomputed), "self_query": summarize(self_recall),
+            "mean_candidates_entity_query": round(float(np.mean([len(memory.index.rows_for_entities(u, [e])) for u, e in pairs])), 1),
+            "mean_candidates_self_query": round(float(np.mean([len(memory.index.rows_for_self(u)) for u, _ in pairs])), 1)}
+    finally:
+        memory.close()
+
+def bench_remember(directory, args):
+    from statefulness import MemorySystem
+    use_memory_dir(directory)
+    memory = MemorySystem()
+    try:
+        texts = [f"Remembered fact number {i} about a topic." for i in range(args.remember)]
+        sequential_s, _ = timed(lambda: [memory.remember("bench_user", "bench_topic", t) for t in texts[: len(texts) // 2]])
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            parallel_s, _ = timed(lambda: list(pool.map(lambda t: memory.remember("bench_user", "bench_topic", t), texts[len(texts) // 2:])))
+        half = len(texts) // 2
+        return {"sequential_per_s": round(half / sequential_s, 1), f"threads_{args.threads}_per_s": round((len(texts) - half) / parallel_s, 1),
+                "embedding_batches": memory.embedder.stats()}
+    finally:
+        memory.close()
+
+def _conversation(turns):
+    lines = ["I really enjoy hiking in the mountains on weekends", "What do I like to do on weekends?",
+             "My sister Sarah is a doctor in Boston", "Tell me what you know about Sarah", "ok thanks"]
+    return [lines[i % len(lines)] + ("" if i < len(lines) else f" ({i})") for i in range(turns)]
+
+def bench_pipeline(directory, args):
+    from agent_core import StateAgent
+    use_memory_dir(directory)
+    agent = StateAgent(serverconfig.DEFAULT_PERSONA_ID, serverconfig.DEFAULT_ABILITY_ID, serverconfig.DEFAULT_ENGINE_ID)
+    agent.memory_system.embedding_model_id = "fake-model.gguf"
+    node_times = defaultdict(list)
+    for node in agent.pipeline:
+        def timed_process(context, _process=node.process, _name=type(node).__name__):
+            t0 = time.perf_counter()
+            try: return _process(context)
+            finally: node_times[_name].append(time.perf_counter() - t0)
+        node.process = timed_process
+    try:
+        request = lambda text: {"session_id": "bench", "messages": [{"role": "user", "content": text}]}
+        agent.handle_request(request("//user bench_user"), "fake-model.gguf")
+        node_times.clear()
+        turns = [timed(agent.handle_request, request(text), "fake-model.gguf")[0] for text in _conversation(args.turns)]
+        agent.ingestion.shutdown(drain=True)
+        return {"turn": summarize(turns), "nodes": {name: summarize(samples) for name, samples in node_times.items()},
+                "ingestion": agent.ingestion.stats()}
+    finally:
+        agent.shutdown(); agent.memory_system.close()
+
+def bench_routes(directory, args):
+    import server
+    from agent_core import StateAgent
+    use_memory_dir(directory)
+    server.agent = StateAgent(serverconfig.DEFAULT_PERSONA_ID, serverconfig.DEFAULT_ABILITY_ID, serverconfig.DEFAULT_ENGINE_ID)
+    server.agent.memory_system.embedding_model_id = "fake-model.gguf"
+    client = server.app.test_client()
+    try:
+        body = lambda text, stream: {"model": "fake-model.gguf", "session_id": "route", "stream": stream, "messages": [{"role": "user", "content": text}]}
+        client.post('/v1/chat/completions', json=body("//user route_user", False))
+        plain = [timed(client.post, '/v1/chat/completions', json=body(text, False))[0] for text in _conversation(args.turns)]
+        streamed, first_chunk = [], []
+        for text in _conversation(args.turns):
+            t0 = time.perf_counter()
+            response = client.post('/v1/chat/completions', json=body(text, True), buffered=False)
+            chunks = iter(response.response); next(chunks); next(chunks, None); first_chunk.append(time.perf_counter() - t0)
+            for _ in chunks: pass
+            response.close(); streamed.append(time.perf_counter() - t0)
+        stats_s = [timed(client.get, '/v1/memory/stats')[0] for _ in range(20)]
+        return {"chat_completions": summarize(plain), "chat_completions_stream": summarize(streamed),
+                "stream_first_delta": summarize(first_chunk), "memory_stats": summarize(stats_s)}
+    finally:
+        server.agent.shutdown(); server.agent.memory_system.close(); server.agent = None
+
+# --- Reporting ---
+def _flatten(obj, prefix=""):
+    if isinstance(obj, dict):
+        for key, value in obj.items(): yield from _flatten(value, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool): yield prefix, obj
+
+def compare(old, new):
+    """Prints every numeric result next to its value in an older report."""
+    before = dict(_flatten(old.get("results", {})))
+    print(f"\nCompared with {old.get('meta', {}).get('git_revision', '?')}:", file=sys.stderr)
+    for key, value in _flatten(new["results"]):
+        if key in before and before[key]:
+            print(f"  {key:<70} {before[key]:>12} -> {value:>12}  ({100 * (value - before[key]) / abs(before[key]):+.1f}%)", file=sys.stderr)
+
+def git_revision():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception: return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline orchestrator benchmarks against a fake llama.cpp server")
+    parser.add_argument('--sizes', default="1000,100000,1000000", help="Comma-separated memory counts for the startup/recall scenarios.")
+    parser.add_argument('--scenarios', default="token_counting,startup,recall,remember,pipeline,routes")
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--entities', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--remember', type=int, default=400, help="Memories written by the remember scenario.")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--chat-latency-ms', type=float, default=0.0)
+    parser.add_argument('--token-latency-ms', type=float, default=0.0)
+    parser.add_argument('--embed-latency-ms', type=float, default=0.0)
+    parser.add_argument('--embed-item-latency-ms', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON report here as well as to stdout.")
+    parser.add_argument('--compare', help="Earlier JSON report to compare against.")
+    parser.add_argument('--verbose', action='store_true', help="Keep the agent's own logging.")
+    args = parser.parse_args()
+    scenarios = {s.strip() for s in args.scenarios.split(",") if s.strip()}
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    rng = np.random.default_rng(args.seed)
+
+    fake = FakeLlamaServer(dim=args.dim, chat_latency_ms=args.chat_latency_ms, token_latency_ms=args.token_latency_ms,
+                           embed_latency_ms=args.embed_latency_ms, embed_item_latency_ms=args.embed_item_latency_ms)
+    use_backend(fake.start())
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="stateagent-bench-") as tmp:
+        with quiet(not args.verbose):
+            if "token_counting" in scenarios: results["token_counting"] = bench_token_counting(args.repeats)
+            if scenarios & {"startup", "recall"}:
+                for size in sizes:
+                    directory = os.path.join(tmp, f"memories_{size}")
+                    build_s, _ = timed(build_dataset, directory, size, args.dim, args.users, args.entities, args.seed)
+                    startup, recall = bench_memory_system(directory, size, args, rng)
+                    if "startup" in scenarios: results.setdefault("startup", {})[str(size)] = dict(startup, dataset_build_s=round(build_s, 1))
+                    if "recall" in scenarios: results.setdefault("recall", {})[str(size)] = recall
+            if "remember" in scenarios: results["remember"] = bench_remember(os.path.join(tmp, "remember"), args)
+            if "pipeline" in scenarios: results["pipeline"] = bench_pipeline(os.path.join(tmp, "pipeline"), args)
+            if "routes" in scenarios: results["routes"] = bench_routes(os.path.join(tmp, "routes"), args)
+    fake.stop()
+
+    report = {"meta": {"git_revision": git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                       "args": vars(args), "backend_calls": fake.calls}, "results": results}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(text + "\n")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
+
+# --- END OF FILE benchmarks/orchestrator.py ---
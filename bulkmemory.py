@@ -0,0 +1,211 @@
+# --- START OF FILE bulkmemory.py ---
+"""
+Bulk import and export of long-term memories.
+
+    python bulkmemory.py import facts.jsonl [--batch-size 256] [--workers 4] [--restart]
+    python bulkmemory.py export memories.jsonl [--embeddings]
+
+A row is (speaker_id, entity_id, text) plus an optional uuid, timestamp and precomputed
+`embedding`. JSONL holds one object per line; CSV uses the same column names, with the
+embedding as a JSON array. `speaker`/`entity` are accepted for the id columns, and a row
+without an entity is about its speaker. Text is stored as given: the enrich and route
+prompts a chat turn runs are skipped. Export writes the same format, so its output can
+be imported again.
+
+A row without a uuid gets one derived from its content, so importing a row twice stores
+it once. Imports checkpoint after every batch (<file>.checkpoint.json) and resume from
+there. Run the CLI while the server is stopped, or with [server_settings] shared_store
+on so the running server picks the new memories up; the server also offers
+POST /v1/memory/import and GET /v1/memory/export.
+"""
+import os, io, csv, json, time, uuid, argparse, datetime
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import backend
+from memorylog import MemoryRecord
+
+FORMATS = ("jsonl", "csv")
+# Content-derived uuids live in their own namespace, so they never collide with uuid4 ones.
+IMPORT_NAMESPACE = uuid.UUID("6466dea8-dddf-4d2e-be4a-c6dbdcf9faa2")
+ALIASES = {"speaker": "speaker_id", "entity": "entity_id"}
+EXPORT_FIELDS = list(MemoryRecord._fields)
+
+def detect_format(path, fmt=None):
+    if fmt: return fmt
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+def read_rows(f, fmt):
+    """Yields one dict per input row; an unreadable JSONL line yields None so it can be counted."""
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        if not line.strip(): continue
+        try: yield json.loads(line)
+        except ValueError: yield None
+
+def parse_row(row, dim=None):
+    """Returns (MemoryRecord, embedding or None) for one input row, or None if the row is unusable."""
+    from nodes import _sanitize_for_filename
+    if not isinstance(row, dict): return None
+    row = {ALIASES.get(key, key): value for key, value in row.items()}
+    speaker_id = _sanitize_for_filename(str(row.get("speaker_id") or ""))
+    entity_id = _sanitize_for_filename(str(row.get("entity_id") or "")) or speaker_id
+    text = str(row.get("text") or "").strip()
+    if not speaker_id or not text: return None
+    embedding = row.get("embedding")
+    try:
+        if isinstance(embedding, str): embedding = json.loads(embedding) if embedding.strip() else None
+        if embedding is not None: embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    except (ValueError, TypeError): return None
+    if embedding is not None and dim is not None and len(embedding) != dim: return None
+    memory_uuid = str(row.get("uuid") or "") or str(uuid.uuid5(IMPORT_NAMESPACE, f"{speaker_id}\0{entity_id}\0{text}"))
+    timestamp = str(row.get("timestamp") or "") or datetime.datetime.now().isoformat(sep=' ')
+    return MemoryRecord(memory_uuid, timestamp, speaker_id, entity_id, text), embedding
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size: yield batch; batch = []
+    if batch: yield batch
+
+def _remember_batch(memory_system, records, embeddings, level):
+    with backend.priority(level) if level is not None else nullcontext():
+        return memory_system.remember_many(records, embeddings)
+
+def import_rows(memory_system, rows, batch_size=256, workers=4, priority=None, on_batch=None):
+    """
+    Imports row dicts into `memory_system`. Up to `workers` batches embed at the same time;
+    batches are settled in input order and `on_batch(rows_done, stats)` runs after each one
+    (the checkpoint hook). `priority` is the backend priority class for the embedding calls.
+    Returns {"rows", "imported", "skipped", "invalid", "seconds"}.
+    """
+    stats = {"rows": 0, "imported": 0, "skipped": 0, "invalid": 0}
+    started, last_report, rows_read = time.perf_counter(), time.perf_counter(), 0
+    pending = deque() # (future, rows read through this batch, valid rows in it)
+    def settle_oldest():
+        nonlocal last_report
+        future, rows_through, valid = pending.popleft()
+        added = future.result()
+        stats["rows"] = rows_through; stats["imported"] += added; stats["skipped"] += valid - added
+        if on_batch: on_batch(rows_through, stats)
+        if time.perf_counter() - last_report >= 10:
+            last_report = time.perf_counter()
+            print(f"[BULK] {rows_through:,} rows, {rows_through / (last_report - started):,.0f} rows/s "
+                  f"(imported {stats['imported']:,}, skipped {stats['skipped']:,}, invalid {stats['invalid']:,})")
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bulk-import") as pool:
+        for batch in _batches(rows, max(1, batch_size)):
+            parsed = [p for p in (parse_row(row, memory_system.vectors.dim) for row in batch) if p]
+            rows_read += len(batch); stats["invalid"] += len(batch) - len(parsed)
+            future = pool.submit(_remember_batch, memory_system, [r for r, _ in parsed], [e for _, e in parsed], priority)
+            pending.append((future, rows_read, len(parsed)))
+            if len(pending) >= 2 * max(1, workers): settle_oldest()
+        while pending: settle_oldest()
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+class Checkpoint:
+    """Progress of one file import, saved next to it so an interrupted import resumes."""
+    def __init__(self, source_path):
+        self.source = os.path.abspath(source_path)
+        self.path = f"{self.source}.checkpoint.json"
+
+    def load(self):
+        """Rows already imported, or 0 when there is no checkpoint for this exact file."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f: state = json.load(f)
+        except (FileNotFoundError, ValueError): return 0
+        if state.get("source") != self.source or state.get("size") != os.path.getsize(self.source):
+            print(f"[BULK] Ignoring checkpoint '{self.path}': it belongs to a different file."); return 0
+        return int(state.get("rows_done", 0))
+
+    def save(self, rows_done, stats):
+        state = dict(stats, source=self.source, size=os.path.getsize(self.source), rows_done=rows_done)
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f: json.dump(state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def clear(self):
+        try: os.remove(self.path)
+        except FileNotFoundError: pass
+
+def import_file(memory_system, path, fmt=None, batch_size=256, workers=4, resume=True):
+    """Imports a JSONL/CSV file, resuming from its checkpoint. Returns the import stats."""
+    fmt = detect_format(path, fmt)
+    checkpoint = Checkpoint(path)
+    skip = checkpoint.load() if resume else 0
+    if skip: print(f"[BULK] Resuming '{os.path.basename(path)}' after row {skip:,}.")
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        rows = read_rows(f, fmt)
+        for _ in range(skip): next(rows, None)
+        stats = import_rows(memory_system, rows, batch_size, workers, on_batch=lambda done, s: checkpoint.save(skip + done, s))
+    checkpoint.clear()
+    stats["rows"] += skip; stats["resumed_after"] = skip
+    return stats
+
+def export_rows(memory_system, embeddings=False):
+    """Yields every stored memory as an importable row dict, in log order."""
+    for record in memory_system.memory_log:
+        row = record._asdict()
+        if embeddings:
+            vector = memory_system.vectors.get(record.uuid)
+            row["embedding"] = None if vector is None else [round(float(x), 7) for x in vector]
+        yield row
+
+def format_rows(rows, fmt, embeddings=False):
+    """Serializes row dicts as JSONL or CSV text chunks (one per row, CSV header first)."""
+    if fmt != "csv":
+        for row in rows: yield json.dumps(row, ensure_ascii=False) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS + (["embedding"] if embeddings else []))
+    writer.writeheader()
+    for row in rows:
+        if row.get("embedding") is not None: row = dict(row, embedding=json.dumps(row["embedding"]))
+        writer.writerow(row)
+        yield buffer.getvalue(); buffer.seek(0); buffer.truncate()
+
+def export_file(memory_system, path, fmt=None, embeddings=False):
+    """Writes every memory to `path`. Returns how many rows were written."""
+    fmt, written = detect_format(path, fmt), 0
+    def counted(rows):
+        nonlocal written
+        for row in rows: written += 1; yield row
+    with open(f"{path}.tmp", "w", encoding="utf-8", newline="") as f:
+        for chunk in format_rows(counted(export_rows(memory_system, embeddings)), fmt, embeddings): f.write(chunk)
+    os.replace(f"{path}.tmp", path)
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import/export of StateAgent memories")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="Import a JSONL/CSV file of (speaker_id, entity_id, text) rows.")
+    imp.add_argument("path")
+    imp.add_argument("--format", choices=FORMATS, help="Defaults to the file extension (.csv, else JSONL).")
+    imp.add_argument("--batch-size", type=int, default=256)
+    imp.add_argument("--workers", type=int, default=4, help="Batches embedded concurrently.")
+    imp.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint.")
+    exp = sub.add_parser("export", help="Export every memory to a JSONL/CSV file.")
+    exp.add_argument("path")
+    exp.add_argument("--format", choices=FORMATS)
+    exp.add_argument("--embeddings", action="store_true", help="Include each memory's stored (unit-length) vector.")
+    args = parser.parse_args()
+
+    from statefulness import MemorySystem
+    memory_system = MemorySystem()
+    try:
+        if args.command == "import":
+            stats = import_file(memory_system, args.path, args.format, args.batch_size, args.workers, resume=not args.restart)
+            print(f"[BULK] Import finished: {json.dumps(stats)}")
+        else:
+            written = export_file(memory_system, args.path, args.format, args.embeddings)
+            print(f"[BULK] Exported {written:,} memories to '{args.path}'.")
+    finally:
+        memory_system.close()
+
+if __name__ == '__main__':
+    main()
+
+# --- END OF FILE bulkmemory.py ---
@@ -0,0 +1,121 @@
+# --- START OF FILE contextpack.py ---
+
+import time
+from collections import namedtuple
+import backend, serverconfig, tokencount
+
+STATS_RESERVE = 24     # the CONTEXT usage line ContextMonitorNode inserts
+SECTION_OVERHEAD = 8   # header line of the memory/summary system messages
+SUMMARY_JOB_TIMEOUT = 300 # seconds before a summary job that never reported back is submitted again
+
+Packed = namedtuple("Packed", ["recalled", "summary", "history_start"])
+
+class _SummaryUpdate:
+    """One background summary extension: from the summary covering `base_upto` to one covering `upto`."""
+    def __init__(self, base_upto, upto):
+        self.base_upto, self.upto, self.started, self.text = base_upto, upto, time.monotonic(), None
+
+def budget_for(engine_card):
+    """Token budget for one turn: the engine card's optional 'context_budget', else [context] token_budget."""
+    try: return int(engine_card.get('context_budget') or serverconfig.CONTEXT_TOKEN_BUDGET)
+    except (TypeError, ValueError): return serverconfig.CONTEXT_TOKEN_BUDGET
+
+def _plain_text(content):
+    if isinstance(content, str): return content
+    if isinstance(content, list): return " ".join(p.get("text", "") if p.get("type") == "text" else "[image]" for p in content)
+    return ""
+
+class ContextPacker:
+    """
+    Fits a turn's prompt into its token budget, in this order:
+      1. history older than the newest `keep_recent` messages is folded into a rolling summary,
+      2. recalled memories are dropped weakest first (recall returns them best first),
+      3. the remaining verbatim messages are folded too, oldest first.
+
+    The summary lives on the dossier with the sequence number it covers up to. It is only
+    ever extended with messages that newly age out, so one short utility call covers many
+    turns; messages it already covers never need to go back in verbatim. The extension runs
+    as a background job (`submit`, at housekeeping priority) and lands on a later turn; the
+    turn that triggers it uses the summary as it is and simply drops the uncovered messages.
+    """
+    def __init__(self, keep_recent=4, summary_max_tokens=256):
+        self.keep_recent, self.summary_max_tokens = max(0, keep_recent), summary_max_tokens
+
+    @staticmethod
+    def memory_tokens(memory): return tokencount.count_text(memory) + 3 # "\n- " separator
+
+    def pack(self, dossier, budget, fixed_tokens, recalled, history, history_counts, model_id=None, submit=None):
+        """
+        `fixed_tokens` covers what always goes in (system prompt, new user message). `submit(fn, *args, key=...)`
+        queues the summary extension (e.g. IngestionQueue.submit); without it the summary is never extended.
+        Returns Packed(recalled memories to keep, summary text or None, index of the first history message kept verbatim).
+        Called with the turn's dossier lock held.
+        """
+        self._apply_summary_update(dossier)
+        recalled_counts = [self.memory_tokens(m) for m in recalled]
+        def used(n_recalled, start, summary_tokens):
+            memories = sum(recalled_counts[:n_recalled]) + (tokencount.MESSAGE_OVERHEAD + SECTION_OVERHEAD if n_recalled else 0)
+            return fixed_tokens + STATS_RESERVE + memories + sum(history_counts[start:]) + summary_tokens
+
+        if used(len(recalled), 0, 0) <= budget: return Packed(recalled, None, 0)
+
+        first_seq = dossier.messages_added - len(history)
+        reserve = self.summary_max_tokens + tokencount.MESSAGE_OVERHEAD + SECTION_OVERHEAD
+        start, n_recalled = min(len(history), max(0, dossier.summary_upto - first_seq)), len(recalled)
+        while used(n_recalled, start, reserve) > budget and start < len(history) - self.keep_recent: start += 1
+        while used(n_recalled, start, reserve) > budget and n_recalled: n_recalled -= 1
+        while used(n_recalled, start, reserve) > budget and start < len(history): start += 1
+        # Never open the verbatim history on an assistant reply whose question was folded away.
+        while start < len(history) and history[start].get("role") == "assistant": start += 1
+
+        if start and submit: self._schedule_summary(dossier, history, first_seq, start, model_id, submit)
+        summary = (dossier.summary or None) if start else None
+        if used(n_recalled, start, reserve) > budget:
+            print(f"[CONTEXT] Prompt still exceeds its {budget:,}-token budget after packing (system prompt + new message alone).")
+        print(f"[CONTEXT] Packed to budget {budget:,}: folded {start} of {len(history)} history messages, kept {n_recalled} of {len(recalled)} memories.")
+        return Packed(recalled[:n_recalled], summary, start)
+
+    @staticmethod
+    def _apply_summary_update(dossier):
+        # Caller holds the dossier lock. A finished job only applies on top of the summary it extended.
+        update = dossier.summary_update
+        if update is None or update.text is None: return
+        if update.base_upto == dossier.summary_upto and update.upto > dossier.summary_upto: dossier.summary, dossier.summary_upto = update.text, update.upto
+        dossier.summary_update = None
+
+    def _schedule_summary(self, dossier, history, first_seq, start, model_id, submit):
+        # Caller holds the dossier lock.
+        upto, update = first_seq + start, dossier.summary_update
+        if upto <= dossier.summary_upto: return
+        if update is not None and time.monotonic() - update.started < SUMMARY_JOB_TIMEOUT: return # one job at a time
+        update = dossier.summary_update = _SummaryUpdate(dossier.summary_upto, upto)
+        new_messages = history[max(0, dossier.summary_upto - first_seq):start]
+        if not submit(self._extend_summary, dossier, update, dossier.summary, new_messages, model_id, key=("summary", dossier.user_id)):
+            dossier.summary_update = None
+
+    def _extend_summary(self, dossier, update, summary, new_messages, model_id):
+        """Background job: writes the extended summary into `update`; the dossier's next turn applies it."""
+        transcript = "\n".join(f"{m.get('role')}: {_plain_text(m.get('content'))}" for m in new_messages)
+        summary_prompt = f"""
+Update the running summary of a conversation with '{dossier.user_id}'. Keep names, facts, preferences, decisions and open questions; drop small talk.
+Respond with ONLY the updated summary, in at most {self.summary_max_tokens * 2 // 3} words.
+
+Current summary: {summary or "(none yet)"}
+
+New messages:
+{transcript}
+
+Updated summary:"""
+        try:
+            payload = {"messages": [{"role": "user", "content": summary_prompt}], "temperature": 0.2, "n_predict": self.summary_max_tokens}
+            if model_id: payload["model"] = model_id
+            with backend.priority(backend.HOUSEKEEPING):
+                resp = backend.post("utility", serverconfig.CHAT_COMPLETIONS_PATH, json=payload); resp.raise_for_status()
+            update.text = resp.json()['choices'][0]['message']['content'].strip()
+        except Exception as e:
+            print(f"[CONTEXT] Summary update failed, {len(new_messages)} old messages stay unsummarized: {e}")
+            if dossier.summary_update is update: dossier.summary_update = None
+
+packer = ContextPacker(keep_recent=serverconfig.CONTEXT_KEEP_RECENT_MESSAGES, summary_max_tokens=serverconfig.CONTEXT_SUMMARY_MAX_TOKENS)
+
+# --- END OF FILE contextpack.py ---
@@ -0,0 +1,190 @@
+# --- START OF FILE dossierstore.py ---
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class DossierStore:
+    """
+    Resident cache of UserDossiers backed by one SQLite table (one JSON row per user).
+
+    - Dossiers load lazily on first access; unknown users get a fresh one from `factory`.
+    - `save()` snapshots a dossier on the caller's thread (at the end of its turn, while the
+      turn lock is still held) and a writer thread persists the latest snapshot per user,
+      so turns never wait on disk.
+    - At most `max_resident` dossiers stay in RAM (least recently used leave first) and any
+      dossier idle for `idle_seconds` is dropped. A dossier that is locked by a running turn
+      or was touched in the last `grace_seconds` is never evicted, so two live copies of
+      one user can't appear.
+    - With `shared=True` (several worker processes on one store) saves are written through
+      immediately, a resident copy is brought up to date in place (`refresh`, once its turn
+      holds the dossier lock) when another process wrote a newer one, and
+      the session -> user map lives in the `sessions` table so every worker sees switches.
+      Sessions unused for `session_idle_seconds` are deleted from it.
+    """
+    SCHEMA = "CREATE TABLE IF NOT EXISTS dossiers (user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+    SESSIONS_SCHEMA = "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, updated_at REAL NOT NULL DEFAULT 0)"
+    # A session's updated_at is refreshed at most this often while it is being read.
+    SESSION_TOUCH_SECONDS = 60
+
+    def __init__(self, db_path, factory, max_resident=1024, idle_seconds=3600, flush_interval=1.0, grace_seconds=30, pinned=(), shared=False,
+                 session_idle_seconds=86400):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.factory = factory
+        self.max_resident, self.idle_seconds, self.grace_seconds = max(1, max_resident), idle_seconds, grace_seconds
+        self.flush_interval = flush_interval
+        self.pinned, self.shared = set(pinned), shared
+        self.session_idle_seconds = session_idle_seconds
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(self.SCHEMA); self.conn.execute(self.SESSIONS_SCHEMA)
+        if "updated_at" not in {column[1] for column in self.conn.execute("PRAGMA table_info(sessions)")}:
+            # Tables from before session expiry; their rows count as just used.
+            self.conn.execute("ALTER TABLE sessions ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE sessions SET updated_at = ?", (time.time(),))
+        self.db_lock = threading.Lock()
+        self.resident = OrderedDict() # user_id -> (dossier, last_used), least recently used first
+        self.pending = {}             # user_id -> snapshot not yet written
+        self.versions = {}            # user_id -> updated_at of the stored row the resident copy matches (shared mode)
+        self.lock = threading.Condition()
+        self.closed = False
+        self.loads = self.creates = self.writes = self.evictions = self.reloads = 0
+        self._writer = threading.Thread(target=self._write_loop, name="dossier-writer", daemon=True)
+        self._writer.start()
+
+    def get(self, user_id):
+        """Returns the resident dossier for `user_id`, loading or creating it as needed."""
+        with self.lock:
+            if user_id in self.resident: dossier = self.resident.pop(user_id)[0]
+            else:
+                snapshot = self.pending.get(user_id) or self._read(user_id)
+                if snapshot is not None: dossier = self.factory(user_id, snapshot); self.loads += 1
+                else: dossier = self.factory(user_id, None); self.creates += 1
+            self.resident[user_id] = (dossier, time.monotonic())
+            self._evict_over_cap()
+            return dossier
+
+    def refresh(self, dossier):
+        """
+        Shared mode: loads another process's newer snapshot into `dossier` itself, so every
+        holder keeps seeing one object. Call with the dossier's lock held (see StateAgent.claim_dossier).
+        """
+        if not self.shared or dossier.user_id in self.pinned: return
+        with self.lock:
+            if dossier.user_id in self.pending: return # our own newer snapshot is still on its way
+            newer = self._read(dossier.user_id, newer_than=self.versions.get(dossier.user_id, 0.0))
+            if newer is not None: dossier.load_dict(newer); self.reloads += 1
+
+    def put(self, dossier):
+        """Registers an already-built dossier as resident (e.g. the bootstrap dossier)."""
+        with self.lock: self.resident[dossier.user_id] = (dossier, time.monotonic())
+
+    def save(self, dossier):
+        """Snapshots `dossier` now; it is written to disk shortly after."""
+        if dossier.user_id in self.pinned: return
+        snapshot = dossier.to_dict()
+        with self.lock:
+            self.pending[dossier.user_id] = snapshot
+            if not self.shared: self.lock.notify(); return
+        # Other workers may serve this user's next turn, so it has to be on disk before the turn ends.
+        self._write([(dossier.user_id, snapshot)])
+
+    def _read(self, user_id, newer_than=None):
+        """The stored snapshot, or None. With `newer_than`, only if it was written after that time."""
+        with self.db_lock:
+            row = self.conn.execute("SELECT data, updated_at FROM dossiers WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or (newer_than is not None and row[1] <= newer_than): return None
+        try: snapshot = json.loads(row[0])
+        except ValueError as e: print(f"[DOSSIER_STORE] Ignoring unreadable dossier '{user_id}': {e}"); return None
+        self.versions[user_id] = row[1]
+        return snapshot
+
+    # --- Sessions (shared mode) ---
+    def get_session(self, session_id):
+        """The user a session points at, or None. Marks the session as used."""
+        now = time.time()
+        with self.db_lock:
+            row = self.conn.execute("SELECT user_id, updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row and now - row[1] >= self.SESSION_TOUCH_SECONDS:
+                self.conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (now, session_id))
+        return row[0] if row else None
+
+    def set_session(self, session_id, user_id):
+        with self.db_lock:
+            self.conn.execute("INSERT OR REPLACE INTO sessions (session_id, user_id, updated_at) VALUES (?, ?, ?)", (session_id, user_id, time.time()))
+
+    def _expire_sessions(self):
+        try:
+            with self.db_lock:
+                expired = self.conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.session_idle_seconds,)).rowcount
+        except sqlite3.Error as e: print(f"[DOSSIER_STORE] Session cleanup failed, will retry: {e}"); return
+        if expired: print(f"[DOSSIER_STORE] Expired {expired} idle session(s).")
+
+    def _evictable(self, user_id, dossier, last_used, now):
+        return user_id not in self.pinned and not dossier.lock.locked() and now - last_used >= self.grace_seconds
+
+    def _evict_over_cap(self):
+        # Caller holds self.lock.
+        if len(self.resident) <= self.max_resident: return
+        now = time.monotonic()
+        for user_id, (dossier, last_used) in list(self.resident.items()):
+            if len(self.resident) <= self.max_resident: break
+            if self._evictable(user_id, dossier, last_used, now): del self.resident[user_id]; self.evictions += 1
+
+    def _evict_idle(self):
+        with self.lock:
+            now = time.monotonic()
+            for user_id, (dossier, last_used) in list(self.resident.items()):
+                if now - last_used < self.idle_seconds: break # the rest were used more recently
+                if self._evictable(user_id, dossier, last_used, now): del self.resident[user_id]; self.evictions += 1
+
+    def _write_loop(self):
+        last_sweep = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.pending and not self.closed: self.lock.wait(self.flush_interval)
+                batch = list(self.pending.items())
+                closed = self.closed
+            if batch: self._write(batch)
+            if closed: return
+            if time.monotonic() - last_sweep >= min(60.0, self.idle_seconds):
+                self._evict_idle(); self._expire_sessions(); last_sweep = time.monotonic()
+
+    def _write(self, batch):
+        rows = [(user_id, json.dumps(snapshot, ensure_ascii=False), time.time()) for user_id, snapshot in batch]
+        try:
+            with self.db_lock:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("INSERT OR REPLACE INTO dossiers (user_id, data, updated_at) VALUES (?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+        except Exception as e:
+            print(f"[DOSSIER_STORE] Write-back failed, will retry: {e}")
+            with self.db_lock:
+                if self.conn.in_transaction: self.conn.execute("ROLLBACK")
+            time.sleep(self.flush_interval); return
+        with self.lock:
+            # Only forget snapshots that were not replaced while we were writing.
+            for user_id, _, updated_at in rows: self.versions[user_id] = updated_at
+            for user_id, snapshot in batch:
+                if self.pending.get(user_id) is snapshot: del self.pending[user_id]
+            self.writes += len(batch)
+
+    def close(self):
+        """Flushes every pending snapshot and stops the writer."""
+        with self.lock: self.closed = True; self.lock.notify_all()
+        self._writer.join()
+        with self.db_lock: self.conn.close()
+
+    def __len__(self):
+        with self.db_lock: return self.conn.execute("SELECT COUNT(*) FROM dossiers").fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            return {"resident": len(self.resident), "max_resident": self.max_resident, "pending_writes": len(self.pending),
+                    "loads": self.loads, "creates": self.creates, "writes": self.writes, "evictions": self.evictions,
+                    "shared": self.shared, "reloads": self.reloads}
+
+# --- END OF FILE dossierstore.py ---
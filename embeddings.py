@@ -0,0 +1,152 @@
+# --- START OF FILE embeddings.py ---
+
+import os
+import time
+import queue
+import hashlib
+import itertools
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import backend
+
+class EmbeddingCache:
+    """
+    Content-hash keyed cache of embedding vectors.
+
+    Keys are sha256(model_id + text), so switching the embedding model naturally misses
+    every old entry. The in-memory tier is an LRU bounded to `max_entries`; the optional
+    disk tier (SQLite) survives restarts and refills the LRU on a hit. The disk tier holds
+    at most `max_disk_entries` rows: once over, the oldest-written tenth is deleted.
+    """
+    SCHEMA = "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+
+    def __init__(self, max_entries=4096, disk_path=None, max_disk_entries=100000):
+        self.max_entries, self.max_disk_entries = max_entries, max(1, max_disk_entries)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.disk_evictions = 0
+        self.conn, self.disk_rows = None, 0
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            self.conn = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(self.SCHEMA)
+            self.disk_rows = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._trim_disk()
+
+    @staticmethod
+    def key(model_id, text):
+        return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember_in_memory(self, key, vector):
+        self.entries[key] = vector; self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+    def _trim_disk(self):
+        # Caller holds self.lock (or is __init__). Rowids grow with every insert, so the lowest are the oldest.
+        if self.disk_rows <= self.max_disk_entries: return
+        self.disk_rows = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] # replaced keys were counted twice
+        excess = self.disk_rows - self.max_disk_entries * 9 // 10
+        if self.disk_rows <= self.max_disk_entries: return
+        self.conn.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY rowid LIMIT ?)", (excess,))
+        self.disk_rows -= excess; self.disk_evictions += excess
+
+    def get(self, model_id, text):
+        key = self.key(model_id, text)
+        with self.lock:
+            if (vector := self.entries.get(key)) is not None:
+                self.entries.move_to_end(key); self.hits += 1; return vector
+            if self.conn is not None:
+                row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember_in_memory(key, vector); self.disk_hits += 1; return vector
+            self.misses += 1
+            return None
+
+    def put(self, model_id, text, vector):
+        key = self.key(model_id, text)
+        vector = np.array(vector, dtype=np.float32); vector.setflags(write=False) # shared between callers
+        with self.lock:
+            self._remember_in_memory(key, vector)
+            if self.conn is not None:
+                self.conn.execute("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", (key, vector.tobytes()))
+                self.disk_rows += 1; self._trim_disk()
+        return vector
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "entries": len(self.entries),
+                    "disk_entries": self.disk_rows, "disk_evictions": self.disk_evictions,
+                    "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0}
+
+class EmbeddingBatcher:
+    """
+    Embedding client that talks straight to the llama.cpp /v1/embeddings endpoint and
+    coalesces concurrent requests (recall, gatekeeper, enrollment, identification) into
+    batched `input` lists.
+
+    A collector thread takes the first waiting text, then keeps gathering until it has
+    `max_batch` texts or `max_wait_ms` has passed, and hands the batch to a small pool of
+    senders. Identical texts inside one batch are only sent once. Each text keeps the
+    backend priority of the thread that submitted it: urgent texts are collected first and
+    a batch is sent at the priority of its most urgent text.
+    """
+    def __init__(self, url, max_batch=32, max_wait_ms=5, max_in_flight=4):
+        self.url = url
+        self.max_batch, self.max_wait = max(1, max_batch), max(0, max_wait_ms) / 1000.0
+        self.pending = queue.PriorityQueue() # (priority, ticket, text, future)
+        self.tickets = itertools.count()
+        self.senders = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="embed-send")
+        # Background batches get their own senders, so they never hold the ones urgent batches need.
+        self.background_senders = ThreadPoolExecutor(max_workers=max(1, max_in_flight // 2), thread_name_prefix="embed-send-bg")
+        self.batches_sent = self.texts_sent = 0
+        self._collector = threading.Thread(target=self._collect_loop, name="embed-collect", daemon=True)
+        self._collector.start()
+
+    def submit(self, texts):
+        """Queues texts without waiting; returns one Future per text."""
+        futures, level = [], backend.current_priority("embedding")
+        for text in texts:
+            future = Future(); self.pending.put((level, next(self.tickets), text, future)); futures.append(future)
+        return futures
+
+    def embed_many(self, texts):
+        """Returns one float32 vector per text, in order. Raises if the backend call failed."""
+        return [f.result() for f in self.submit(texts)]
+
+    def embed(self, text): return self.embed_many([text])[0]
+
+    def _collect_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try: batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+                except queue.Empty: break
+            background = min(level for level, _, _, _ in batch) >= backend.BACKGROUND
+            (self.background_senders if background else self.senders).submit(self._send, batch)
+
+    def _send(self, batch):
+        unique_texts = list(dict.fromkeys(text for _, _, text, _ in batch))
+        try:
+            with backend.priority(min(level for level, _, _, _ in batch)):
+                resp = backend.post("embedding", self.url, json={"input": unique_texts}); resp.raise_for_status()
+            data = sorted(resp.json()['data'], key=lambda d: d.get('index', 0))
+            vectors = {text: np.array(d['embedding'], dtype=np.float32) for text, d in zip(unique_texts, data)}
+            self.batches_sent += 1; self.texts_sent += len(unique_texts)
+            for _, _, text, future in batch: future.set_result(vectors[text])
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done(): future.set_exception(e)
+
+    def stats(self):
+        return {"batches_sent": self.batches_sent, "texts_sent": self.texts_sent, "queued": self.pending.qsize(),
+                "avg_batch_size": round(self.texts_sent / self.batches_sent, 2) if self.batches_sent else 0.0}
+
+# --- END OF FILE embeddings.py ---
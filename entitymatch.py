@@ -0,0 +1,77 @@
+# --- START OF FILE entitymatch.py ---
+
+import threading
+from collections import deque
+
+# Sanitized tokens that mean the speaker is talking about themself ("I'm" -> "im", "I've" -> "ive").
+SELF_TERMS = ("i", "me", "my", "mine", "myself", "im", "ive")
+
+class AhoCorasick:
+    """Multi-pattern matcher: finds every occurrence of any pattern in one pass over the text."""
+    def __init__(self, patterns):
+        """`patterns` maps pattern string -> value reported when it matches."""
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+        for pattern, value in patterns.items():
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto); self.goto[node][ch] = nxt
+                    self.goto.append({}); self.fail.append(0); self.out.append([])
+                node = nxt
+            self.out[node].append(value)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]: f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def findall(self, text):
+        node = 0
+        for ch in text:
+            while node and ch not in self.goto[node]: node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            yield from self.out[node]
+
+class EntityGazetteer:
+    """
+    Every known entity_id/speaker_id plus the self-reference terms, matched on whole
+    underscore-separated tokens of a sanitized query (see nodes._sanitize_for_filename).
+
+    New ids are recorded as memories arrive; the automaton is rebuilt lazily on the next
+    lookup and swapped in whole, so lookups never see a half-built one.
+    """
+    def __init__(self, entity_ids=(), self_terms=SELF_TERMS):
+        self.self_terms = tuple(self_terms)
+        self.entities = set()
+        self.lock = threading.Lock()
+        self._automaton = None
+        self.add(*entity_ids)
+
+    def add(self, *entity_ids):
+        with self.lock:
+            new = {e for e in entity_ids if e and len(e) > 1 and e != "self"} - self.entities
+            if new: self.entities |= new; self._automaton = None
+
+    def __len__(self): return len(self.entities)
+
+    def _current(self):
+        automaton = self._automaton
+        if automaton is None:
+            with self.lock:
+                patterns = {f"_{term}_": "self" for term in self.self_terms}
+                patterns.update({f"_{entity}_": entity for entity in self.entities})
+                automaton = self._automaton = AhoCorasick(patterns)
+        return automaton
+
+    def match(self, sanitized_text):
+        """Returns (known entity ids in order of appearance, whether the text refers to the speaker)."""
+        found = dict.fromkeys(self._current().findall(f"_{sanitized_text}_"))
+        refers_to_self = "self" in found; found.pop("self", None)
+        return list(found), refers_to_self
+
+# --- END OF FILE entitymatch.py ---
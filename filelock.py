@@ -0,0 +1,52 @@
+# --- START OF FILE filelock.py ---
+
+import os
+import threading
+
+try:
+    import fcntl
+    def _lock(fh): fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+    def _unlock(fh): fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+except ImportError: # Windows
+    import msvcrt
+    def _lock(fh):
+        fh.seek(0)
+        while True:
+            try: msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1); return
+            except OSError: pass # LK_LOCK gives up after ~10 s; keep waiting
+    def _unlock(fh): fh.seek(0); msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+class InterProcessLock:
+    """
+    Exclusive lock shared by every process that opens the same lock file, and by the
+    threads of this process. Re-entrant within a thread, so a locked method can call
+    another locked method. A forked child reopens the lock file, because an inherited
+    descriptor would share the parent's lock instead of competing for it.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._pid = os.getpid()
+        self._thread_lock = threading.RLock()
+        self._fh, self._depth = None, 0
+
+    def __enter__(self):
+        if self._pid != os.getpid():
+            self._pid, self._thread_lock, self._fh, self._depth = os.getpid(), threading.RLock(), None, 0
+        self._thread_lock.acquire()
+        try:
+            if self._depth == 0:
+                if self._fh is None: self._fh = open(self.path, "a+b")
+                _lock(self._fh)
+            self._depth += 1
+        except BaseException:
+            self._thread_lock.release(); raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._depth -= 1
+            if self._depth == 0: _unlock(self._fh)
+        finally: self._thread_lock.release()
+
+# --- END OF FILE filelock.py ---
@@ -0,0 +1,94 @@
+# --- START OF FILE ingestion.py ---
+
+import time
+import threading
+import traceback
+from collections import deque, namedtuple
+from contextlib import nullcontext
+import metrics
+
+_Job = namedtuple("_Job", ["fn", "args", "key", "enqueued_at"])
+
+class IngestionQueue:
+    """
+    Bounded queue of background memory work (enrich -> route -> remember, enrollment),
+    drained by a fixed number of worker threads.
+
+    When the queue is full the `policy` decides what gives:
+      drop_oldest  - discard the longest-waiting job to make room (default)
+      drop_newest  - refuse the new job
+      coalesce     - skip a job whose key is already queued; otherwise behave like drop_oldest
+
+    `job_context`, if given, is called for every job and the job runs inside the context
+    manager it returns (the agent uses it to run jobs at background backend priority).
+    """
+    POLICIES = ("drop_oldest", "drop_newest", "coalesce")
+
+    def __init__(self, workers=2, max_depth=256, policy="drop_oldest", job_context=None):
+        if policy not in self.POLICIES: raise ValueError(f"Unknown ingestion policy '{policy}'. Use one of {self.POLICIES}.")
+        self.max_depth, self.policy = max(1, max_depth), policy
+        self.job_context = job_context or nullcontext
+        self.jobs = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.in_flight = 0
+        self.submitted = self.processed = self.failed = self.dropped = self.coalesced = 0
+        self.last_lag = 0.0
+        self.workers = [threading.Thread(target=self._worker_loop, name=f"ingest-{i}", daemon=True) for i in range(max(1, workers))]
+        for worker in self.workers: worker.start()
+
+    def submit(self, fn, *args, key=None):
+        """Queues fn(*args). Returns False if the job was refused or the queue is shut down."""
+        with self.cond:
+            if self.closed: return False
+            if self.policy == "coalesce" and key is not None and any(job.key == key for job in self.jobs):
+                self.coalesced += 1; return True
+            if len(self.jobs) >= self.max_depth:
+                self.dropped += 1
+                if self.policy == "drop_newest":
+                    print(f"[INGEST] Queue full ({self.max_depth}); dropped new job."); return False
+                self.jobs.popleft()
+                print(f"[INGEST] Queue full ({self.max_depth}); dropped oldest job.")
+            self.jobs.append(_Job(fn, args, key, time.monotonic())); self.submitted += 1
+            self.cond.notify()
+            return True
+
+    def _worker_loop(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.closed: self.cond.wait()
+                if not self.jobs: return # closed and drained
+                job = self.jobs.popleft(); self.in_flight += 1
+                self.last_lag = time.monotonic() - job.enqueued_at
+            name = getattr(job.fn, "__name__", "job").lstrip("_")
+            metrics.BACKGROUND_WAIT_SECONDS.observe(self.last_lag, job=name)
+            try:
+                with metrics.BACKGROUND_SECONDS.time(job=name), self.job_context(): job.fn(*job.args)
+                ok = True
+            except Exception:
+                traceback.print_exc(); ok = False
+            with self.cond:
+                self.in_flight -= 1
+                if ok: self.processed += 1
+                else: self.failed += 1
+                self.cond.notify_all()
+
+    def shutdown(self, drain=True, timeout=None):
+        """Stops accepting jobs; with drain=True the workers finish everything already queued."""
+        with self.cond:
+            self.closed = True
+            if not drain: self.dropped += len(self.jobs); self.jobs.clear()
+            self.cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self.cond:
+            oldest_wait = time.monotonic() - self.jobs[0].enqueued_at if self.jobs else 0.0
+            return {"queued": len(self.jobs), "in_flight": self.in_flight, "max_depth": self.max_depth, "policy": self.policy,
+                    "submitted": self.submitted, "processed": self.processed, "failed": self.failed,
+                    "dropped": self.dropped, "coalesced": self.coalesced,
+                    "oldest_wait_seconds": round(oldest_wait, 3), "last_lag_seconds": round(self.last_lag, 3)}
+
+# --- END OF FILE ingestion.py ---
@@ -0,0 +1,122 @@
+# --- START OF FILE memorylog.py ---
+
+import os
+import csv
+import sqlite3
+import threading
+from collections import namedtuple, defaultdict
+
+# One row of the master memory log. 'speaker_id' is who said it, 'entity_id' is who/what it is about.
+MemoryRecord = namedtuple("MemoryRecord", ["uuid", "timestamp", "speaker_id", "entity_id", "text"])
+
+class MemoryLog:
+    """
+    Append-only master memory log backed by SQLite in WAL mode.
+
+    Every append is a single-row INSERT committed on its own, so writes cost the same
+    no matter how many memories exist and a crash can never leave a half-rewritten log.
+    Startup streams rows through a cursor instead of parsing the whole file at once.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS memories (
+            row INTEGER PRIMARY KEY,
+            uuid TEXT NOT NULL UNIQUE,
+            timestamp TEXT NOT NULL,
+            speaker_id TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            text TEXT NOT NULL
+        )"""
+    INSERT = "INSERT INTO memories (uuid, timestamp, speaker_id, entity_id, text) VALUES (?, ?, ?, ?, ?)"
+    SELECT = "SELECT uuid, timestamp, speaker_id, entity_id, text FROM memories ORDER BY row"
+    SELECT_AFTER = "SELECT row, uuid, timestamp, speaker_id, entity_id, text FROM memories WHERE row > ? ORDER BY row"
+
+    def __init__(self, db_path, legacy_csv_path=None):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Autocommit mode: each INSERT is its own transaction. WAL keeps readers and the writer apart.
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(self.SCHEMA)
+        self._count = self.conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+        if legacy_csv_path and self._count == 0 and os.path.exists(legacy_csv_path):
+            self._migrate_legacy_csv(legacy_csv_path)
+
+    def _migrate_legacy_csv(self, csv_path):
+        """One-time import of the old master_memory_log.csv, streamed row by row."""
+        with open(csv_path, "r", encoding="utf-8", newline="") as f:
+            rows = (MemoryRecord(*(r.get(col) or "" for col in MemoryRecord._fields)) for r in csv.DictReader(f))
+            migrated = self.append_many(rows)
+        print(f"MEMORY_LOG: Migrated {migrated} entries from '{os.path.basename(csv_path)}'. The CSV is no longer written and can be deleted.")
+
+    def append(self, record):
+        with self.lock:
+            self.conn.execute(self.INSERT, tuple(record)); self._count += 1
+
+    def append_many(self, records):
+        """Inserts many records in one transaction. Returns how many were written."""
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(self.INSERT, (tuple(r) for r in records))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK"); raise
+            written = self.conn.total_changes - before
+            self._count += written
+            return written
+
+    def __iter__(self):
+        # A separate read-only connection lets the stream run without holding the writer lock.
+        reader = sqlite3.connect(self.db_path)
+        try:
+            for row in reader.execute(self.SELECT): yield MemoryRecord(*row)
+        finally: reader.close()
+
+    def iter_rows(self, after=0):
+        """Yields (row, MemoryRecord) for rows past `after`, including ones other processes appended."""
+        reader = sqlite3.connect(self.db_path)
+        try:
+            for row in reader.execute(self.SELECT_AFTER, (after,)): yield row[0], MemoryRecord(*row[1:])
+        finally: reader.close()
+
+    def __len__(self): return self._count
+
+    def close(self):
+        with self.lock: self.conn.close()
+
+class MemoryIndex:
+    """
+    Inverted indexes over master log rows, kept current by MemorySystem.remember.
+
+    Candidate selection for recall walks only the rows filed under the asking user,
+    so its cost follows that user's memory count rather than the size of the whole log.
+    """
+    def __init__(self):
+        self.by_speaker = defaultdict(list)
+        self.by_entity = defaultdict(list)
+        self.by_pair = defaultdict(list)
+        self.text_by_uuid = {}
+
+    def add(self, row, record):
+        self.by_speaker[record.speaker_id].append(row)
+        self.by_entity[record.entity_id].append(row)
+        self.by_pair[(record.speaker_id, record.entity_id)].append(row)
+        self.text_by_uuid[record.uuid] = record.text
+
+    def rows_for_self(self, user_id):
+        """Rows the user spoke OR that are about the user, in log order."""
+        spoken, about = self.by_speaker.get(user_id, ()), self.by_entity.get(user_id, ())
+        if not about: return list(spoken)
+        if not spoken: return list(about)
+        return sorted(set(spoken).union(about))
+
+    def rows_for_entities(self, speaker_id, entity_ids):
+        """Rows spoken by `speaker_id` about any of `entity_ids`."""
+        rows = []
+        for entity_id in dict.fromkeys(entity_ids): rows.extend(self.by_pair.get((speaker_id, entity_id), ()))
+        return rows
+
+# --- END OF FILE memorylog.py ---
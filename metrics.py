@@ -0,0 +1,88 @@
+# --- START OF FILE metrics.py ---
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _escape(value): return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(pairs):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Cumulative-bucket latency histogram, one series per label combination."""
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help_text, tuple(label_names), tuple(sorted(buckets))
+        self.series = {} # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            counts = self.series.get(key)
+            if counts is None: counts = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1; counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the block; labels can still be changed inside it (e.g. the outcome)."""
+        start = time.perf_counter()
+        try: yield labels
+        finally: self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock: series = {key: list(counts) for key, counts in self.series.items()}
+        for key, counts in sorted(series.items()):
+            pairs, cumulative = list(zip(self.label_names, key)), 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(pairs + [('le', '+Inf' if bound == float('inf') else repr(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(pairs)} {counts[-1]!r}")
+            lines.append(f"{self.name}_count{_labels(pairs)} {cumulative}")
+        return lines
+
+class Gauge:
+    """Read at scrape time from `fn`, which returns a number or a list of ({label: value}, number) pairs."""
+    def __init__(self, name, help_text, fn):
+        self.name, self.help, self.fn = name, help_text, fn
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try: value = self.fn()
+        except Exception: return [] # a subsystem that is not up yet just has no sample
+        for labels, number in (value if isinstance(value, list) else [({}, value)]):
+            lines.append(f"{self.name}{_labels(sorted(labels.items()))} {float(number)!r}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics, self.lock = {}, threading.Lock()
+
+    def _register(self, metric):
+        with self.lock: return self.metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, fn):
+        """Registers (or replaces) a gauge callback."""
+        with self.lock: self.metrics[name] = Gauge(name, help_text, fn); return self.metrics[name]
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4)."""
+        with self.lock: metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+REGISTRY = Registry()
+NODE_SECONDS = REGISTRY.histogram("stateagent_node_seconds", "Time spent in Node.process, by node.", ("node",))
+TURN_SECONDS = REGISTRY.histogram("stateagent_turn_seconds", "Wall time of a whole chat turn, by response mode.", ("mode",))
+BACKEND_SECONDS = REGISTRY.histogram("stateagent_backend_request_seconds", "llama.cpp HTTP calls (streams until closed), by call type and outcome.", ("call_type", "outcome"))
+BACKGROUND_SECONDS = REGISTRY.histogram("stateagent_background_job_seconds", "Background ingestion/enrollment jobs, by job.", ("job",))
+BACKEND_QUEUE_SECONDS = REGISTRY.histogram("stateagent_backend_queue_seconds", "Time llama.cpp calls waited for a scheduler slot, by priority class.", ("priority",))
+BACKGROUND_WAIT_SECONDS = REGISTRY.histogram("stateagent_background_wait_seconds", "Time background jobs spent queued, by job.", ("job",))
+
+# --- END OF FILE metrics.py ---
@@ -1,5 +1,5 @@
-import threading, prompt, serverconfig, requests, tiktoken, traceback
-import re
+import prompt, serverconfig, backend, tokencount, contextpack, traceback
+import re, json
 # ### DELETED ###
 # The faulty import statement has been removed from here.
 
@@ -44,7 +44,7 @@ def _handle_user_command(context, args):
     if not user_id_raw: return {"final_response": "ACK_ERROR: '//user' command requires a name.", "continue_pipeline": False}
     user_id = _sanitize_for_filename(user_id_raw)
     if not user_id: return {"final_response": f"ACK_ERROR: Invalid user name provided: '{user_id_raw}'.", "continue_pipeline": False}
-    context['agent'].switch_active_dossier(user_id)
+    context['agent'].switch_active_dossier(user_id, context['session_id'])
     return {"final_response": f"ACK: Active user switched to '{user_id}'.", "continue_pipeline": False}
 
 def _handle_persona_command(context, args):
@@ -82,12 +82,13 @@ def _handle_mem_command(context, args):
 
     print("[CMD_BUS] //mem triggering smart memory routing.")
     ### MODIFIED: Use the correct class name directly ###
-    gatekeeper_node = MemoryGatekeeperNode() # We use the class directly since it's in this file
+    gatekeeper_node = MemoryGatekeeperNode(context['agent']) # We use the class directly since it's in this file
     mem_context = context.copy()
     mem_context['text_prompt'] = text_to_remember # Provide the text from the command
     
-    # Run the smart memory saving process in a background thread
-    threading.Thread(target=gatekeeper_node._enrich_and_route, args=(mem_context,)).start()
+    # Run the smart memory saving process on the background ingestion pool
+    if not context['agent'].ingestion.submit(gatekeeper_node._enrich_and_route, mem_context, key=(context['user_dossier'].user_id, text_to_remember)):
+        return {"final_response": "ACK_ERROR: Memory ingestion is saturated; please try again shortly.", "continue_pipeline": False}
     return {"final_response": "ACK: Manual memory storage initiated (using intelligent routing).", "continue_pipeline": False}
 
 def _handle_recall_command(context, args):
@@ -112,18 +113,26 @@ def _handle_enroll_command(context, args):
     if user_id_to_enroll != user_dossier.user_id: return {"final_response": f"ACK_ERROR: You must be switched to the user to enroll them. Use `//user {user_id_raw}` first.", "continue_pipeline": False}
     memory_system = context['memory_system']; conversation_history = user_dossier.get_history()
     if len(conversation_history) < 2: return {"final_response": "ACK_WARN: Please chat once more before enrolling so I have a good sample.", "continue_pipeline": False}
-    threading.Thread(target=memory_system.enroll_user, args=(user_id_to_enroll, conversation_history)).start()
+    if not context['agent'].ingestion.submit(memory_system.enroll_user, user_id_to_enroll, conversation_history, key=("enroll", user_id_to_enroll)):
+        return {"final_response": "ACK_ERROR: Memory ingestion is saturated; please try again shortly.", "continue_pipeline": False}
     return {"final_response": f"ACK: Enrollment process initiated for user '{user_id_to_enroll}'.", "continue_pipeline": False}
 
 # --- NODE DEFINITIONS ---
-ENCODER = tiktoken.get_encoding("cl100k_base")
 class Node:
+    # Context keys the node reads / writes. The PipelineExecutor derives the run order from these;
+    # a node that leaves them as None is simply run after everything before it.
+    requires = None
+    provides = None
     def __init__(self, a=None): self.agent = a
     def process(self, c): raise NotImplementedError
 
 class InputParserNode(Node):
+    requires = frozenset({'request_data', 'user_dossier'})
+    provides = frozenset({'text_prompt', 'raw_content', 'session_user_id', 'final_response', 'continue_pipeline'})
     def process(self, context):
         if context.get('continue_pipeline') == False: return context
+        # Snapshot of the speaker before AuthenticationNode may rebind 'user_dossier' in the next wave.
+        context['session_user_id'] = context['user_dossier'].user_id
         request_data = context.get('request_data', {}); raw_content = request_data.get('messages', [{}])[-1].get('content', '')
         text_prompt = ""
         if isinstance(raw_content, str): text_prompt = raw_content
@@ -138,7 +147,7 @@ class InputParserNode(Node):
                 user_id_raw = match.group("name")
                 if user_id := _sanitize_for_filename(user_id_raw):
                     print(f"[NODE_NLP] Detected user introduction: '{user_id_raw}'. Switching dossier.")
-                    self.agent.switch_active_dossier(user_id)
+                    self.agent.switch_active_dossier(user_id, context['session_id'])
                     context['final_response'] = f"ACK: Hello {user_id_raw}! I've loaded your dossier."
                     context['continue_pipeline'] = False
                     return context
@@ -148,14 +157,16 @@ class InputParserNode(Node):
         return context
 
 class AuthenticationNode(Node):
+    requires = frozenset({'text_prompt', 'user_dossier'})
+    provides = frozenset({'user_dossier', 'final_response', 'continue_pipeline'})
     def process(self, context):
         if context.get('continue_pipeline') == False: return context
         user_dossier = context['user_dossier']; text_prompt = context.get('text_prompt', "")
         if user_dossier.user_id == serverconfig.INITIAL_USER_ID and not text_prompt.lstrip().startswith("//"):
             memory_system = context['memory_system']
             if identified_user := memory_system.identify_user(text_prompt):
-                self.agent.switch_active_dossier(identified_user)
-                context['user_dossier'] = self.agent.dossiers[identified_user]
+                context['user_dossier'] = self.agent.switch_active_dossier(identified_user, context['session_id'])
+                self.agent.claim_dossier(context, context['user_dossier'])
             else:
                 history = user_dossier.get_history()
                 if history and "who I'm speaking with" in history[-1].get('content', ''):
@@ -164,66 +175,144 @@ class AuthenticationNode(Node):
                 context['continue_pipeline'] = False
         return context
 
+class QueryAnalysisNode(Node):
+    """Works out the user-independent half of recall (query entities + query embedding) while
+    AuthenticationNode is still deciding who is speaking."""
+    requires = frozenset({'text_prompt', 'session_user_id'})
+    provides = frozenset({'query_entities', 'query_speaker_id', 'query_vector', 'statement_analysis'})
+    def process(self, context):
+        if context.get('continue_pipeline') == False: return context
+        text_prompt = context.get('text_prompt', ""); memory_system = context.get('memory_system')
+        if text_prompt.lstrip().startswith("//") or not memory_system or not memory_system.vectors: return context
+        # 'user_dossier' belongs to AuthenticationNode in this wave; the speaker comes from InputParserNode's snapshot.
+        speaker_id = context['session_user_id']
+        # With no enrolled signatures, the initial user can never be identified and AuthenticationNode ends the turn.
+        if speaker_id == serverconfig.INITIAL_USER_ID and not memory_system.signatures: return context
+        try:
+            # The speaker may still change if AuthenticationNode identifies someone; the gatekeeper
+            # only reuses 'statement_analysis' when its speaker matches the final dossier.
+            context['query_entities'], context['query_vector'], context['statement_analysis'] = memory_system.analyze_query(
+                text_prompt, speaker_id=speaker_id, chat_model_id=context.get('model_id'))
+            # The entity shortcut depends on who is asking; MemoryRecallNode only reuses it for the same speaker.
+            context['query_speaker_id'] = speaker_id
+        except Exception as e: print(f"[QUERY_ANALYSIS] Falling back to in-line recall analysis: {e}")
+        return context
+
 class MemoryRecallNode(Node):
+    requires = frozenset({'text_prompt', 'user_dossier', 'query_entities', 'query_speaker_id', 'query_vector'})
+    provides = frozenset({'recalled_memories'})
     def process(self, context):
         if context.get('continue_pipeline') == False: return context
         text_prompt = context.get('text_prompt', ""); recalled_memories = []
         if not text_prompt.lstrip().startswith("//") and (memory_system := context.get('memory_system')):
-             recalled_memories = memory_system.intelligent_recall(context['user_dossier'].user_id, text_prompt)
+             user_id = context['user_dossier'].user_id
+             # Entities worked out for another speaker (before AuthenticationNode switched users) are recomputed.
+             entities = context.get('query_entities') if context.get('query_speaker_id') == user_id else None
+             recalled_memories = memory_system.intelligent_recall(user_id, text_prompt, entities=entities, query_vec=context.get('query_vector'))
         context['recalled_memories'] = recalled_memories
         return context
 
 class PromptFormatterNode(Node):
+    requires = frozenset({'user_dossier', 'recalled_memories', 'raw_content', 'model_id'})
+    provides = frozenset({'llm_messages_payload', 'llm_messages_token_counts', 'context_budget', 'final_response', 'continue_pipeline'})
     def process(self, context):
         if context.get('continue_pipeline') == False: return context
         dossier = context.get('user_dossier')
         if not dossier: context['final_response'] = "Error: No dossier in context."; context['continue_pipeline'] = False; return context
-        p_card = prompt.PERSONA_CARDS.get(dossier.persona_id, {}); a_card = prompt.ABILITY_CARDS.get(dossier.ability_id, {})
-        e_card = prompt.ENGINE_CARDS.get(dossier.engine_id, {}); persona_text = p_card.get('persona', 'You are a helpful AI.')
-        abilities_text = a_card.get('abilities', 'You have no special abilities.'); engine_text = e_card.get('engine', 'You should respond directly.')
-        system_prompt = f"{persona_text}\n\n--- ABILITIES ---\n{abilities_text}\n\n--- STYLE ---\n{engine_text}"
-        messages = [{"role": "system", "content": system_prompt}]
-        if recalled := context.get('recalled_memories', []): messages.append({"role": "system", "content": f"CONTEXT FROM MEMORY:\n- {'\n- '.join(recalled)}"})
-        messages.extend(dossier.get_history()); messages.append({"role": "user", "content": context.get('raw_content', '')})
-        context['llm_messages_payload'] = messages
+        # Compiled once per card combination (with its token count) and rebuilt only when one of its cards changes.
+        system_prompt, system_count = prompt.compiled_system_prompt(dossier.persona_id, dossier.ability_id, dossier.engine_id)
+        e_card = prompt.ENGINE_CARDS.get(dossier.engine_id, {})
+        # Known token counts per message travel with the payload (None = count it in ContextMonitorNode):
+        # the system prompt and the history were counted on earlier turns; only new text is tokenized.
+        user_message = {"role": "user", "content": context.get('raw_content', '')}; user_count = tokencount.count_message(user_message)
+        history, history_counts = dossier.get_history(), dossier.get_history_token_counts()
+        if len(history_counts) != len(history): history_counts = [tokencount.count_message(m) for m in history]
+
+        # Fit the turn into the engine's token budget: fold old turns into the summary, then drop the weakest memories.
+        # Extending the summary is background work; this turn uses the summary it already has.
+        budget = contextpack.budget_for(e_card)
+        packed = contextpack.packer.pack(dossier, budget, system_count + user_count, context.get('recalled_memories', []),
+                                         history, history_counts, context.get('model_id'), submit=self.agent.ingestion.submit)
+
+        messages, token_counts = [{"role": "system", "content": system_prompt}], [system_count]
+        memory_message, memory_count = None, None
+        if packed.recalled:
+            memory_message = {"role": "system", "content": "CONTEXT FROM MEMORY:\n- " + "\n- ".join(packed.recalled)}
+            memory_count = tokencount.MESSAGE_OVERHEAD + contextpack.SECTION_OVERHEAD + sum(map(contextpack.packer.memory_tokens, packed.recalled))
+        # Prefix-stable layout keeps everything that changes per turn (memories, token stats) right
+        # before the new message, so the system prompt and history form a reusable KV-cache prefix.
+        if memory_message and not serverconfig.PREFIX_STABLE_PROMPTS: messages.append(memory_message); token_counts.append(memory_count)
+        if packed.summary:
+            summary_message = {"role": "system", "content": "SUMMARY OF EARLIER CONVERSATION:\n" + packed.summary}
+            messages.append(summary_message); token_counts.append(tokencount.count_message(summary_message))
+        messages.extend(history[packed.history_start:]); token_counts.extend(history_counts[packed.history_start:])
+        if memory_message and serverconfig.PREFIX_STABLE_PROMPTS: messages.append(memory_message); token_counts.append(memory_count)
+        messages.append(user_message); token_counts.append(user_count)
+        context['llm_messages_payload'] = messages; context['llm_messages_token_counts'] = token_counts; context['context_budget'] = budget
         return context
 
 class ContextMonitorNode(Node):
+    requires = frozenset({'llm_messages_payload', 'llm_messages_token_counts', 'context_budget'})
+    provides = frozenset({'llm_messages_payload', 'llm_messages_token_counts'})
     CONTEXT_SIZE_LIMIT = 128 * 1024
-    def _count_tokens(self, messages):
-        count = 0;
-        for message in messages:
-            count += 4; content = message.get("content")
-            if isinstance(content, str): count += len(ENCODER.encode(content))
-            elif isinstance(content, list):
-                for part in content:
-                    if part.get("type") == "text": count += len(ENCODER.encode(part.get("text", "")))
-                    elif part.get("type") == "image_url": count += 85
-        return count
+    def _count_tokens(self, messages, known_counts=None):
+        """Sums per-message tokens, only tokenizing messages without a count in `known_counts`."""
+        if not known_counts or len(known_counts) != len(messages): known_counts = [None] * len(messages)
+        return sum(tokencount.count_message(m) if known is None else known for m, known in zip(messages, known_counts))
     def process(self, context):
         if context.get('continue_pipeline') == False: return context
         if not (messages := context.get('llm_messages_payload')): return context
         
-        token_count = self._count_tokens(messages)
+        token_count = self._count_tokens(messages, context.get('llm_messages_token_counts'))
         ### MODIFIED: Fixed the typo from 'token_token_count' to 'token_count' ###
-        usage_percent = (token_count / self.CONTEXT_SIZE_LIMIT) * 100
+        usage_percent = (token_count / (context.get('context_budget') or self.CONTEXT_SIZE_LIMIT)) * 100
         
-        messages.insert(1, {"role": "system", "content": f"CONTEXT: {token_count:,} tokens ({usage_percent:.1f}% full)."}); context['llm_messages_payload'] = messages
+        # Right after the system prompt, unless the prompt prefix must stay stable: then just before the new message.
+        position = len(messages) - 1 if serverconfig.PREFIX_STABLE_PROMPTS else 1
+        messages.insert(position, {"role": "system", "content": f"CONTEXT: {token_count:,} tokens ({usage_percent:.1f}% full)."}); context['llm_messages_payload'] = messages
+        if (counts := context.get('llm_messages_token_counts')) and len(counts) == len(messages) - 1: counts.insert(position, None)
         return context
 
 class LLMCallNode(Node):
+    requires = frozenset({'llm_messages_payload', 'model_id', 'stream', 'user_dossier'})
+    provides = frozenset({'llm_response_text', 'final_response', 'response_stream', 'continue_pipeline'})
+    def _stream_deltas(self, payload, affinity):
+        """Consumes llama.cpp's SSE stream and yields the text deltas as they arrive."""
+        started = False
+        with backend.stream("chat", serverconfig.CHAT_COMPLETIONS_PATH, affinity=affinity, json=dict(payload, stream=True)) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"): continue
+                data = line[5:].strip()
+                if data == "[DONE]": break
+                chunk = json.loads(data); backend.slots.record(chunk) # the final chunk carries the timings
+                choices = chunk.get('choices') or [{}]
+                delta = (choices[0].get('delta') or {}).get('content')
+                if not started and delta: delta = delta.lstrip() # match the non-streamed .strip()
+                if delta: started = True; yield delta
+
     def process(self, context):
         if context.get('continue_pipeline') == False: return context
         payload = {"model": context['model_id'], "messages": context.get('llm_messages_payload', [])}
         if not payload["messages"]: context['final_response'] = "Error: Prompt empty."; context['continue_pipeline'] = False; return context
+        if serverconfig.PREFIX_STABLE_PROMPTS: payload["cache_prompt"] = True
+        # The conversation keeps its chat server (and slot on it, added by the backend client) so the cached prompt prefix is reused.
+        user_id = context['user_dossier'].user_id
+        if context.get('stream'):
+            # The agent forwards these deltas to the client and runs the remaining nodes on the assembled text.
+            context['response_stream'] = self._stream_deltas(payload, user_id)
+            return context
         try:
-            resp = requests.post(serverconfig.LLAMA_CPP_CHAT_URL, json=payload, timeout=180); resp.raise_for_status()
-            content = resp.json()['choices'][0]['message']['content'].strip()
+            resp = backend.post("chat", serverconfig.CHAT_COMPLETIONS_PATH, affinity=user_id, json=payload); resp.raise_for_status()
+            reply = resp.json(); backend.slots.record(reply)
+            content = reply['choices'][0]['message']['content'].strip()
             context['llm_response_text'] = content; context['final_response'] = content
         except Exception as e: context.update({'final_response': f"Error: Could not contact model.", 'continue_pipeline': False})
         return context
 
 class WorkingMemoryUpdateNode(Node):
+    requires = frozenset({'user_dossier', 'raw_content', 'final_response'})
+    provides = frozenset()
     def process(self, context):
         dossier = context['user_dossier']; raw_user_content = context.get('raw_content')
         llm_response = context.get('final_response', '')
@@ -232,17 +321,26 @@ class WorkingMemoryUpdateNode(Node):
         return context
 
 class MemoryGatekeeperNode(Node):
+    requires = frozenset({'text_prompt', 'llm_response_text', 'user_dossier', 'model_id', 'statement_analysis'})
+    provides = frozenset()
     def _is_memorable(self, context):
         text_prompt = context.get('text_prompt', ""); return not text_prompt.startswith("//") and len(text_prompt.split()) > 3
 
     def _enrich_and_route(self, context):
         try:
             original_text = context.get('text_prompt'); dossier = context['user_dossier']
-            speaker_id = dossier.user_id
+            speaker_id = dossier.user_id; memory_system = context['memory_system']
+
+            # Structured mode: one call (often already made during recall) yields the fact and its subject.
+            analysis = context.get('statement_analysis')
+            if not analysis or analysis['speaker_id'] != speaker_id or analysis['text'] != original_text:
+                analysis = memory_system.analyze_statement(speaker_id, original_text, context['model_id']) if serverconfig.STRUCTURED_ANALYSIS else None
+            if analysis:
+                memory_system.remember(speaker_id, analysis['primary_entity'], analysis['enriched_fact']); return
             
             enrich_prompt = f"Rewrite the statement from '{speaker_id}' into a concise, self-contained, objective fact, resolving pronouns.\nStatement: \"{original_text}\"\nFactual Memory:"
             payload = {"model": context['model_id'], "messages": [{"role": "user", "content": enrich_prompt}], "temperature": 0.2, "n_predict": 128}
-            resp = requests.post(serverconfig.LLAMA_CPP_CHAT_URL, json=payload, timeout=60); resp.raise_for_status()
+            resp = backend.post("utility", serverconfig.CHAT_COMPLETIONS_PATH, json=payload); resp.raise_for_status()
             enriched_text = resp.json()['choices'][0]['message']['content'].strip()
             
             route_prompt = f"""
@@ -256,7 +354,7 @@ Fact: "{enriched_text}"
 
 Subject:"""
             payload = {"model": context['model_id'], "messages": [{"role": "user", "content": route_prompt}], "temperature": 0.0, "n_predict": 32}
-            resp = requests.post(serverconfig.LLAMA_CPP_CHAT_URL, json=payload, timeout=60); resp.raise_for_status()
+            resp = backend.post("utility", serverconfig.CHAT_COMPLETIONS_PATH, json=payload); resp.raise_for_status()
             raw_entity_id = resp.json()['choices'][0]['message']['content'].strip()
             
             entity_id = _sanitize_for_filename(raw_entity_id) if raw_entity_id else speaker_id
@@ -268,6 +366,6 @@ Subject:"""
     def process(self, context):
         if context.get('llm_response_text') and context.get('continue_pipeline') != False:
             if self._is_memorable(context):
-                threading.Thread(target=self._enrich_and_route, args=(context.copy(),), daemon=True).start()
+                self.agent.ingestion.submit(self._enrich_and_route, context.copy(), key=(context['user_dossier'].user_id, context.get('text_prompt')))
         return context
 # --- end of nodes.py
\ No newline at end of file
@@ -0,0 +1,67 @@
+# --- START OF FILE pipeline.py ---
+
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# The control flag every node reads; ordering on it is the executor's job, not a data dependency.
+CONTROL_KEYS = frozenset({'continue_pipeline'})
+
+def _depends_on(later, earlier):
+    """True if `later` must wait for `earlier`: it reads what earlier writes, or they write the same key,
+    or it overwrites something earlier still reads. Nodes that declare nothing are ordered against everything."""
+    if later.requires is None or later.provides is None or earlier.requires is None or earlier.provides is None: return True
+    writes, reads = earlier.provides - CONTROL_KEYS, earlier.requires - CONTROL_KEYS
+    return bool((later.requires | later.provides) & writes or later.provides & reads)
+
+def run_node(node, context):
+    """Runs one node, recording its latency under its class name."""
+    with metrics.NODE_SECONDS.time(node=type(node).__name__): return node.process(context)
+
+class PipelineExecutor:
+    """
+    Runs the agent's nodes as a dependency graph instead of a strict sequence.
+
+    Each node declares the context keys it reads (`requires`) and writes (`provides`).
+    Nodes are grouped into waves; every node in a wave depends only on earlier waves, so
+    a wave's nodes run at the same time (the first inline, the rest on the pool). The
+    pipeline still stops between waves as soon as a node clears 'continue_pipeline'.
+    """
+    def __init__(self, nodes, max_workers=16):
+        self.nodes = list(nodes)
+        self.waves = self._plan(self.nodes)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+
+    @staticmethod
+    def _plan(nodes):
+        levels = []
+        for i, node in enumerate(nodes):
+            levels.append(1 + max((levels[j] for j in range(i) if _depends_on(node, nodes[j])), default=-1))
+        waves = [[] for _ in range(max(levels, default=-1) + 1)]
+        for node, level in zip(nodes, levels): waves[level].append(node)
+        return waves
+
+    def describe(self):
+        return " -> ".join("[" + ", ".join(type(n).__name__ for n in wave) + "]" for wave in self.waves)
+
+    def run(self, context, stop_after=None):
+        """
+        Runs the waves over `context`. If `stop_after(context)` becomes true after a wave,
+        returns early with the nodes that have not run yet, in order.
+        Returns (context, remaining_nodes).
+        """
+        for position, wave in enumerate(self.waves):
+            if not context.get('continue_pipeline', True): break
+            if len(wave) == 1:
+                context = run_node(wave[0], context)
+            else:
+                # Nodes in one wave touch disjoint keys, so they share the context dict.
+                futures = [self.pool.submit(run_node, node, context) for node in wave[1:]]
+                run_node(wave[0], context)
+                for future in futures: future.result()
+            if stop_after and stop_after(context):
+                return context, [node for later in self.waves[position + 1:] for node in later]
+        return context, []
+
+    def shutdown(self): self.pool.shutdown(wait=False)
+
+# --- END OF FILE pipeline.py ---
@@ -1,53 +1,111 @@
 # --- START OF FILE prompt.py ---
 import os
+import threading
 import yaml
 import serverconfig # <-- The missing import that caused the crash.
+import tokencount
 
+# Card type -> (subdirectory, file extension, required content key)
+CARD_TYPES = {
+    "personas": ("personas", ".persona.yaml", "persona"),
+    "abilities": ("abilities", ".ability.yaml", "abilities"),
+    "engines": ("engines", ".engine.yaml", "engine"),
+}
+CARD_EXTENSIONS = tuple(ext for _, ext, _ in CARD_TYPES.values())
+
+# Published registries. They are never mutated in place: a reload builds a new dict and swaps
+# the module attribute, so a request always sees a complete set of cards, never an empty one.
 PERSONA_CARDS, ABILITY_CARDS, ENGINE_CARDS = {}, {}, {}
+_ATTRS = {"personas": "PERSONA_CARDS", "abilities": "ABILITY_CARDS", "engines": "ENGINE_CARDS"}
+_reload_lock = threading.Lock()
+
+def _card_id(filename):
+    # Extract ID (e.g., "AA" from "AA_librarian.persona.yaml")
+    return os.path.splitext(os.path.splitext(filename)[0])[0].split('_', 1)[0].upper()
+
+def _parse_card(path, content_attr):
+    """Returns the card's data, or None (with a warning) if it is unreadable or incomplete."""
+    filename = os.path.basename(path)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = yaml.safe_load(f)
+        # Validate the card has the required keys
+        if data and "name" in data and content_attr in data:
+            print(f"  - Loaded [{os.path.basename(os.path.dirname(path))}] '{_card_id(filename)}': {data['name']}")
+            return data
+        print(f"[PROMPT_MGR_WARN] Skipping '{filename}': missing 'name' or '{content_attr}' key.")
+    except Exception as e:
+        print(f"ERROR loading card {filename}: {e}")
+    return None
 
-def _load_cards_from_dir(directory, card_dict, extension, content_attr):
-    """Generic function to load cards with a custom YAML extension."""
+def _load_cards_from_dir(directory, extension, content_attr):
+    """Generic function to load cards with a custom YAML extension. Returns a new {card_id: data} dict."""
+    cards = {}
     if not os.path.exists(directory):
         # This is expected on first run, we'll create the dirs in server.py
-        return
-    
-    dir_name = os.path.basename(directory)
-    for filename in os.listdir(directory):
-        if not filename.endswith(extension):
-            continue
-        
-        # Extract ID (e.g., "AA" from "AA_librarian.persona.yaml")
-        card_id = os.path.splitext(os.path.splitext(filename)[0])[0].split('_', 1)[0].upper()
-        
-        try:
-            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
-                data = yaml.safe_load(f)
-                
-                # Validate the card has the required keys
-                if data and "name" in data and content_attr in data:
-                    card_dict[card_id] = data
-                    print(f"  - Loaded [{dir_name}] '{card_id}': {data['name']}")
-                else:
-                    print(f"[PROMPT_MGR_WARN] Skipping '{filename}': missing 'name' or '{content_attr}' key.")
-
-        except Exception as e:
-            print(f"ERROR loading card {filename}: {e}")
+        return cards
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(extension) and (data := _parse_card(os.path.join(directory, filename), content_attr)):
+            cards[_card_id(filename)] = data
+    return cards
 
 def load_all_cards():
     """Loads all card types from their respective subdirectories."""
     print("[PROMPT_MGR] Reloading all prompt cards from YAML files...")
-    # Clear the dictionaries to ensure a fresh load on reload
-    PERSONA_CARDS.clear(); ABILITY_CARDS.clear(); ENGINE_CARDS.clear()
-    
     # Use the PROMPTS_DIR from our new serverconfig
     base_dir = serverconfig.PROMPTS_DIR
-    
-    _load_cards_from_dir(os.path.join(base_dir, "personas"), PERSONA_CARDS, ".persona.yaml", "persona")
-    _load_cards_from_dir(os.path.join(base_dir, "abilities"), ABILITY_CARDS, ".ability.yaml", "abilities")
-    _load_cards_from_dir(os.path.join(base_dir, "engines"), ENGINE_CARDS, ".engine.yaml", "engine")
-    
+    loaded = {kind: _load_cards_from_dir(os.path.join(base_dir, subdir), ext, attr) for kind, (subdir, ext, attr) in CARD_TYPES.items()}
+    with _reload_lock:
+        for kind, cards in loaded.items(): globals()[_ATTRS[kind]] = cards
+        _compiled.clear()
     print("[PROMPT_MGR] Card loading complete.")
 
+def reload_card_file(path):
+    """
+    Re-parses one changed, created or deleted card file and swaps in a new registry for
+    its card type. Compiled prompts using that card are dropped.
+    """
+    kind = next((k for k, (_, ext, _) in CARD_TYPES.items() if path.endswith(ext)), None)
+    if kind is None: return
+    _, extension, content_attr = CARD_TYPES[kind]
+    directory, card_id = os.path.dirname(path), _card_id(os.path.basename(path))
+    data = _parse_card(path, content_attr) if os.path.exists(path) else None
+    if data is None and os.path.isdir(directory):
+        # Deleted or broken: fall back to another file that carries the same id, if there is one.
+        for filename in sorted(os.listdir(directory)):
+            other = os.path.join(directory, filename)
+            if other != path and filename.endswith(extension) and _card_id(filename) == card_id:
+                if data := _parse_card(other, content_attr): break
+    with _reload_lock:
+        cards = dict(globals()[_ATTRS[kind]])
+        if data is None:
+            if cards.pop(card_id, None) is not None: print(f"[PROMPT_MGR] Removed [{kind}] '{card_id}'.")
+        else: cards[card_id] = data
+        globals()[_ATTRS[kind]] = cards
+        position = list(CARD_TYPES).index(kind)
+        for key in list(_compiled):
+            if key[position] == card_id: _compiled.pop(key, None)
+
+# --- Compiled system prompts ---
+# (persona_id, ability_id, engine_id) -> (source cards, prompt text, token count). The source card
+# objects are checked on every hit, so a prompt compiled from a card that has since been replaced
+# is never served even if it was cached while the reload was in flight.
+_compiled = {}
+
+def compiled_system_prompt(persona_id, ability_id, engine_id):
+    """Returns (system prompt text, token count) for a card combination, compiling it once."""
+    key = (persona_id, ability_id, engine_id)
+    cards = (PERSONA_CARDS.get(persona_id), ABILITY_CARDS.get(ability_id), ENGINE_CARDS.get(engine_id))
+    cached = _compiled.get(key)
+    if cached is not None and all(a is b for a, b in zip(cached[0], cards)): return cached[1], cached[2]
+    p_card, a_card, e_card = (card or {} for card in cards)
+    persona_text = p_card.get('persona', 'You are a helpful AI.')
+    abilities_text = a_card.get('abilities', 'You have no special abilities.'); engine_text = e_card.get('engine', 'You should respond directly.')
+    system_prompt = f"{persona_text}\n\n--- ABILITIES ---\n{abilities_text}\n\n--- STYLE ---\n{engine_text}"
+    tokens = tokencount.count_text(system_prompt) + tokencount.MESSAGE_OVERHEAD
+    _compiled[key] = (cards, system_prompt, tokens)
+    return system_prompt, tokens
+
 # Load cards when this module is first imported by the server.
 load_all_cards()
-# --- END OF FILE prompt.py ---
\ No newline at end of file
+# --- END OF FILE prompt.py ---
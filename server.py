@@ -1,20 +1,35 @@
 # --- START OF REFACTORED server.py ---
 
-import time, uuid, argparse, os, threading
-from flask import Flask, request, jsonify, render_template  # <-- ADDED render_template
+import time, uuid, argparse, os, io, threading, json, signal, socket
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context  # <-- ADDED render_template
 from flask_cors import CORS
 import requests
 
-import serverconfig, prompt
+import serverconfig, prompt, backend, metrics, bulkmemory
 from agent_core import StateAgent
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 # --- Background Services ---
 class PromptChangeHandler(FileSystemEventHandler):
+    """Collects changed card files and reloads just those once the burst of editor events settles."""
+    DEBOUNCE_SECONDS = 0.5
+    def __init__(self):
+        super().__init__(); self.pending, self.lock, self.timer = set(), threading.Lock(), None
+
     def on_any_event(self, event):
-        if any(event.src_path.endswith(ext) for ext in ['.persona.yaml', '.ability.yaml', '.engine.yaml']):
-            print(f"[PROMPTS_WATCHER] Change detected. Reloading all cards..."); prompt.load_all_cards()
+        if event.is_directory or event.event_type not in ("created", "modified", "deleted", "moved"): return
+        paths = {p for p in (event.src_path, getattr(event, 'dest_path', None)) if p and p.endswith(prompt.CARD_EXTENSIONS)}
+        if not paths: return
+        with self.lock:
+            self.pending |= paths
+            if self.timer: self.timer.cancel()
+            self.timer = threading.Timer(self.DEBOUNCE_SECONDS, self._flush); self.timer.daemon = True; self.timer.start()
+
+    def _flush(self):
+        with self.lock: paths, self.pending, self.timer = sorted(self.pending), set(), None
+        print(f"[PROMPTS_WATCHER] Change detected. Reloading {len(paths)} card file(s)...")
+        for path in paths: prompt.reload_card_file(path)
 
 def start_prompt_watcher():
     path = serverconfig.PROMPTS_DIR
@@ -33,25 +48,33 @@ CORS(app)
 agent = None
 LAST_KNOWN_MODEL = [None] 
 
+def _poll_backend(server):
+    """The model a llama.cpp server reports, or None if it is unreachable or has no model loaded."""
+    try:
+        resp = backend.get("health", f"{server}/v1/models")
+        if resp.status_code != 200: return None
+        models = resp.json().get("data", []); return os.path.basename(models[0]['id']) if models else None
+    except: return None
+
 def model_monitor_thread(stop_event):
+    """Health-checks every configured llama.cpp server; the router only sends calls to healthy ones."""
     global LAST_KNOWN_MODEL; print("[MODEL_MONITOR] Starting...")
     while not stop_event.is_set():
-        try:
-            resp = requests.get(f"{serverconfig.LLAMA_CPP_BASE_URL}/v1/models", timeout=5)
-            if resp.status_code == 200:
-                models = resp.json().get("data", []); current_model = os.path.basename(models[0]['id']) if models else None
-                if current_model and LAST_KNOWN_MODEL[0] != current_model:
-                    print(f"[MODEL_MONITOR] !! MODEL ONLINE: {current_model} !!"); LAST_KNOWN_MODEL[0] = current_model
-            elif LAST_KNOWN_MODEL[0] is not None:
-                print(f"[MODEL_MONITOR] Model '{LAST_KNOWN_MODEL[0]}' offline."); LAST_KNOWN_MODEL[0] = None
-        except:
-            if LAST_KNOWN_MODEL[0] is not None: print("[MODEL_MONITOR] Llama.cpp unreachable."); LAST_KNOWN_MODEL[0] = None
+        for server in backend.router.servers():
+            model = _poll_backend(server); backend.router.mark(server, model is not None, model)
+        current_model = backend.router.model_for("chat")
+        if current_model and LAST_KNOWN_MODEL[0] != current_model:
+            print(f"[MODEL_MONITOR] !! MODEL ONLINE: {current_model} !!"); LAST_KNOWN_MODEL[0] = current_model
+        elif not current_model and LAST_KNOWN_MODEL[0] is not None:
+            print(f"[MODEL_MONITOR] Model '{LAST_KNOWN_MODEL[0]}' offline or unreachable."); LAST_KNOWN_MODEL[0] = None
+        # Cached embeddings are keyed by the embedding pool's model, so a model swap invalidates them.
+        if agent and (embedding_model := backend.router.model_for("embedding")): agent.memory_system.embedding_model_id = embedding_model
         stop_event.wait(5)
     print("[MODEL_MONITOR] Stopped.")
 
 def _get_models_list():
     try:
-        resp = requests.get(f"{serverconfig.LLAMA_CPP_BASE_URL}/v1/models", timeout=10); resp.raise_for_status()
+        resp = backend.get("models", "/v1/models"); resp.raise_for_status()
         return [{"id": os.path.basename(m.get("id")), "object": "model"} for m in resp.json().get("data", []) if m.get("id")]
     except: return []
 
@@ -82,7 +105,7 @@ def handle_embeddings():
             return jsonify({"error": "'input' must be a string or a list of strings."}), 400
         safe_payload = {"input": payload_input}
         headers = { "Content-Type": "application/json" }
-        response = requests.post(serverconfig.LLAMA_CPP_RAW_EMBEDDING_URL, json=safe_payload, headers=headers, timeout=30)
+        response = backend.post("embedding", serverconfig.EMBEDDINGS_PATH, json=safe_payload, headers=headers)
         response.raise_for_status()
         return jsonify(response.json())
     except requests.exceptions.HTTPError as http_err:
@@ -92,6 +115,60 @@ def handle_embeddings():
         print(f"[EMBEDDING_PROXY_ERROR] {e}")
         return jsonify({"error": "Failed to get embedding from backend."}), 500
 
+def _register_gauges():
+    """Scrape-time gauges; each reads the live agent, so they simply have no sample until it is up."""
+    metrics.REGISTRY.gauge("stateagent_memories", "Memories in the long-term memory log.", lambda: len(agent.memory_system.master_log))
+    metrics.REGISTRY.gauge("stateagent_dossiers", "User dossiers, resident in RAM and stored on disk.",
+                           lambda: [({"state": "resident"}, agent.dossiers.stats()["resident"]), ({"state": "stored"}, len(agent.dossiers))])
+    metrics.REGISTRY.gauge("stateagent_ingestion_backlog", "Background memory jobs waiting or running.",
+                           lambda: [({"state": state}, agent.ingestion.stats()[state]) for state in ("queued", "in_flight")])
+    metrics.REGISTRY.gauge("stateagent_sessions", "Client sessions with an active dossier.", lambda: len(agent.sessions))
+    metrics.REGISTRY.gauge("stateagent_prompt_cache_hit_ratio", "Share of prompt tokens llama.cpp served from its KV cache.",
+                           lambda: backend.slots.stats()["cache_hit_rate"])
+    metrics.REGISTRY.gauge("stateagent_backend_healthy", "1 if a llama.cpp server passed its last health check, by server.",
+                           lambda: [({"server": url}, float(s["healthy"])) for url, s in backend.router.stats()["servers"].items()])
+    metrics.REGISTRY.gauge("stateagent_backend_in_flight", "llama.cpp calls holding a scheduler slot, by priority class.",
+                           lambda: [({"priority": name}, backend.client.scheduler.stats()[name]["in_flight"]) for name in backend.PRIORITY_NAMES])
+
+_register_gauges()
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/v1/memory/stats', methods=['GET'])
+def memory_stats():
+    if not agent: return jsonify({"error": "Agent not initialized."}), 500
+    return jsonify(dict(agent.memory_system.stats(), ingestion=agent.ingestion.stats(), dossiers=agent.dossiers.stats(), prompt_cache=backend.slots.stats(),
+                        scheduler=backend.client.scheduler.stats(), backends=backend.router.stats()))
+
+@app.route('/v1/memory/import', methods=['POST'])
+def memory_import():
+    """Bulk-imports memories: {"records": [...]} as JSON, or a JSONL (default) / CSV (text/csv) body. See bulkmemory.py."""
+    if not agent: return jsonify({"error": "Agent not initialized."}), 500
+    if request.is_json:
+        rows = (request.get_json(silent=True) or {}).get("records")
+        if not isinstance(rows, list): return jsonify({"error": "Invalid payload. 'records' must be a list."}), 400
+    else:
+        fmt = "csv" if "csv" in (request.content_type or "") else "jsonl"
+        rows = bulkmemory.read_rows(io.StringIO(request.get_data(as_text=True)), fmt)
+    try:
+        # Imports run behind chat turns for backend capacity.
+        return jsonify(bulkmemory.import_rows(agent.memory_system, rows, priority=backend.INGESTION))
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        return jsonify({"error": f"Import failed: {e}"}), 500
+
+@app.route('/v1/memory/export', methods=['GET'])
+def memory_export():
+    """Streams every memory as JSONL (default) or CSV (?format=csv); ?embeddings=1 adds the vectors."""
+    if not agent: return jsonify({"error": "Agent not initialized."}), 500
+    fmt = request.args.get("format", "jsonl").lower()
+    if fmt not in bulkmemory.FORMATS: return jsonify({"error": f"'format' must be one of {bulkmemory.FORMATS}."}), 400
+    embeddings = request.args.get("embeddings", "").lower() in ("1", "true", "yes")
+    chunks = bulkmemory.format_rows(bulkmemory.export_rows(agent.memory_system, embeddings), fmt, embeddings)
+    return Response(chunks, mimetype="text/csv" if fmt == "csv" else "application/x-ndjson")
+
 @app.route('/v1/chat/completions', methods=['POST'])
 @app.route('/chat/completions', methods=['POST'])
 def chat_completions():
@@ -102,37 +179,129 @@ def chat_completions():
         model_id = request_data.get("model") or LAST_KNOWN_MODEL[0]
         if not model_id: discovered = _get_models_list(); model_id = discovered[0]['id'] if discovered else None
         if not model_id: return jsonify({"error": "No model is loaded in the backend."}), 503
+        session_id = agent.session_id_for(request_data)
+        if request_data.get("stream"):
+            response = _stream_chat_response(agent.handle_request(request_data, model_id, stream=True), model_id)
+            response.headers["X-Session-Id"] = session_id
+            return response
         ai_response_text = agent.handle_request(request_data, model_id)
-        return jsonify({"id": f"cmpl-{uuid.uuid4()}", "model": agent.current_model_id, "choices": [{"message": {"role": "assistant", "content": ai_response_text}}]})
+        response = jsonify({"id": f"cmpl-{uuid.uuid4()}", "model": model_id, "session_id": session_id, "choices": [{"message": {"role": "assistant", "content": ai_response_text}}]})
+        response.headers["X-Session-Id"] = session_id
+        return response
     except Exception as e:
         import traceback; traceback.print_exc()
         return jsonify({"error": f"Internal Server Error: {e}"}), 500
 
+def _stream_chat_response(result, model_id):
+    """Wraps the agent's text deltas (or a complete string) as OpenAI-compatible SSE chunks."""
+    completion_id, created = f"chatcmpl-{uuid.uuid4()}", int(time.time())
+    def chunk(delta, finish_reason=None):
+        body = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model_id,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(body)}\n\n"
+    def events():
+        yield chunk({"role": "assistant"})
+        for delta in ([result] if isinstance(result, str) else result):
+            if delta: yield chunk({"content": delta})
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Service Lifecycle (one per process: the dev server, each prefork worker, or wsgi.py) ---
+_services = []
+
+def start_services(persona_id, ability_id, engine_id):
+    """Builds this process's agent and starts its prompt watcher and model monitor."""
+    global agent
+    agent = StateAgent(persona_id=persona_id, ability_id=ability_id, engine_id=engine_id)
+    prompt_watcher = start_prompt_watcher()
+    stop_monitor_event = threading.Event()
+    model_monitor = threading.Thread(target=model_monitor_thread, args=(stop_monitor_event,), daemon=True)
+    model_monitor.start()
+    _services[:] = [prompt_watcher, stop_monitor_event, model_monitor]
+
+def stop_services():
+    if not _services: return
+    prompt_watcher, stop_monitor_event, model_monitor = _services; _services.clear()
+    print("[SERVER] Shutdown initiated...")
+    agent.shutdown()
+    if prompt_watcher: prompt_watcher.stop(); prompt_watcher.join()
+    stop_monitor_event.set(); model_monitor.join()
+    print("[SERVER] All background services stopped. Goodbye.")
+
+def serve_workers(host, port, workers, agent_args):
+    """
+    POSIX prefork server. The parent binds the port once and forks `workers` children; each
+    builds its own agent (the memory store is shared, see serverconfig.SHARED_STORE) and
+    serves threaded requests from the inherited socket. A child that dies is replaced, and
+    SIGINT/SIGTERM to the parent stops them all.
+    """
+    from werkzeug.serving import make_server
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port)); listener.listen(128); listener.set_inheritable(True)
+    children, stopping = {}, threading.Event()
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid:
+            children[pid] = worker_id; return
+        # --- Child ---
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent turns Ctrl+C into SIGTERM
+        signal.signal(signal.SIGTERM, signal.SIG_DFL) # until the server below can shut down cleanly
+        start_services(*agent_args)
+        server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+        print(f"[SERVER] Worker {worker_id} (pid {os.getpid()}) serving.")
+        status = 0
+        try: server.serve_forever()
+        except Exception: import traceback; traceback.print_exc(); status = 1
+        finally:
+            try: stop_services()
+            finally: os._exit(status)
+
+    def stop(signum, frame): stopping.set()
+    signal.signal(signal.SIGINT, stop); signal.signal(signal.SIGTERM, stop)
+    for worker_id in range(workers): spawn(worker_id)
+    signalled = False
+    while children:
+        if stopping.is_set() and not signalled:
+            print(f"[SERVER] Stopping {len(children)} worker(s)...")
+            for pid in children: os.kill(pid, signal.SIGTERM)
+            signalled = True
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid: stopping.wait(0.5); continue
+        worker_id = children.pop(pid)
+        if not stopping.is_set():
+            print(f"[SERVER] Worker {worker_id} (pid {pid}) exited with status {status}; restarting.")
+            time.sleep(1); spawn(worker_id)
+    listener.close()
+    print("[SERVER] All workers stopped. Goodbye.")
+
 # --- Main Execution Block ---
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="State Agent Orchestrator v0.2")
     parser.add_argument('-p', '--persona', type=str.upper, default=serverconfig.DEFAULT_PERSONA_ID, help="Default Persona ID (e.g., AA).")
     parser.add_argument('-a', '--ability', type=str, default=serverconfig.DEFAULT_ABILITY_ID, help="Default Ability ID (e.g., 01).")
     parser.add_argument('-e', '--engine', type=str.upper, default=serverconfig.DEFAULT_ENGINE_ID, help="Default Engine ID (e.g., F0).")
+    parser.add_argument('-w', '--workers', type=int, default=serverconfig.WORKERS, help="Worker processes (POSIX only; default from config.ini).")
     args = parser.parse_args()
 
     # ASCII Art and other startup messages...
     print(r"""...""") # (Keeping this brief to save space)
 
-    agent = StateAgent(persona_id=args.persona, ability_id=args.ability, engine_id=args.engine)
-    
-    prompt_watcher = start_prompt_watcher()
-    stop_monitor_event = threading.Event()
-    model_monitor = threading.Thread(target=model_monitor_thread, args=(stop_monitor_event,))
-    model_monitor.start()
-
     port = serverconfig.ORCHESTRATOR_PORT; host = serverconfig.HOST
+    agent_args = (args.persona, args.ability, args.engine)
+    if args.workers > 1 and not hasattr(os, "fork"):
+        print("[SERVER] WARN: Worker processes need os.fork(); starting a single process instead."); args.workers = 1
     print(f"Orchestrator v0.2 starting on http://{host}:{port}")
     print(f"Web UI available at http://{host}:{port}") # Added a message for clarity
-    try:
-        app.run(host=host, port=port, debug=False, use_reloader=False)
-    finally:
-        print("[SERVER] Shutdown initiated..."); 
-        if prompt_watcher: prompt_watcher.stop(); prompt_watcher.join()
-        stop_monitor_event.set(); model_monitor.join()
-        print("[SERVER] All background services stopped. Goodbye.")
\ No newline at end of file
+    if args.workers > 1:
+        serverconfig.SHARED_STORE = backend.slots.shared = True
+        serve_workers(host, port, args.workers, agent_args)
+    else:
+        start_services(*agent_args)
+        try:
+            app.run(host=host, port=port, debug=False, use_reloader=False)
+        finally:
+            stop_services()
\ No newline at end of file
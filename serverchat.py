@@ -1,14 +1,12 @@
 # --- START OF FILE serverchat.py ---
 
-import requests, json, os, argparse, serverconfig
+import requests, json, os, argparse, uuid, serverconfig
 
-# Session ID will be given by the server on the first request
-SESSION_ID = None
+# Each client run is its own session, so its `//user` switches only affect this chat.
+SESSION_ID = f"cli-{uuid.uuid4()}"
 
 def send_request(payload):
     """Handles sending requests and printing/managing session responses."""
-    global SESSION_ID
-
     if SESSION_ID:
         payload['session_id'] = SESSION_ID
         
@@ -21,11 +19,6 @@ def send_request(payload):
         response.raise_for_status()
         json_response = response.json()
         
-        # Capture the session_id from the server's response
-        if 'session_id' in json_response and SESSION_ID is None:
-            SESSION_ID = json_response['session_id']
-            print(f"\n[CLIENT] Session started. Your permanent Session ID for this chat is: {SESSION_ID}\n")
-        
         reply = json_response.get('choices', [{}])[0].get('message', {}).get('content', 'Error: No response content.')
         print(f"AI> {reply}")
 
@@ -45,6 +38,7 @@ if __name__ == '__main__':
     print("  //engine <id>       - Change the current user's thinking style (e.g., //engine F0)")
     print("  //loadout <id>      - Apply a preset mind from config.ini (e.g., //loadout TEST99)")
     print("-----------------------------------")
+    print(f"[CLIENT] Session ID for this chat: {SESSION_ID}")
     
     while True:
         # We don't need to know the user here; the server manages it via `//user` command
@@ -34,13 +34,77 @@ try:
 except (configparser.NoSectionError, configparser.NoOptionError) as e:
     raise RuntimeError(f"FATAL: config.ini is missing a required section or key. Error: {e}")
 
+# --- Worker processes (optional [server_settings] keys) ---
+WORKERS = max(1, config.getint('server_settings', 'workers', fallback=1))
+# With several processes the memory files are shared, and every read first picks up what other workers wrote.
+SHARED_STORE = config.getboolean('server_settings', 'shared_store', fallback=WORKERS > 1)
+SHARED_REFRESH_SECONDS = config.getint('server_settings', 'shared_refresh_ms', fallback=250) / 1000.0
+
+# --- Backend HTTP Client (optional [backend] section) ---
+BACKEND_POOL_SIZE = config.getint('backend', 'pool_size', fallback=32)
+BACKEND_RETRIES = config.getint('backend', 'retries', fallback=2)
+BACKEND_RETRY_BACKOFF = config.getfloat('backend', 'retry_backoff', fallback=0.25)
+BACKEND_CHAT_CONCURRENCY = config.getint('backend', 'chat_concurrency', fallback=8)
+BACKEND_EMBEDDING_CONCURRENCY = config.getint('backend', 'embedding_concurrency', fallback=4)
+BACKEND_TIMEOUTS = {
+    call_type: config.getfloat('backend', f'timeout_{call_type}', fallback=default)
+    for call_type, default in {'chat': 180, 'utility': 60, 'embedding': 30, 'models': 10, 'health': 5}.items()
+}
+# Cap on llama.cpp calls in flight across every call type (0 = no cap); background work never takes the reserved slots.
+BACKEND_MAX_IN_FLIGHT = config.getint('backend', 'max_in_flight', fallback=8)
+BACKEND_BACKGROUND_RESERVE = config.getint('backend', 'background_reserve', fallback=2)
+PREFIX_STABLE_PROMPTS = config.getboolean('backend', 'prefix_stable_prompts', fallback=True)
+BACKEND_SLOTS = config.getint('backend', 'slots', fallback=0)
+
+# --- Background Ingestion (optional [ingestion] section) ---
+INGESTION_WORKERS = config.getint('ingestion', 'workers', fallback=2)
+INGESTION_MAX_QUEUE = config.getint('ingestion', 'max_queue', fallback=256)
+INGESTION_WHEN_FULL = config.get('ingestion', 'when_full', fallback='drop_oldest').strip().lower()
+
+# --- Memory Tuning (optional [memory] section) ---
+ANN_INDEX_ENABLED = config.getboolean('memory', 'ann_index', fallback=False)
+ANN_NPROBE = config.getint('memory', 'ann_nprobe', fallback=8)
+ANN_EXACT_BELOW = config.getint('memory', 'ann_exact_below', fallback=2048)
+STRUCTURED_ANALYSIS = config.getboolean('memory', 'structured_analysis', fallback=True)
+STRUCTURED_RETRY_SECONDS = config.getint('memory', 'structured_retry_seconds', fallback=300)
+
+# --- Dossier store ---
+DOSSIER_MAX_RESIDENT = config.getint('dossiers', 'max_resident', fallback=1024)
+DOSSIER_IDLE_SECONDS = config.getint('dossiers', 'idle_seconds', fallback=3600)
+SESSION_MAX = config.getint('dossiers', 'max_sessions', fallback=10000)
+SESSION_IDLE_SECONDS = config.getint('dossiers', 'session_idle_seconds', fallback=86400)
+
+# --- Context packing (prompt token budget) ---
+CONTEXT_TOKEN_BUDGET = config.getint('context', 'token_budget', fallback=32768)
+CONTEXT_KEEP_RECENT_MESSAGES = config.getint('context', 'keep_recent_messages', fallback=4)
+CONTEXT_SUMMARY_MAX_TOKENS = config.getint('context', 'summary_max_tokens', fallback=256)
+
+# --- Embedding Tuning (optional [embeddings] section) ---
+EMBEDDING_CACHE_SIZE = config.getint('embeddings', 'cache_size', fallback=4096)
+EMBEDDING_DISK_CACHE = config.getboolean('embeddings', 'disk_cache', fallback=True)
+EMBEDDING_DISK_CACHE_MAX = config.getint('embeddings', 'disk_max_entries', fallback=100000)
+EMBEDDING_MAX_BATCH = config.getint('embeddings', 'max_batch', fallback=32)
+EMBEDDING_MAX_WAIT_MS = config.getint('embeddings', 'max_wait_ms', fallback=5)
+
 # --- Derived Paths & URLs (Updated for new memory structure) ---
 ORCHESTRATOR_BASE_URL = f"http://{HOST}:{ORCHESTRATOR_PORT}"
 LLAMA_CPP_BASE_URL = f"http://{HOST}:{LLAMA_CPP_PORT}"
 LLAMA_CPP_CHAT_URL = f"{LLAMA_CPP_BASE_URL}/v1/chat/completions"
 LLAMA_CPP_RAW_EMBEDDING_URL = f"{LLAMA_CPP_BASE_URL}/v1/embeddings"
+# The orchestrator's own proxy route, for external clients. MemorySystem embeds via the raw URL directly.
 LLAMA_CPP_EMBEDDING_URL = f"{ORCHESTRATOR_BASE_URL}/v1/embeddings"
 
+# --- Backend pools (optional [backends] section) ---
+# Comma-separated llama.cpp base URLs per role. Chat defaults to llama_cpp_port; utility and embedding default to the chat pool.
+def _backend_pool(role, fallback):
+    return [url.strip().rstrip('/') for url in config.get('backends', role, fallback='').split(',') if url.strip()] or fallback
+BACKEND_POOLS = {'chat': _backend_pool('chat', [LLAMA_CPP_BASE_URL])}
+BACKEND_POOLS['utility'] = _backend_pool('utility', BACKEND_POOLS['chat'])
+BACKEND_POOLS['embedding'] = _backend_pool('embedding', BACKEND_POOLS['chat'])
+# Calls made with a bare path are routed to a server of their role's pool (see backend.BackendRouter).
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+EMBEDDINGS_PATH = "/v1/embeddings"
+
 # --- NEW MEMORY PATHS ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROMPTS_DIR = os.path.join(BASE_DIR, "prompts")
@@ -48,11 +112,16 @@ MEMORY_DIR = os.path.join(BASE_DIR, "memory")
 
 # The folder for individual user/entity manifests
 DOSSIER_DIR = os.path.join(MEMORY_DIR, "dossiers")
+# Working memory and mind settings of every user dossier
+DOSSIER_STORE_PATH = os.path.join(DOSSIER_DIR, "dossiers.sqlite3")
 
 # The folder for the central, unified memory database
 AGENT_MEMORY_PATH = os.path.join(MEMORY_DIR, INITIAL_USER_ID)
 AGENT_VECTOR_DB_PATH = os.path.join(AGENT_MEMORY_PATH, "vectors")
+MEMORY_LOG_DB_PATH = os.path.join(AGENT_MEMORY_PATH, "memory_log.sqlite3")
+# Legacy CSV log; only read once to migrate it into MEMORY_LOG_DB_PATH.
 MASTER_MEMORY_LOG_PATH = os.path.join(AGENT_MEMORY_PATH, "master_memory_log.csv")
 SIGNATURES_FILE_PATH = os.path.join(AGENT_MEMORY_PATH, "signatures.safetensors")
+EMBEDDING_CACHE_PATH = os.path.join(AGENT_MEMORY_PATH, "embedding_cache.sqlite3")
 
 # --- END OF REFACTORED serverconfig.py ---
\ No newline at end of file
@@ -0,0 +1,76 @@
+# --- START OF FILE similarity.py ---
+
+import threading
+import numpy as np
+
+def normalize(vectors):
+    """Returns float32 copies of `vectors` scaled to unit L2 norm (zero rows stay zero)."""
+    arr = np.array(vectors, dtype=np.float32, ndmin=1)
+    norms = np.linalg.norm(arr, axis=-1, keepdims=True)
+    np.divide(arr, norms, out=arr, where=norms > 0)
+    return arr
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores along the last axis, best first, without a full sort."""
+    n = scores.shape[-1]
+    if k >= n: return np.argsort(-scores, axis=-1)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+class SimilaritySearch:
+    """
+    Cosine top-k search over a matrix whose rows are already unit-normalized.
+
+    Because stored rows are pre-normalized, a score is a single matrix-vector (or
+    matrix-matrix for batched queries) product. A candidate subset given as row numbers
+    is used as a view when it is one contiguous range and otherwise gathered into a
+    reusable per-thread buffer instead of a fresh array per query.
+    """
+    def __init__(self, matrix):
+        # `matrix` is either an array or a zero-argument callable returning the current one,
+        # so a growing VectorStore can be searched without rebuilding this object.
+        self._matrix = matrix if callable(matrix) else (lambda: matrix)
+        self._local = threading.local()
+
+    def _gather(self, matrix, rows):
+        if rows[-1] - rows[0] + 1 == len(rows) and np.all(rows[1:] > rows[:-1]):
+            return matrix[rows[0]:rows[-1] + 1]
+        buf = getattr(self._local, "buf", None)
+        if buf is None or buf.shape[0] < len(rows) or buf.shape[1] != matrix.shape[1]:
+            buf = self._local.buf = np.empty((max(len(rows), 64), matrix.shape[1]), dtype=np.float32)
+        out = buf[:len(rows)]
+        np.take(matrix, rows, axis=0, out=out)
+        return out
+
+    def search(self, queries, rows=None, top_k=3, threshold=None):
+        """
+        Scores a batch of queries (n_queries, dim) and returns, per query, a list of
+        (row, score) pairs sorted best first. `rows` restricts the search to those rows.
+        """
+        q = normalize(np.atleast_2d(queries))
+        matrix = self._matrix()
+        if rows is None:
+            candidates, subset = None, matrix
+        else:
+            candidates = np.asarray(rows, dtype=np.intp)
+            if candidates.size == 0: return [[] for _ in range(q.shape[0])]
+            subset = self._gather(matrix, candidates)
+        if subset.shape[0] == 0: return [[] for _ in range(q.shape[0])]
+
+        scores = q @ subset.T
+        best = top_k_indices(scores, top_k)
+        results = []
+        for query_scores, query_best in zip(scores, best):
+            hits = []
+            for i in query_best:
+                score = float(query_scores[i])
+                if threshold is not None and score < threshold: break
+                hits.append((int(i) if candidates is None else int(candidates[i]), score))
+            results.append(hits)
+        return results
+
+    def search_one(self, query, rows=None, top_k=3, threshold=None):
+        return self.search(query, rows=rows, top_k=top_k, threshold=threshold)[0]
+
+# --- END OF FILE similarity.py ---
@@ -1,12 +1,21 @@
 import os
+import time
 import threading
 import uuid
+import json
+import datetime
 import numpy as np
-import requests
+import backend
 import serverconfig
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from collections import deque
+from collections import deque, defaultdict
+from vectorstore import VectorStore
+from memorylog import MemoryLog, MemoryRecord, MemoryIndex
+from similarity import SimilaritySearch, normalize
+from ann import IVFIndex
+from embeddings import EmbeddingCache, EmbeddingBatcher
+from entitymatch import EntityGazetteer
+from filelock import InterProcessLock
+import tokencount
 
 try:
     from safetensors.numpy import save_file, load_file
@@ -25,61 +34,177 @@ class UserDossier:
         # which is a cleaner separation of concerns. This class now just holds the agent's
         # state for a given user session.
         self.working_memory = deque(maxlen=20)
+        # Token count of each working_memory entry, counted once when the message is added.
+        self.token_counts = deque(maxlen=20)
+        # Rolling summary of messages that aged out of the prompt (see contextpack.ContextPacker);
+        # it covers every message with sequence number < summary_upto.
+        self.messages_added = 0
+        self.summary, self.summary_upto = "", 0
+        # Background extension of the summary (see contextpack.ContextPacker); not stored.
+        self.summary_update = None
         self.persona_id = ""
         self.ability_id = ""
         self.engine_id = ""
+        # Held for the duration of a turn on this dossier (see StateAgent.claim_dossier).
+        self.lock = threading.Lock()
 
-    def add_message(self, role, content): self.working_memory.append({"role": role, "content": content})
+    def add_message(self, role, content):
+        message = {"role": role, "content": content}
+        self.token_counts.append(tokencount.count_message(message)); self.working_memory.append(message)
+        self.messages_added += 1
     def get_history(self): return list(self.working_memory)
+    def get_history_token_counts(self): return list(self.token_counts)
+
+    def to_dict(self):
+        """Snapshot for the dossier store (see dossierstore.DossierStore)."""
+        return {"user_id": self.user_id, "persona_id": self.persona_id, "ability_id": self.ability_id, "engine_id": self.engine_id,
+                "working_memory": list(self.working_memory), "token_counts": list(self.token_counts),
+                "messages_added": self.messages_added, "summary": self.summary, "summary_upto": self.summary_upto}
+
+    @classmethod
+    def from_dict(cls, data):
+        dossier = cls(data["user_id"]); dossier.load_dict(data)
+        return dossier
+
+    def load_dict(self, data):
+        """Replaces this dossier's state with a stored snapshot, keeping the object (and its lock)."""
+        self.persona_id, self.ability_id, self.engine_id = data.get("persona_id", ""), data.get("ability_id", ""), data.get("engine_id", "")
+        self.working_memory.clear(); self.token_counts.clear()
+        self.working_memory.extend(data.get("working_memory", []))
+        counts = data.get("token_counts", [])
+        self.token_counts.extend(counts if len(counts) == len(self.working_memory) else map(tokencount.count_message, self.working_memory))
+        self.messages_added = data.get("messages_added", len(self.working_memory))
+        self.summary, self.summary_upto = data.get("summary", ""), data.get("summary_upto", 0)
 
 class MemorySystem:
     def __init__(self):
         self.lock = threading.Lock()
         os.makedirs(serverconfig.AGENT_VECTOR_DB_PATH, exist_ok=True)
         os.makedirs(serverconfig.DOSSIER_DIR, exist_ok=True)
-        self.vectors = self._load_all_vectors()
+        # All memory vectors live in one memory-mapped matrix; the old one-file-per-memory
+        # layout is migrated into it on first start.
+        # Rows are stored unit-normalized so recall scores with a single dot product.
+        self.vectors = VectorStore(serverconfig.AGENT_VECTOR_DB_PATH, legacy_extension=VECTOR_FILE_EXTENSION, legacy_loader=load_file, normalize=True)
+        self.search = SimilaritySearch(lambda: self.vectors.matrix)
+        self.ann = IVFIndex(self.vectors, nprobe=serverconfig.ANN_NPROBE, exact_below=serverconfig.ANN_EXACT_BELOW) if serverconfig.ANN_INDEX_ENABLED else None
         
         ### MODIFIED: Added 'speaker_id' to solve the "Two Sarahs" problem ###
         # This is the single most important data model change.
-        try:
-            self.master_log = pd.read_csv(serverconfig.MASTER_MEMORY_LOG_PATH)
-        except FileNotFoundError:
-            self.master_log = pd.DataFrame(columns=['uuid', 'timestamp', 'speaker_id', 'entity_id', 'text'])
+        # The log is append-only on disk (SQLite/WAL) and streamed into an in-memory list of
+        # MemoryRecords at startup; the old CSV is migrated on first start.
+        self.memory_log = MemoryLog(serverconfig.MEMORY_LOG_DB_PATH, legacy_csv_path=serverconfig.MASTER_MEMORY_LOG_PATH)
+        self.master_log, self.index = [], MemoryIndex()
+        # Highest log row read from disk; in shared-store mode refresh() continues from here.
+        self._log_position = 0
+        for log_row, record in self.memory_log.iter_rows():
+            self.index.add(len(self.master_log), record); self.master_log.append(record); self._log_position = log_row
+        # Known speakers/subjects, so most recall queries resolve their entities without an LLM call.
+        self.gazetteer = EntityGazetteer([*self.index.by_speaker, *self.index.by_entity])
+        self.entity_lookups = self.entity_llm_skips = 0
 
-        try:
-            self.signatures = load_file(serverconfig.SIGNATURES_FILE_PATH)
-        except FileNotFoundError: self.signatures = {}
+        self._signatures_lock = InterProcessLock(f"{serverconfig.SIGNATURES_FILE_PATH}.lock")
+        self.signatures, self._signatures_mtime = self._load_signatures()
+        self._signature_search = None # (user_ids, SimilaritySearch), rebuilt after enrollment
+        self._refreshed_at = 0.0
+        # After a failed structured-analysis call the legacy prompts are used until this time (monotonic).
+        self._structured_retry_at = 0.0
+
+        # Embeddings are cached per model; the server's model monitor sets the id once the backend
+        # reports which model is loaded. Until then the cache is bypassed rather than risk mixing models.
+        self.embedding_model_id = None
+        self.embedding_cache = EmbeddingCache(serverconfig.EMBEDDING_CACHE_SIZE, serverconfig.EMBEDDING_CACHE_PATH if serverconfig.EMBEDDING_DISK_CACHE else None,
+                                              max_disk_entries=serverconfig.EMBEDDING_DISK_CACHE_MAX)
+        self.embedder = EmbeddingBatcher(serverconfig.EMBEDDINGS_PATH, max_batch=serverconfig.EMBEDDING_MAX_BATCH, max_wait_ms=serverconfig.EMBEDDING_MAX_WAIT_MS)
         print(f"MemorySystem Initialized: {len(self.vectors)} vectors, {len(self.master_log)} log entries, {len(self.signatures)} user signatures.")
 
-    def _load_all_vectors(self):
-        vectors = {}
-        for filename in os.listdir(serverconfig.AGENT_VECTOR_DB_PATH):
-            if filename.endswith(VECTOR_FILE_EXTENSION):
-                try: vectors[os.path.splitext(filename)[0]] = load_file(os.path.join(serverconfig.AGENT_VECTOR_DB_PATH, filename))["embedding"]
-                except Exception as e: print(f"LTM_WARN: Failed to load vector '{filename}': {e}")
+    def close(self):
+        """Closes the vector store and memory log files."""
+        self.vectors.close(); self.memory_log.close()
+
+    def _load_signatures(self):
+        with self._signatures_lock:
+            try: return dict(load_file(serverconfig.SIGNATURES_FILE_PATH)), os.path.getmtime(serverconfig.SIGNATURES_FILE_PATH)
+            except FileNotFoundError: return {}, None
+
+    def refresh(self):
+        """
+        Shared-store mode (several worker processes): folds in the memories, vectors and
+        signatures other workers wrote since the last call. Runs at most once per
+        SHARED_REFRESH_SECONDS; a no-op for a single process.
+        """
+        if not serverconfig.SHARED_STORE: return
+        now = time.monotonic()
+        if now - self._refreshed_at < serverconfig.SHARED_REFRESH_SECONDS: return
+        self._refreshed_at = now
+        with self.lock:
+            # Log first: a record's vector is always written before the record itself.
+            for log_row, record in self.memory_log.iter_rows(self._log_position):
+                self._log_position = log_row
+                if record.uuid in self.index.text_by_uuid: continue # appended by this process
+                self.index.add(len(self.master_log), record); self.master_log.append(record)
+                self.gazetteer.add(record.speaker_id, record.entity_id)
+            self.vectors.refresh()
+            if self.ann: self.ann.refresh()
+        try: mtime = os.path.getmtime(serverconfig.SIGNATURES_FILE_PATH)
+        except FileNotFoundError: mtime = None
+        if mtime != self._signatures_mtime:
+            signatures, mtime = self._load_signatures()
+            with self.lock: self.signatures, self._signatures_mtime, self._signature_search = signatures, mtime, None
+
+    def _get_embedding(self, text): return self._get_embeddings([text])[0]
+
+    def _get_embeddings(self, texts):
+        """Embeds many texts; cache misses go to the backend together as one batched request."""
+        model_id = self.embedding_model_id
+        vectors = [self.embedding_cache.get(model_id, t) if model_id else None for t in texts]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            for i, vec in zip(missing, self.embedder.embed_many([texts[i] for i in missing])):
+                vectors[i] = self.embedding_cache.put(model_id, texts[i], vec) if model_id else vec
         return vectors
 
-    def _get_embedding(self, text):
-        resp = requests.post(serverconfig.LLAMA_CPP_EMBEDDING_URL, json={"input": [text]}, timeout=30); resp.raise_for_status()
-        return np.array(resp.json()['data'][0]['embedding'], dtype=np.float32)
+    def analyze_query(self, query, speaker_id=None, chat_model_id=None):
+        """
+        Returns (entities, query_vector, statement_analysis) for a user message. The embedding
+        request is queued before the LLM call starts, so the two backend calls overlap.
+
+        In structured mode (and with a known speaker) the LLM call is analyze_statement, whose
+        result also carries the enriched fact and subject for the gatekeeper; otherwise it is
+        the plain entity-extraction prompt and statement_analysis is None.
+        """
+        self.refresh()
+        model_id = self.embedding_model_id
+        query_vec = self.embedding_cache.get(model_id, query) if model_id else None
+        pending = None if query_vec is not None else self.embedder.submit([query])[0]
+        entities, analysis = self._match_query_entities(speaker_id, query), None
+        if entities is None:
+            analysis = self.analyze_statement(speaker_id, query, chat_model_id) if serverconfig.STRUCTURED_ANALYSIS and speaker_id else None
+            entities = analysis['mentioned_entities'] if analysis else self._extract_entities_from_query(query)
+        if pending is not None:
+            query_vec = pending.result()
+            if model_id: query_vec = self.embedding_cache.put(model_id, query, query_vec)
+        return entities, query_vec, analysis
+
+    def stats(self):
+        self.refresh()
+        lookups = self.entity_lookups
+        return {"vectors": len(self.vectors), "log_entries": len(self.master_log), "signatures": len(self.signatures),
+                "embedding_model": self.embedding_model_id, "embedding_cache": self.embedding_cache.stats(), "embedding_batches": self.embedder.stats(),
+                "entity_matcher": {"known_entities": len(self.gazetteer), "lookups": lookups, "llm_skipped": self.entity_llm_skips,
+                                   "llm_skip_rate": round(self.entity_llm_skips / lookups, 4) if lookups else 0.0}}
 
     ### MODIFIED: 'remember' now tracks the speaker ###
     def remember(self, speaker_id, entity_id, enriched_text):
         try:
             vec = self._get_embedding(enriched_text); unique_id = str(uuid.uuid4())
             with self.lock:
-                vector_filepath = os.path.join(serverconfig.AGENT_VECTOR_DB_PATH, f"{unique_id}{VECTOR_FILE_EXTENSION}")
-                save_file({"embedding": vec}, vector_filepath); self.vectors[unique_id] = vec
+                vector_row = self.vectors.add(unique_id, vec)
+                if self.ann: self.ann.add(vector_row, vec)
                 
-                new_entry_df = pd.DataFrame([{'uuid': unique_id, 'timestamp': pd.Timestamp.now(), 'speaker_id': speaker_id, 'entity_id': entity_id, 'text': enriched_text}])
-                
-                ### NEW: Fix for Pandas FutureWarning ###
-                if self.master_log.empty:
-                    self.master_log = new_entry_df
-                else:
-                    self.master_log = pd.concat([self.master_log, new_entry_df], ignore_index=True)
-
-                self.master_log.to_csv(serverconfig.MASTER_MEMORY_LOG_PATH, index=False)
+                record = MemoryRecord(unique_id, datetime.datetime.now().isoformat(sep=' '), speaker_id, entity_id, enriched_text)
+                self.memory_log.append(record)
+                self.index.add(len(self.master_log), record); self.master_log.append(record)
+                self.gazetteer.add(speaker_id, entity_id)
                 
                 # We still create dossier manifests for easy data management, but they are not the primary source for recall.
                 entity_dossier_dir = os.path.join(serverconfig.DOSSIER_DIR, entity_id)
@@ -89,10 +214,65 @@ class MemorySystem:
             print(f"LTM: Memory anchor complete for entity '{entity_id}' spoken by '{speaker_id}': {unique_id}")
         except Exception as e: print(f"LTM_ERROR: Failed to save memory for entity '{entity_id}': {e}")
 
+    def remember_many(self, records, vectors=None):
+        """
+        Stores already-enriched MemoryRecords in bulk (see bulkmemory.py): one embedding request
+        for the batch, one append per vector file and one log transaction. `vectors` may give a
+        precomputed embedding per record (None entries are embedded here). Records whose uuid is
+        already stored are skipped, so replaying a batch is harmless. Returns how many were added.
+        """
+        vectors = list(vectors) if vectors is not None else [None] * len(records)
+        known, seen, batch = self.index.text_by_uuid, set(), []
+        for record, vec in zip(records, vectors):
+            if record.uuid not in known and record.uuid not in seen: seen.add(record.uuid); batch.append([record, vec])
+        missing = [item for item in batch if item[1] is None]
+        if missing:
+            for item, vec in zip(missing, self._get_embeddings([record.text for record, _ in missing])): item[1] = vec
+        with self.lock:
+            batch = [(record, vec) for record, vec in batch if record.uuid not in self.index.text_by_uuid]
+            if not batch: return 0
+            # Vectors can outlive their log rows when an earlier import stopped between the two writes.
+            new_vectors = [(record.uuid, vec) for record, vec in batch if record.uuid not in self.vectors]
+            if new_vectors:
+                first_row = self.vectors.add_many([u for u, _ in new_vectors], [vec for _, vec in new_vectors])
+                if self.ann: self.ann.add_many(first_row)
+            self.memory_log.append_many(record for record, _ in batch)
+            manifests = defaultdict(list)
+            for record, _ in batch:
+                self.index.add(len(self.master_log), record); self.master_log.append(record)
+                self.gazetteer.add(record.speaker_id, record.entity_id)
+                manifests[record.entity_id].append(record.uuid)
+            for entity_id, uuids in manifests.items():
+                entity_dossier_dir = os.path.join(serverconfig.DOSSIER_DIR, entity_id)
+                os.makedirs(entity_dossier_dir, exist_ok=True)
+                with open(os.path.join(entity_dossier_dir, "memory_manifest.txt"), "a", encoding="utf-8") as f: f.write("".join(f"{u}\n" for u in uuids))
+        return len(batch)
+
     ### DELETED: The old 'recall' function ###
     # It has been replaced by the more powerful 'intelligent_recall'.
 
     ### NEW: Helper method for intelligent recall ###
+    def _match_query_entities(self, user_id, query):
+        """
+        Resolves query entities with the gazetteer. Returns None when the match is inconclusive
+        and the LLM should be asked instead.
+
+        Known names win over self-references ("what does my sister Sarah like" -> ['sarah']).
+        With no match at all the answer is still conclusive (nothing to recall) when the user
+        has no memories yet or the message is too short to carry a reference ("ok thanks").
+        """
+        from nodes import _sanitize_for_filename
+        entities, refers_to_self = self.gazetteer.match(_sanitize_for_filename(query))
+        if entities: result = entities
+        elif refers_to_self: result = ['self']
+        elif user_id and not (self.index.by_speaker.get(user_id) or self.index.by_entity.get(user_id)): result = []
+        elif len(query.split()) <= 3: result = []
+        else: result = None
+        with self.lock:
+            self.entity_lookups += 1
+            if result is not None: self.entity_llm_skips += 1
+        return result
+
     def _extract_entities_from_query(self, query):
         """Uses the LLM to find what subjects the user is asking about."""
         entity_prompt = f"""
@@ -105,60 +285,104 @@ Query: "{query}"
 Subjects:"""
         try:
             payload = {"messages": [{"role": "user", "content": entity_prompt}], "temperature": 0.0, "n_predict": 48}
-            resp = requests.post(serverconfig.LLAMA_CPP_CHAT_URL, json=payload, timeout=60)
+            resp = backend.post("utility", serverconfig.CHAT_COMPLETIONS_PATH, json=payload)
             resp.raise_for_status()
+            from nodes import _sanitize_for_filename
             entities_raw = resp.json()['choices'][0]['message']['content'].strip()
             return [_sanitize_for_filename(e.strip()) for e in entities_raw.split(',') if e.strip()]
         except Exception as e:
             print(f"ENTITY_EXTRACTION_ERROR: {e}")
             return []
 
+    STATEMENT_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "enriched_fact": {"type": "string"},
+            "primary_entity": {"type": "string"},
+            "mentioned_entities": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["enriched_fact", "primary_entity", "mentioned_entities"],
+        "additionalProperties": False,
+    }
+
+    def analyze_statement(self, speaker_id, text, model_id=None):
+        """
+        One schema-constrained LLM call that replaces the enrich, route and entity-extraction
+        prompts. Returns {'speaker_id', 'text', 'enriched_fact', 'primary_entity', 'mentioned_entities'}
+        with sanitized entity ids, or None if the reply does not strictly match the schema.
+        A failure switches structured mode off for structured_retry_seconds, so a backend
+        that cannot do it costs one wasted call rather than one per turn.
+        """
+        if time.monotonic() < self._structured_retry_at: return None
+        analysis_prompt = f"""
+Analyze a message from '{speaker_id}' and answer with a JSON object with exactly these keys:
+- "enriched_fact": the message rewritten as a concise, self-contained, objective fact, resolving pronouns.
+- "primary_entity": the main person or topic the fact is about (use "{speaker_id}" if it is about the speaker).
+- "mentioned_entities": the names of all people or specific topics the message mentions or asks about. Use "self" if the speaker is talking or asking about themself.
+
+Message: "{text}"
+
+JSON:"""
+        try:
+            payload = {"messages": [{"role": "user", "content": analysis_prompt}], "temperature": 0.0, "n_predict": 192,
+                       "response_format": {"type": "json_object", "schema": self.STATEMENT_SCHEMA}}
+            if model_id: payload["model"] = model_id
+            resp = backend.post("utility", serverconfig.CHAT_COMPLETIONS_PATH, json=payload); resp.raise_for_status()
+            data = json.loads(resp.json()['choices'][0]['message']['content'])
+            if not isinstance(data, dict) or set(data) != set(self.STATEMENT_SCHEMA["required"]): raise ValueError(f"unexpected keys {sorted(data) if isinstance(data, dict) else type(data).__name__}")
+            fact, primary, mentioned = data["enriched_fact"], data["primary_entity"], data["mentioned_entities"]
+            if not isinstance(fact, str) or not fact.strip() or not isinstance(primary, str) or not isinstance(mentioned, list) or not all(isinstance(m, str) for m in mentioned):
+                raise ValueError("field types do not match the schema")
+        except Exception as e:
+            self._structured_retry_at = time.monotonic() + serverconfig.STRUCTURED_RETRY_SECONDS
+            print(f"STRUCTURED_ANALYSIS_WARN: Falling back to separate prompts for {serverconfig.STRUCTURED_RETRY_SECONDS}s: {e}")
+            return None
+        from nodes import _sanitize_for_filename
+        primary_id = _sanitize_for_filename(primary)
+        return {
+            "speaker_id": speaker_id, "text": text, "enriched_fact": fact.strip(),
+            "primary_entity": speaker_id if primary_id in ("", "self") else primary_id,
+            "mentioned_entities": [e for e in dict.fromkeys(_sanitize_for_filename(m) for m in mentioned) if e],
+        }
+
     ### NEW: The 'intelligent_recall' function that solves the "Two Sarahs" problem ###
-    def intelligent_recall(self, user_id, query, top_k=3, threshold=0.5):
+    def intelligent_recall(self, user_id, query, top_k=3, threshold=0.5, entities=None, query_vec=None):
+        """`entities`/`query_vec` may be precomputed (see analyze_query); missing ones are computed here."""
+        self.refresh()
         if not self.vectors: return []
         try:
-            entities_in_query = self._extract_entities_from_query(query)
+            if entities is None: entities = self._match_query_entities(user_id, query)
+            entities_in_query = self._extract_entities_from_query(query) if entities is None else entities
             if not entities_in_query:
                 print(f"[RECALL] No entities extracted from query: '{query}'")
                 return []
             
             print(f"[RECALL] User '{user_id}' querying about: {entities_in_query}")
             
-            with self.lock:
-                log_df = self.master_log.copy()
-
             # --- THE CORE INTELLIGENCE ---
             # This logic block is the new "brain" for recall.
             # It filters the entire memory log based on who is asking and what they are asking about.
             if 'self' in entities_in_query:
                 # Find memories where the user is either the speaker OR the subject.
-                relevant_memories_df = log_df[(log_df['speaker_id'] == user_id) | (log_df['entity_id'] == user_id)]
+                relevant_rows = self.index.rows_for_self(user_id)
             else:
                 # Find memories SPOKEN BY THE CURRENT USER about the specific entities queried.
                 # This is what differentiates Scott's "Sarah" from Fred's "Sarah".
-                relevant_memories_df = log_df[(log_df['speaker_id'] == user_id) & (log_df['entity_id'].isin(entities_in_query))]
+                relevant_rows = self.index.rows_for_entities(user_id, entities_in_query)
 
-            if relevant_memories_df.empty:
+            if not relevant_rows:
                 print(f"[RECALL] No relevant memories found for user '{user_id}' on topics {entities_in_query}.")
                 return []
 
             # Perform vector search ONLY on this highly relevant subset of memories
-            relevant_uuids = relevant_memories_df['uuid'].tolist()
-            filtered_vecs = {uuid: self.vectors[uuid] for uuid in relevant_uuids if uuid in self.vectors}
+            vector_rows = [r for r in (self.vectors.row_of(self.master_log[row].uuid) for row in relevant_rows) if r is not None]
+            if not vector_rows: return []
 
-            if not filtered_vecs: return []
-
-            query_vec = self._get_embedding(query)
-            
-            # Perform similarity search
-            uuids_list = list(filtered_vecs.keys())
-            vecs_array = np.array(list(filtered_vecs.values()))
-            sim = cosine_similarity(query_vec.reshape(1, -1), vecs_array)[0]
-            
-            top_indices = np.argsort(sim)[-top_k:][::-1]
-            results = [log_df.loc[log_df['uuid'] == uuids_list[i], 'text'].iloc[0] for i in top_indices if sim[i] >= threshold]
-            
-            return results
+            if query_vec is None: query_vec = self._get_embedding(query)
+            # The ANN index answers only for large candidate sets; otherwise scan exactly.
+            hits = self.ann.search(query_vec, vector_rows, top_k=top_k, threshold=threshold) if self.ann else None
+            if hits is None: hits = self.search.search_one(query_vec, rows=vector_rows, top_k=top_k, threshold=threshold)
+            return [self.index.text_by_uuid[self.vectors.uuids[row]] for row, score in hits]
         except Exception as e:
             import traceback; traceback.print_exc()
             return [f"LTM_RECALL_ERROR: {e}"]
@@ -167,26 +391,30 @@ Subjects:"""
     def enroll_user(self, user_id, conversation_history):
         if len(conversation_history) < 3: return
         try:
-            with self.lock:
-                user_messages = [msg['content'] for msg in conversation_history if msg['role'] == 'user']
-                if not user_messages: return
-                message_vectors = [self._get_embedding(msg) for msg in user_messages]
+            user_messages = [msg['content'] for msg in conversation_history if msg['role'] == 'user']
+            if not user_messages: return
+            message_vectors = self._get_embeddings(user_messages)
+            with self.lock, self._signatures_lock:
+                # Another worker may have enrolled someone since we last read the file.
+                if serverconfig.SHARED_STORE: self.signatures, _ = self._load_signatures()
                 self.signatures[user_id] = np.mean(message_vectors, axis=0)
                 save_file(self.signatures, serverconfig.SIGNATURES_FILE_PATH)
+                self._signatures_mtime = os.path.getmtime(serverconfig.SIGNATURES_FILE_PATH)
+                self._signature_search = None
             print(f"ENROLL: Signature for '{user_id}' saved successfully.")
         except Exception as e: print(f"ENROLL_ERROR: {e}")
 
     def identify_user(self, current_message_text, confidence_threshold=0.75):
+        self.refresh()
         if not self.signatures: return None
         try:
+            guest_vector = self._get_embedding(current_message_text)
             with self.lock:
-                guest_vector = self._get_embedding(current_message_text).reshape(1, -1)
                 if not self.signatures: return None # Check again after lock
-                known_users, signature_vectors = list(self.signatures.keys()), np.array(list(self.signatures.values()))
-            if signature_vectors.size == 0: return None
-            similarities = cosine_similarity(guest_vector, signature_vectors)[0]
-            best_match_index = np.argmax(similarities)
-            best_score = similarities[best_match_index]
-            if best_score >= confidence_threshold: return known_users[best_match_index]
-            return None
+                if self._signature_search is None:
+                    known_users = list(self.signatures.keys())
+                    self._signature_search = (known_users, SimilaritySearch(normalize(list(self.signatures.values()))))
+                known_users, signature_search = self._signature_search
+            best = signature_search.search_one(guest_vector, top_k=1, threshold=confidence_threshold)
+            return known_users[best[0][0]] if best else None
         except Exception as e: print(f"ID_ERROR: {e}"); return None
\ No newline at end of file
@@ -13,6 +13,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
     let imageBase64 = null;
 
+    // One session per browser (shared by its tabs), so its `//user` switches don't affect other users.
+    let sessionId = localStorage.getItem('stateagent-session-id');
+    if (!sessionId) {
+        sessionId = `web-${crypto.randomUUID()}`;
+        localStorage.setItem('stateagent-session-id', sessionId);
+    }
+
     // --- Event Listeners ---
     debugToggle.addEventListener('change', () => {
         debugPanel.classList.toggle('hidden', !debugToggle.checked);
@@ -60,13 +67,18 @@ document.addEventListener('DOMContentLoaded', () => {
             });
 
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-            
-            const data = await response.json();
-            const aiResponse = data.choices[0].message.content;
-            displayMessage(aiResponse, 'assistant');
 
-            // Update debugger
-            debugContent.textContent = JSON.stringify(data.debug_info, null, 2);
+            const contentType = response.headers.get('Content-Type') || '';
+            if (contentType.includes('text/event-stream')) {
+                await renderStream(response);
+            } else {
+                const data = await response.json();
+                const aiResponse = data.choices[0].message.content;
+                displayMessage(aiResponse, 'assistant');
+
+                // Update debugger
+                debugContent.textContent = JSON.stringify(data.debug_info, null, 2);
+            }
 
         } catch (error) {
             console.error('Fetch error:', error);
@@ -86,20 +98,56 @@ document.addEventListener('DOMContentLoaded', () => {
                 image_url: { url: image }
             });
         }
-        return { messages: [{ role: 'user', content: content }] };
+        return { messages: [{ role: 'user', content: content }], stream: true, session_id: sessionId };
     }
 
-    function displayMessage(text, role) {
-        const messageDiv = document.createElement('div');
-        messageDiv.className = `chat-message ${role}`;
+    // Reads OpenAI-style SSE chunks and renders the reply as the tokens arrive.
+    async function renderStream(response) {
+        const messageDiv = displayMessage('', 'assistant');
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let lastChunk = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop(); // keep any partial event for the next read
+            for (const event of events) {
+                const line = event.split('\n').find(l => l.startsWith('data:'));
+                if (!line) continue;
+                const data = line.slice(5).trim();
+                if (data === '[DONE]') continue;
+                lastChunk = JSON.parse(data);
+                const delta = lastChunk.choices[0].delta.content;
+                if (delta) {
+                    text += delta;
+                    renderMessage(messageDiv, text);
+                }
+            }
+        }
+        debugContent.textContent = JSON.stringify(lastChunk && lastChunk.debug_info, null, 2);
+    }
+
+    function renderMessage(messageDiv, text) {
         // A simple markdown-to-html for code blocks and bold
         let formattedText = text.replace(/\*\*(.*?)\*\*/g, '<strong>$1</strong>');
         formattedText = formattedText.replace(/```(\w+)?\n([\s\S]+?)```/g, '<pre><code>$2</code></pre>');
         messageDiv.innerHTML = formattedText;
-        chatWindow.appendChild(messageDiv);
         chatWindow.scrollTop = chatWindow.scrollHeight;
     }
 
+    function displayMessage(text, role) {
+        const messageDiv = document.createElement('div');
+        messageDiv.className = `chat-message ${role}`;
+        chatWindow.appendChild(messageDiv);
+        renderMessage(messageDiv, text);
+        return messageDiv;
+    }
+
     // Initial welcome message
     displayMessage("Welcome to StateAgent v0.2. How can I assist you?", "assistant");
 });
\ No newline at end of file
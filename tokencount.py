@@ -0,0 +1,33 @@
+# --- START OF FILE tokencount.py ---
+
+import threading
+
+ENCODING_NAME = "cl100k_base"
+MESSAGE_OVERHEAD = 4 # role/separator tokens added per chat message
+IMAGE_TOKENS = 85    # flat estimate for one image_url part
+
+_encoder, _encoder_lock = None, threading.Lock()
+
+def encoder():
+    """The tiktoken encoder, loaded on first use rather than at import (loading may download the BPE file)."""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                import tiktoken
+                _encoder = tiktoken.get_encoding(ENCODING_NAME)
+    return _encoder
+
+def count_text(text): return len(encoder().encode(text)) if text else 0
+
+def count_message(message):
+    """Tokens for one chat message, including multimodal content lists."""
+    count, content = MESSAGE_OVERHEAD, message.get("content")
+    if isinstance(content, str): count += count_text(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text": count += count_text(part.get("text", ""))
+            elif part.get("type") == "image_url": count += IMAGE_TOKENS
+    return count
+
+# --- END OF FILE tokencount.py ---
@@ -0,0 +1,204 @@
+# --- START OF FILE vectorstore.py ---
+
+import os
+import json
+import threading
+from collections import Counter
+import numpy as np
+from filelock import InterProcessLock
+
+class VectorStore:
+    """
+    Append-only store for memory vectors, kept as ONE memory-mapped float32 matrix.
+
+    Files inside `directory`:
+      vectors.f32   row-major float32 matrix, one row per memory
+      vectors.ids   one uuid per line; line N belongs to row N
+      vectors.json  metadata (embedding dimension, normalization and legacy migration flags)
+
+    Opening the store costs a constant number of file opens regardless of how many
+    memories exist; vector data is paged in by the OS only when a row is touched.
+    The class behaves like a read-only dict of uuid -> vector for existing callers.
+
+    With `normalize=True` every row is stored at unit length, so cosine similarity against
+    the matrix is a plain dot product (see similarity.SimilaritySearch).
+
+    Several processes can share one store: appends are serialized by a lock file
+    (vectors.lock) and `refresh()` picks up rows other processes appended.
+    """
+    MATRIX_FILE = "vectors.f32"
+    INDEX_FILE = "vectors.ids"
+    META_FILE = "vectors.json"
+    LOCK_FILE = "vectors.lock"
+    DTYPE = np.float32
+
+    def __init__(self, directory, legacy_extension=None, legacy_loader=None, normalize=False):
+        self.directory = directory
+        self.normalize = normalize
+        os.makedirs(directory, exist_ok=True)
+        self.matrix_path = os.path.join(directory, self.MATRIX_FILE)
+        self.index_path = os.path.join(directory, self.INDEX_FILE)
+        self.meta_path = os.path.join(directory, self.META_FILE)
+        self.lock = threading.Lock()
+        self.file_lock = InterProcessLock(os.path.join(directory, self.LOCK_FILE))
+
+        with self.file_lock:
+            self._meta = self._load_meta()
+            self.dim = self._meta.get("dim")
+            self._uuids, self._rows = [], {}
+            self._mmap, self._mapped_rows = None, 0
+            self._load_index()
+
+            self._matrix_fh = open(self.matrix_path, "ab")
+            self._index_fh = open(self.index_path, "ab")
+
+            if normalize and not self._meta.get("normalized"):
+                self._normalize_existing_rows()
+            if legacy_extension and legacy_loader and not self._meta.get("legacy_migrated"):
+                self._migrate_legacy_files(legacy_extension, legacy_loader)
+
+    # --- Loading ---
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f: return json.load(f)
+        except FileNotFoundError: return {}
+
+    def _save_meta(self):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(self._meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f: raw = f.read()
+        except FileNotFoundError: raw = ""
+        lines = raw.split("\n")
+        # A missing trailing newline means the last append was interrupted mid-line.
+        uuids = lines[:-1]
+
+        matrix_bytes = os.path.getsize(self.matrix_path) if os.path.exists(self.matrix_path) else 0
+        row_bytes = self.dim * np.dtype(self.DTYPE).itemsize if self.dim else 0
+        matrix_rows = matrix_bytes // row_bytes if row_bytes else 0
+
+        # Rows are written before their uuid, so the two files can only disagree by a torn append.
+        rows = min(len(uuids), matrix_rows)
+        if rows != len(uuids) or (raw and not raw.endswith("\n")):
+            with open(self.index_path, "w", encoding="utf-8") as f: f.write("".join(f"{u}\n" for u in uuids[:rows]))
+        if row_bytes and matrix_bytes != rows * row_bytes:
+            with open(self.matrix_path, "r+b") as f: f.truncate(rows * row_bytes)
+            print(f"VECTOR_STORE_WARN: Discarded a partially written vector in '{self.matrix_path}'.")
+
+        self._uuids = uuids[:rows]
+        self._rows = {u: i for i, u in enumerate(self._uuids)}
+        self._index_offset = sum(len(u.encode("utf-8")) + 1 for u in self._uuids) # bytes of vectors.ids already read
+
+    def _normalize_existing_rows(self, chunk_rows=65536):
+        """One-time, in-place upgrade of a store written before rows were kept normalized."""
+        rows = len(self._uuids)
+        if rows:
+            data = np.memmap(self.matrix_path, dtype=self.DTYPE, mode="r+", shape=(rows, self.dim))
+            for start in range(0, rows, chunk_rows):
+                chunk = data[start:start + chunk_rows]
+                norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+                np.divide(chunk, norms, out=chunk, where=norms > 0)
+            data.flush(); del data
+            print(f"VECTOR_STORE: Normalized {rows} stored vectors to unit length.")
+        self._meta["normalized"] = True; self._save_meta()
+
+    def _migrate_legacy_files(self, extension, loader):
+        """One-time import of the old one-file-per-memory layout into the matrix."""
+        legacy_files = sorted(f for f in os.listdir(self.directory) if f.endswith(extension))
+        migrated = 0
+        for filename in legacy_files:
+            unique_id = os.path.splitext(filename)[0]
+            if unique_id in self._rows: continue
+            try:
+                self.add(unique_id, loader(os.path.join(self.directory, filename))["embedding"]); migrated += 1
+            except Exception as e: print(f"VECTOR_STORE_WARN: Failed to migrate legacy vector '{filename}': {e}")
+        self._meta["legacy_migrated"] = True; self._save_meta()
+        if legacy_files:
+            print(f"VECTOR_STORE: Migrated {migrated} legacy '{extension}' files into '{self.MATRIX_FILE}'. They are no longer read and can be deleted.")
+
+    # --- Writing ---
+    def add(self, unique_id, vector):
+        """Appends one vector. Returns its row."""
+        return self.add_many([unique_id], np.asarray(vector, dtype=self.DTYPE).reshape(1, -1))
+
+    def add_many(self, unique_ids, vectors):
+        """Appends several vectors with one write per file. Returns the row of the first one."""
+        mat = np.array(vectors, dtype=self.DTYPE).reshape(len(unique_ids), -1)
+        if self.normalize:
+            norms = np.linalg.norm(mat, axis=1, keepdims=True); np.divide(mat, norms, out=mat, where=norms > 0)
+        with self.file_lock, self.lock:
+            # Rows other processes appended come first; our row number is whatever is next on disk.
+            self._read_new_rows()
+            first_row = len(self._uuids)
+            if not unique_ids: return first_row
+            duplicate = next((u for u in unique_ids if u in self._rows), None)
+            if duplicate is None and len(set(unique_ids)) != len(unique_ids): duplicate = next(u for u, n in Counter(unique_ids).items() if n > 1)
+            if duplicate is not None: raise KeyError(f"Vector '{duplicate}' already exists.")
+            if self.dim is None:
+                self.dim = int(mat.shape[1]); self._meta["dim"] = self.dim; self._save_meta()
+            elif mat.shape[1] != self.dim:
+                raise ValueError(f"Vector dimension {mat.shape[1]} does not match store dimension {self.dim}.")
+            lines = "".join(f"{u}\n" for u in unique_ids).encode("utf-8")
+            self._matrix_fh.write(mat.tobytes()); self._matrix_fh.flush()
+            self._index_fh.write(lines); self._index_fh.flush()
+            for row, unique_id in enumerate(unique_ids, first_row): self._rows[unique_id] = row
+            self._uuids.extend(unique_ids); self._index_offset += len(lines)
+            return first_row
+
+    def refresh(self):
+        """Loads rows appended by other processes. Returns how many were new."""
+        with self.lock: return self._read_new_rows()
+
+    def _read_new_rows(self):
+        # Caller holds self.lock. A row is visible once its uuid line is complete; the vector was written first.
+        try:
+            if os.path.getsize(self.index_path) <= self._index_offset: return 0
+            with open(self.index_path, "rb") as f: f.seek(self._index_offset); raw = f.read()
+        except FileNotFoundError: return 0
+        complete = raw[:raw.rfind(b"\n") + 1]
+        if not complete: return 0
+        if self.dim is None: self._meta = self._load_meta(); self.dim = self._meta.get("dim")
+        new_ids = complete.decode("utf-8").split("\n")[:-1]
+        for unique_id in new_ids: self._rows[unique_id] = len(self._uuids); self._uuids.append(unique_id)
+        self._index_offset += len(complete)
+        return len(new_ids)
+
+    def close(self):
+        with self.lock:
+            self._matrix_fh.close(); self._index_fh.close(); self._mmap = None
+
+    # --- Reading ---
+    @property
+    def matrix(self):
+        """A (rows, dim) read-only memory map of every stored vector."""
+        rows = len(self._uuids)
+        if rows == 0: return np.empty((0, self.dim or 0), dtype=self.DTYPE)
+        if self._mmap is None or self._mapped_rows != rows:
+            with self.lock:
+                rows = len(self._uuids)
+                self._mmap = np.memmap(self.matrix_path, dtype=self.DTYPE, mode="r", shape=(rows, self.dim))
+                self._mapped_rows = rows
+        return self._mmap
+
+    @property
+    def uuids(self): return self._uuids
+
+    def row_of(self, unique_id): return self._rows.get(unique_id)
+
+    def get(self, unique_id, default=None):
+        row = self._rows.get(unique_id)
+        return default if row is None else self.matrix[row]
+
+    def __getitem__(self, unique_id):
+        row = self._rows.get(unique_id)
+        if row is None: raise KeyError(unique_id)
+        return self.matrix[row]
+
+    def __contains__(self, unique_id): return unique_id in self._rows
+    def __len__(self): return len(self._uuids)
+    def __iter__(self): return iter(list(self._uuids))
+
+# --- END OF FILE vectorstore.py ---
@@ -0,0 +1,22 @@
+# --- START OF FILE wsgi.py ---
+"""
+WSGI entry point for running the orchestrator under a multi-process server, e.g.
+
+    gunicorn -w 4 -k gthread --threads 8 -b 127.0.0.1:8000 wsgi:app
+
+Each worker process builds its own agent when it imports this module and all of them
+share one memory store (see serverconfig.SHARED_STORE). Do not use --preload: the agent's
+files, locks and background threads have to be created inside each worker.
+"""
+import atexit
+import serverconfig, backend
+
+serverconfig.SHARED_STORE = backend.slots.shared = True
+
+import server
+
+server.start_services(serverconfig.DEFAULT_PERSONA_ID, serverconfig.DEFAULT_ABILITY_ID, serverconfig.DEFAULT_ENGINE_ID)
+atexit.register(server.stop_services)
+app = server.app
+
+# --- END OF FILE wsgi.py ---